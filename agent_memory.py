@@ -0,0 +1,85 @@
+"""
+智能体的有界内存
+
+长局游戏或大规模玩家时，每个 Agent 的 llm_interactions（每次调用的完整prompt）、reasoning 和
+belief_memory（含完整的信念更新prompt）是主要的内存占用，而游戏过程中只会读取最新的信念和最近几条reasoning。
+有界内存模式下这些列表只在内存中保留最后几条，更早的记录按顺序追加到每个智能体的JSONL溢出文件中；
+遍历、len() 和下标访问仍按完整列表的语义工作，GameRecorder 保存时会从磁盘读回全部记录。
+"""
+
+import json
+import os
+
+
+class SpillStore:
+    """单个智能体的溢出文件：每行一条 {"kind": 类别, "record": 记录}
+
+    每次追加时打开并关闭文件，不长期占用文件描述符，玩家数超过进程的文件数上限时也能运行
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 与原先以追加模式打开时一样创建文件（已存在时保留内容）
+        open(path, "a", encoding="utf-8").close()
+
+    def append(self, kind, record):
+        line = json.dumps({"kind": kind, "record": record}, ensure_ascii=False, default=str) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def iter(self, kind):
+        """按写入顺序遍历某一类别的记录"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["kind"] == kind:
+                    yield entry["record"]
+
+    def remove(self):
+        """删除溢出文件"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SpilledList:
+    """只在内存中保留最后 keep_last 条记录的列表，更早的记录写入 SpillStore"""
+
+    def __init__(self, store, kind, keep_last, items=()):
+        self.store = store
+        self.kind = kind
+        self.keep_last = keep_last
+        self._recent = []
+        self._spilled = 0
+        for item in items:
+            self.append(item)
+
+    def append(self, item):
+        self._recent.append(item)
+        while len(self._recent) > self.keep_last:
+            self.store.append(self.kind, self._recent.pop(0))
+            self._spilled += 1
+
+    def __len__(self):
+        return self._spilled + len(self._recent)
+
+    def __iter__(self):
+        if self._spilled:
+            yield from self.store.iter(self.kind)
+        yield from self._recent
+
+    def __getitem__(self, index):
+        indices = range(len(self))[index]
+        if isinstance(index, slice):
+            if not indices or min(indices) >= self._spilled:
+                return [self._recent[i - self._spilled] for i in indices]
+            items = list(self)
+            return [items[i] for i in indices]
+        if indices >= self._spilled:
+            return self._recent[indices - self._spilled]
+        return list(self)[indices]
+
+    def __repr__(self):
+        return f"SpilledList(kind={self.kind!r}, len={len(self)}, in_memory={len(self._recent)})"
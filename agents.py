@@ -1,12 +1,27 @@
 # agents.py
-from openai import OpenAI
-from zhipuai import ZhipuAI
-from pydantic import BaseModel, Field
-from config import API_KEYS, GAME_CONFIG, MODEL_CONFIG
-from personality_traits import PERSONALITY_PROMPTS
+# 各提供商的SDK在首次使用时才导入（见 llm_clients 和 _build_gemini_request），
+# 只使用某一个提供商的运行不需要加载其他提供商的SDK
+import asyncio
 import datetime
-import time
 import json
+import threading
+import time
+from pydantic import BaseModel, Field
+from config import MODEL_CONFIG, GAME_CONFIG, CACHE_CONFIG, PROMPT_CONFIG
+from personality_traits import PERSONALITY_PROMPTS
+from llm_clients import get_client, get_async_client
+from llm_scheduler import get_scheduler, estimate_tokens
+from llm_retry import RetryPolicy, LLMCallError, RATE_LIMITED, classify_error
+from llm_cache import get_response_cache, make_cache_key
+from llm_usage import response_usage, result_usage
+from llm_metrics import get_metrics
+from profiling import profiled, phase
+from llm_replay import get_replay_source
+import llm_fake
+from llm_schemas import contribution_decision_model, final_decision_model, model_schema_text
+from agent_memory import SpillStore, SpilledList
+from history_aggregates import HistoryAggregates
+from llm_batch import PreparedCall
 
 # 把公用的描述提取到一个变量里
 COMMON_REASONING_DESC = "思考过程：需要输出得到 output 的完整思考链路。"
@@ -42,20 +57,17 @@ class BeliefUpdate(BaseModel):
         ...,
         description="更新后的性格和合作倾向描述"
     )
-import os
-import json
-import openai
-from openai import OpenAI
-from zhipuai import ZhipuAI
-from google import genai
-from google.genai import types
-from config import API_KEYS, MODEL_CONFIG, GAME_CONFIG
-from personality_traits import PERSONALITY_PROMPTS
-import datetime
-import time
+
+# 并发决策时多个线程同时打印调试信息，每段调试输出拼成一个字符串后在锁内一次打印，避免不同智能体的行交错
+_PRINT_LOCK = threading.Lock()
+
+def _print_block(lines):
+    with _PRINT_LOCK:
+        print("\n".join(lines), flush=True)
 
 class Agent:
-    def __init__(self, agent_id, personality_type, is_anchor=False, model=None, provider=None):
+    def __init__(self, agent_id, personality_type, is_anchor=False, model=None, provider=None, game_config=None,
+                 game_id=None):
         """
         Args:
             agent_id: str，智能体的唯一标识符
@@ -63,12 +75,19 @@ class Agent:
             is_anchor: 是否是锚定智能体
             model: 使用的模型名称
             provider: 模型提供商
+            game_config: 本局游戏配置（默认使用全局 GAME_CONFIG）
+            game_id: 所属游戏的标识，用于调度器在多局游戏之间公平排队
         """
+        # 显式传入的本局配置，使同一进程内的多局游戏互不影响
+        self.game_config = game_config if game_config is not None else GAME_CONFIG
+        self.game_id = game_id
         self.id = agent_id
         self.name = f"{int(agent_id) + 1}"  # 智能体名称，基于ID+1生成
         self.is_anchor = is_anchor
         self.personality_type = personality_type  # 保存性格类型
         self.debug_prompts = False  # 默认关闭调试
+        # 当前轮次（由 GameController 在每轮开始时设置并写入每条LLM交互记录；最终决策时为None）
+        self.round_number = None
         # anchor智能体不需要prompt
         if not self.is_anchor:
             if personality_type in PERSONALITY_PROMPTS:
@@ -83,231 +102,426 @@ class Agent:
         self.belief_memory = []   # 信念记忆：每轮更新，存储对自身身份/风格的宏观反思
         self.llm_interactions = []  # LLM交互记录：存储每次AI交互的完整输入输出
         self.reasoning = []  # 用于存储每轮reasoning等短期记忆，替代short_term_memory
-        self.current_endowment = GAME_CONFIG["endowment"]  # 当前禀赋
-        self.current_total_money = GAME_CONFIG["endowment"]  # 当前总金额（初始禀赋 + 累计收益）
+        self.current_endowment = self.game_config["endowment"]  # 当前禀赋
+        self.current_total_money = self.game_config["endowment"]  # 当前总金额（初始禀赋 + 累计收益）
+        # 事件回调 event_sink(kind, agent, record)：流式记录模式下由 GameRecorder 设置，
+        # 每次LLM交互（"interaction"）和信念更新（"belief"）发生时立即写入磁盘
+        self.event_sink = None
+        # 是否在内存中保留完整的LLM交互记录（流式记录模式下交互记录已写入磁盘，无需保留）
+        self.retain_interactions = True
+        # 有界内存模式下的溢出文件（见 enable_bounded_memory）
+        self.spill_store = None
         
         # 使用配置文件中指定的模型
         self.provider = provider or MODEL_CONFIG["provider"]
         self.model = model or MODEL_CONFIG["model"]
         
+        # 同一进程内相同 provider/base_url/api_key 的智能体共享客户端和连接池
+        self.client = get_client(self.provider)
+        # 回放模式：从已保存的游戏记录中读取响应
+        self.replay_source = get_replay_source(self.game_config["replay_file"], game_id) if self.provider == "replay" else None
+
+    def enable_bounded_memory(self, spill_path, reasoning_window=3, belief_window=1, interaction_window=0):
+        """有界内存模式：llm_interactions、reasoning、belief_memory 只在内存中保留最后几条，其余写入溢出文件
+        
+        Args:
+            spill_path: 本智能体的溢出文件路径
+            reasoning_window: 内存中保留的最近reasoning条数
+            belief_window: 内存中保留的最近信念记忆条数
+            interaction_window: 内存中保留的最近LLM交互记录条数
+        """
+        self.spill_store = SpillStore(spill_path)
+        self.llm_interactions = SpilledList(self.spill_store, "interaction", interaction_window, self.llm_interactions)
+        self.reasoning = SpilledList(self.spill_store, "reasoning", reasoning_window, self.reasoning)
+        self.belief_memory = SpilledList(self.spill_store, "belief", belief_window, self.belief_memory)
+
+    def restore_state(self, history, belief_memory, interactions):
+        """从已保存的游戏记录恢复状态（用于中断游戏的续跑）
+        
+        Args:
+            history: 已完成各轮的基础数据（record_round_data 的返回值列表）
+            belief_memory: 已完成各轮的信念记忆
+            interactions: 已完成各轮的LLM交互记录（按调用顺序）
+        """
+        for entry in history:
+            self.history.append(entry)
+        for interaction in interactions:
+            if self.event_sink is not None:
+                self.event_sink("interaction", self, interaction)
+            if self.retain_interactions:
+                self.llm_interactions.append(interaction)
+            reasoning = interaction.get("output", {}).get("reasoning")
+            if reasoning:
+                self.reasoning.append(reasoning)
+        for belief in belief_memory:
+            self.belief_memory.append(belief)
+            if self.event_sink is not None:
+                self.event_sink("belief", self, belief)
+        if belief_memory:
+            self.system_prompt = belief_memory[-1]["updated_personality"].replace("我", "你")
+        # 与 record_round_data / update_memory 的结算方式一致
+        if history:
+            last = history[-1]
+            if self.is_anchor:
+                self.current_total_money = int(round(last["total_money_before_round"] - last["contribution"] + last["payoff"]))
+            else:
+                self.current_total_money = int(round(last["payoff"]))
+
+    @property
+    def async_client(self):
+        """当前事件循环下共享的异步客户端，供 _acall_llm 使用"""
+        return get_async_client(self.provider)
+
+    @profiled("agent.debug_print")
+    def _print_prompt_debug(self, messages, debug_label, structured_output):
+        """调试模式下打印发送给LLM的完整消息"""
+        if not self.debug_prompts:
+            return
+        try:
+            lines = [
+                f"\n{'='*80}",
+                f"【Agent {self.name} - {self.personality_type} - {self.provider}/{self.model}】{debug_label}",
+                f"{'='*80}"
+            ]
+            for i, msg in enumerate(messages):
+                role_name = "系统消息" if msg["role"] == "system" else "用户消息"
+                lines.append(f"\n【{role_name}】")
+                lines.append(f"{msg['content']}")
+            if structured_output:
+                lines.append(f"\n【结构化输出类型】: {structured_output.__name__}")
+            lines.append(f"{'='*80}\n")
+            _print_block(lines)
+        except Exception as debug_error:
+            print(f"调试输出错误: {debug_error}")
+
+    @staticmethod
+    def _parse_structured_response(parsed_response):
+        """从结构化输出对象中提取 (content, reasoning, estimated_others_avg_ratio, output_ratio)
+        
+        小组决策的输出（含 decisions 列表）整体序列化为JSON文本作为content，由 group_decision 拆分给各玩家
+        """
+        if hasattr(parsed_response, "decisions"):
+            return parsed_response.model_dump_json(), None, None, None
+        if hasattr(parsed_response, "reasoning") and hasattr(parsed_response, "output"):
+            reasoning = parsed_response.reasoning
+            output = parsed_response.output
+            # 提取estimated_others_avg_ratio和output_ratio（如果存在）
+            estimated_others_avg_ratio = getattr(parsed_response, "estimated_others_avg_ratio", None)
+            output_ratio = getattr(parsed_response, "output_ratio", None)
+            if isinstance(output, (int, float)):
+                response_content = str(output)
+            else:
+                response_content = output
+            return response_content, reasoning, estimated_others_avg_ratio, output_ratio
+        return str(parsed_response), None, None, None
+
+    def _openai_params(self, messages):
+        """OpenAI Responses API 的公共请求参数
+        
+        启用 PROMPT_CONFIG["cache_key"] 时附带 prompt_cache_key（同一局游戏共用），
+        使共享前缀相同的请求尽量路由到同一缓存
+        """
+        params = {"model": self.model, "input": messages}
+        if PROMPT_CONFIG["cache_key"] and self.game_id:
+            params["prompt_cache_key"] = f"pgg-{self.game_id}"
+        return params
+
+    def _build_gemini_request(self, messages, structured_output):
+        """将messages转换为Gemini的 (contents, config)，支持system instruction
+        
+        不使用显式缓存（cached_content）：固定的规则和schema低于显式缓存的最小token数，依靠隐式前缀缓存（见README）
+        """
+        system_instruction = ""
+        user_content = ""
+        
+        for msg in messages:
+            if msg["role"] == "system":
+                system_instruction += msg["content"] + "\n\n"
+            elif msg["role"] == "user":
+                user_content += msg["content"] + "\n\n"
+            elif msg["role"] == "assistant":
+                user_content += f"[Previous response: {msg['content']}]\n\n"
+        
+        from google.genai import types
+        
+        # 构建GenerateContentConfig
+        config_kwargs = {
+            "thinking_config": types.ThinkingConfig(thinking_budget=0)
+        }
+        
+        # 如果有system instruction，添加到config
+        if system_instruction.strip():
+            config_kwargs["system_instruction"] = system_instruction.strip()
+        
+        # 如果有structured_output要求，添加JSON schema
+        if structured_output:
+            config_kwargs["response_mime_type"] = "application/json"
+            config_kwargs["response_schema"] = structured_output
+        
+        return user_content.strip(), types.GenerateContentConfig(**config_kwargs)
+
+    def _parse_gemini_response(self, response, structured_output):
+        """处理Gemini响应"""
+        if structured_output:
+            # 使用结构化输出
+            return self._parse_structured_response(response.parsed)
+        # 非结构化输出
+        return response.text.strip(), None, None, None
+
+    def _build_deepseek_params(self, messages, structured_output):
+        """构建DeepSeek（OpenAI兼容API + JSON mode）的请求参数"""
+        if not structured_output:
+            return {
+                "model": self.model,
+                "messages": messages
+            }
+        # DeepSeek需要在system prompt中说明JSON格式
+        # 添加JSON输出格式说明到system message
+        schema_instruction = f"\n\nPlease output your response in the following JSON format:\n{model_schema_text(structured_output)}\n\nIMPORTANT: Output ONLY valid JSON, no additional text."
+        
+        # 修改messages,将schema说明加入system prompt
+        modified_messages = messages.copy()
+        if modified_messages and modified_messages[0]["role"] == "system":
+            modified_messages[0] = {
+                "role": "system",
+                "content": modified_messages[0]["content"] + schema_instruction
+            }
+        else:
+            modified_messages.insert(0, {
+                "role": "system", 
+                "content": schema_instruction
+            })
+        
+        # 使用JSON mode (简化格式)
+        return {
+            "model": self.model,
+            "messages": modified_messages,
+            "response_format": {
+                "type": "json_object"  # DeepSeek使用简化的JSON mode
+            }
+        }
+
+    def _parse_deepseek_response(self, response, structured_output):
+        """处理DeepSeek响应"""
+        raw_content = response.choices[0].message.content.strip()
+        if not structured_output:
+            return raw_content, None, None, None
+        # 解析JSON为Pydantic对象
+        parsed_data = json.loads(raw_content)
+        return self._parse_structured_response(structured_output(**parsed_data))
+
+    @profiled("llm.request")
+    def _request_llm(self, messages, structured_output=None):
+        """同步发送一次请求（不含重试）
+        
+        Returns:
+            tuple: (response_content, reasoning, estimated_others_avg_ratio, output_ratio, usage)，
+                   usage 为 llm_usage 统一格式的token用量（回放提供商只返回前4项）
+        """
         if self.provider == "openai":
-            # openai.api_key = API_KEYS["openai"]
-            self.client = OpenAI(api_key=API_KEYS["openai"])
-        elif self.provider == "zhipuai":
-            self.client = ZhipuAI(api_key=API_KEYS["zhipuai"])
+            params = self._openai_params(messages)
+            if structured_output:
+                response = self.client.responses.parse(**params, text_format=structured_output)
+                return self._parse_structured_response(response.output_parsed) + (response_usage(self.provider, response),)
+            response = self.client.responses.create(**params)
+            return response.output_text, None, None, None, response_usage(self.provider, response)
         elif self.provider == "gemini":
-            # 使用新的Google GenAI SDK
-            self.client = genai.Client(api_key=API_KEYS["gemini"])
+            contents, config = self._build_gemini_request(messages, structured_output)
+            response = self.client.models.generate_content(
+                model=self.model,
+                contents=contents,
+                config=config
+            )
+            return self._parse_gemini_response(response, structured_output) + (response_usage(self.provider, response),)
         elif self.provider == "deepseek":
-            # DeepSeek使用OpenAI兼容的API
-            self.client = OpenAI(
-                api_key=API_KEYS["deepseek"],
-                base_url="https://api.deepseek.com"
+            params = self._build_deepseek_params(messages, structured_output)
+            response = self.client.chat.completions.create(**params)
+            return self._parse_deepseek_response(response, structured_output) + (response_usage(self.provider, response),)
+        elif self.provider == "replay":
+            return self.replay_source.respond(self.id, messages)
+        elif self.provider == "fake":
+            return llm_fake.respond(self, messages, structured_output)
+        raise ValueError(f"Unsupported provider: {self.provider}")
+
+    @profiled("llm.request")
+    async def _arequest_llm(self, messages, structured_output=None):
+        """异步发送一次请求（不含重试），返回值同 _request_llm"""
+        if self.provider == "openai":
+            params = self._openai_params(messages)
+            if structured_output:
+                response = await self.async_client.responses.parse(**params, text_format=structured_output)
+                return self._parse_structured_response(response.output_parsed) + (response_usage(self.provider, response),)
+            response = await self.async_client.responses.create(**params)
+            return response.output_text, None, None, None, response_usage(self.provider, response)
+        elif self.provider == "gemini":
+            contents, config = self._build_gemini_request(messages, structured_output)
+            response = await self.async_client.models.generate_content(
+                model=self.model,
+                contents=contents,
+                config=config
             )
+            return self._parse_gemini_response(response, structured_output) + (response_usage(self.provider, response),)
+        elif self.provider == "deepseek":
+            params = self._build_deepseek_params(messages, structured_output)
+            response = await self.async_client.chat.completions.create(**params)
+            return self._parse_deepseek_response(response, structured_output) + (response_usage(self.provider, response),)
+        elif self.provider == "replay":
+            return self.replay_source.respond(self.id, messages)
+        elif self.provider == "fake":
+            return await llm_fake.arespond(self, messages, structured_output)
+        # 没有原生异步客户端的提供商退化为线程内的同步调用
+        return await asyncio.to_thread(self._request_llm, messages, structured_output)
 
     def _call_llm(self, messages, debug_label="", structured_output=None): 
+        """调用LLM并记录交互，重试耗尽或遇到不可重试的错误时抛出 LLMCallError"""
         # 记录交互开始时间
         start_time = datetime.datetime.now()
+        self._print_prompt_debug(messages, debug_label, structured_output)
+        return self._finish_call(messages, debug_label, structured_output, start_time,
+                                 *self._execute_call(messages, structured_output))
+
+    def _execute_call(self, messages, structured_output=None):
+        """发出请求（含响应缓存、调度和重试），不记录交互
         
-        # 添加调试输出
-        if self.debug_prompts:
+        Returns:
+            tuple: (result, error, attempts, queue_seconds, cache_status)，失败时 result 为None
+        """
+        # 先查响应缓存，命中则不发出请求
+        cache_key = self._cache_key(messages, structured_output)
+        if cache_key:
+            cached = get_response_cache().get(cache_key)
+            if cached is not None:
+                return tuple(cached), None, 1, 0.0, "hit"
+        result, error, attempt, queue_seconds = self._scheduled_request(messages, structured_output)
+        if error is None and cache_key:
+            get_response_cache().put(cache_key, self.provider, self.model, list(result[:4]))
+        return result, error, attempt, queue_seconds, "miss" if cache_key else None
+
+    def _scheduled_request(self, messages, structured_output=None):
+        """经调度器限流和重试策略发出请求（不查响应缓存），批处理的 local 后端也使用它
+        
+        Returns:
+            tuple: (result, error, attempts, queue_seconds)，失败时 result 为None
+        """
+        scheduler = get_scheduler()
+        policy = RetryPolicy()
+        estimated_tokens = estimate_tokens(messages)
+        queue_seconds = 0.0
+        attempt = 0
+        
+        while True:
+            attempt += 1
             try:
-                print(f"\n{'='*80}")
-                print(f"【Agent {self.name} - {self.personality_type} - {self.provider}/{self.model}】{debug_label}")
-                print(f"{'='*80}")
-                for i, msg in enumerate(messages):
-                    role_name = "系统消息" if msg["role"] == "system" else "用户消息"
-                    print(f"\n【{role_name}】")
-                    print(f"{msg['content']}")
-                if structured_output:
-                    print(f"\n【结构化输出类型】: {structured_output.__name__}")
-                print(f"{'='*80}\n")
-            except Exception as debug_error:
-                print(f"调试输出错误: {debug_error}")
+                # 每次请求（包括重试）都需先通过调度器的限流和公平排队
+                grant = scheduler.acquire(self.provider, self.model, estimated_tokens, self.game_id)
+                queue_seconds += grant.queue_seconds
+                try:
+                    result = self._request_llm(messages, structured_output)
+                    usage = result_usage(result)
+                    if usage:
+                        # 按实际用量修正TPM令牌桶
+                        grant.used_tokens = usage["total_tokens"]
+                finally:
+                    scheduler.release(grant)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                delay = self._retry_delay(policy, scheduler, attempt, e)
+                if delay is None:
+                    break
+                time.sleep(delay)
+        return result if error is None else None, error, attempt, queue_seconds
+
+    async def _acall_llm(self, messages, debug_label="", structured_output=None):
+        """_call_llm 的异步版本：使用提供商的异步客户端，重试等待不阻塞事件循环"""
+        start_time = datetime.datetime.now()
+        self._print_prompt_debug(messages, debug_label, structured_output)
+        return self._finish_call(messages, debug_label, structured_output, start_time,
+                                 *await self._aexecute_call(messages, structured_output))
+
+    async def _aexecute_call(self, messages, structured_output=None):
+        """_execute_call 的异步版本"""
+        cache_key = self._cache_key(messages, structured_output)
+        if cache_key:
+            cached = get_response_cache().get(cache_key)
+            if cached is not None:
+                return tuple(cached), None, 1, 0.0, "hit"
+        scheduler = get_scheduler()
+        policy = RetryPolicy()
+        estimated_tokens = estimate_tokens(messages)
+        queue_seconds = 0.0
+        attempt = 0
         
-        try:
-            # LLM自动重试机制
-            max_retry = 10
-            retry_count = 0
-            while True:
+        while True:
+            attempt += 1
+            try:
+                grant = await scheduler.aacquire(self.provider, self.model, estimated_tokens, self.game_id)
+                queue_seconds += grant.queue_seconds
                 try:
-                    if self.provider == "openai":
-                        if structured_output:
-                            params = {
-                                "model": self.model,
-                                "input": messages,
-                                "text_format": structured_output
-                            }
-                            response = self.client.responses.parse(**params)
-                            parsed_response = response.output_parsed
-                            if hasattr(parsed_response, "reasoning") and hasattr(parsed_response, "output"):
-                                reasoning = parsed_response.reasoning
-                                output = parsed_response.output
-                                # 提取estimated_others_avg_ratio和output_ratio（如果存在）
-                                estimated_others_avg_ratio = getattr(parsed_response, "estimated_others_avg_ratio", None)
-                                output_ratio = getattr(parsed_response, "output_ratio", None)
-                                if isinstance(output, (int, float)):
-                                    response_content = str(output)
-                                else:
-                                    response_content = output
-                            else:
-                                reasoning = None
-                                estimated_others_avg_ratio = None
-                                output_ratio = None
-                                response_content = str(parsed_response)
-                        else:
-                            params = {
-                                "model": self.model,
-                                "input": messages
-                            }
-                            response = self.client.responses.create(**params)
-                            raw_response = response.output_text
-                            response_content = raw_response
-                            reasoning = None
-                            estimated_others_avg_ratio = None
-                            output_ratio = None
-                    elif self.provider == "gemini":
-                        # 使用新的Google GenAI SDK调用，支持system instruction
-                        system_instruction = ""
-                        user_content = ""
-                        
-                        for msg in messages:
-                            if msg["role"] == "system":
-                                system_instruction += msg["content"] + "\n\n"
-                            elif msg["role"] == "user":
-                                user_content += msg["content"] + "\n\n"
-                            elif msg["role"] == "assistant":
-                                user_content += f"[Previous response: {msg['content']}]\n\n"
-                        
-                        # 构建GenerateContentConfig
-                        config_kwargs = {
-                            "thinking_config": types.ThinkingConfig(thinking_budget=0)
-                        }
-                        
-                        # 如果有system instruction，添加到config
-                        if system_instruction.strip():
-                            config_kwargs["system_instruction"] = system_instruction.strip()
-                        
-                        # 如果有structured_output要求，添加JSON schema
-                        if structured_output:
-                            config_kwargs["response_mime_type"] = "application/json"
-                            config_kwargs["response_schema"] = structured_output
-                        
-                        # 创建config对象
-                        config = types.GenerateContentConfig(**config_kwargs)
-                        
-                        # 调用Gemini API
-                        response = self.client.models.generate_content(
-                            model=self.model,
-                            contents=user_content.strip(),
-                            config=config
-                        )
-                        
-                        # 处理响应
-                        if structured_output:
-                            # 使用结构化输出
-                            parsed_response = response.parsed
-                            if hasattr(parsed_response, "reasoning") and hasattr(parsed_response, "output"):
-                                reasoning = parsed_response.reasoning
-                                output = parsed_response.output
-                                # 提取estimated_others_avg_ratio和output_ratio（如果存在）
-                                estimated_others_avg_ratio = getattr(parsed_response, "estimated_others_avg_ratio", None)
-                                output_ratio = getattr(parsed_response, "output_ratio", None)
-                                if isinstance(output, (int, float)):
-                                    response_content = str(output)
-                                else:
-                                    response_content = output
-                            else:
-                                reasoning = None
-                                estimated_others_avg_ratio = None
-                                output_ratio = None
-                                response_content = str(parsed_response)
-                        else:
-                            # 非结构化输出
-                            raw_response = response.text.strip()
-                            response_content = raw_response
-                            reasoning = None
-                            estimated_others_avg_ratio = None
-                            output_ratio = None
-                    elif self.provider == "deepseek":
-                        # DeepSeek使用OpenAI兼容API + JSON mode
-                        if structured_output:
-                            # DeepSeek需要在system prompt中说明JSON格式
-                            # 添加JSON输出格式说明到system message
-                            schema_instruction = f"\n\nPlease output your response in the following JSON format:\n{json.dumps(structured_output.model_json_schema(), indent=2)}\n\nIMPORTANT: Output ONLY valid JSON, no additional text."
-                            
-                            # 修改messages,将schema说明加入system prompt
-                            modified_messages = messages.copy()
-                            if modified_messages and modified_messages[0]["role"] == "system":
-                                modified_messages[0] = {
-                                    "role": "system",
-                                    "content": modified_messages[0]["content"] + schema_instruction
-                                }
-                            else:
-                                modified_messages.insert(0, {
-                                    "role": "system", 
-                                    "content": schema_instruction
-                                })
-                            
-                            # 使用JSON mode (简化格式)
-                            params = {
-                                "model": self.model,
-                                "messages": modified_messages,
-                                "response_format": {
-                                    "type": "json_object"  # DeepSeek使用简化的JSON mode
-                                }
-                            }
-                            
-                            response = self.client.chat.completions.create(**params)
-                            raw_json = response.choices[0].message.content.strip()
-                            
-                            # 解析JSON为Pydantic对象 (json已在文件顶部导入)
-                            parsed_data = json.loads(raw_json)
-                            parsed_response = structured_output(**parsed_data)
-                            
-                            if hasattr(parsed_response, "reasoning") and hasattr(parsed_response, "output"):
-                                reasoning = parsed_response.reasoning
-                                output = parsed_response.output
-                                estimated_others_avg_ratio = getattr(parsed_response, "estimated_others_avg_ratio", None)
-                                output_ratio = getattr(parsed_response, "output_ratio", None)
-                                if isinstance(output, (int, float)):
-                                    response_content = str(output)
-                                else:
-                                    response_content = output
-                            else:
-                                reasoning = None
-                                estimated_others_avg_ratio = None
-                                output_ratio = None
-                                response_content = str(parsed_response)
-                        else:
-                            # 非结构化输出
-                            params = {
-                                "model": self.model,
-                                "messages": messages
-                            }
-                            response = self.client.chat.completions.create(**params)
-                            raw_response = response.choices[0].message.content.strip()
-                            response_content = raw_response
-                            reasoning = None
-                            estimated_others_avg_ratio = None
-                            output_ratio = None
-                    else:
-                        raise ValueError(f"Unsupported provider: {self.provider}")
-                    # 检查是否为连接失败
-                    if isinstance(response_content, str) and response_content.startswith("LLM调用失败: Connection error"):
-                        raise RuntimeError("LLM调用失败: Connection error")
+                    result = await self._arequest_llm(messages, structured_output)
+                    usage = result_usage(result)
+                    if usage:
+                        grant.used_tokens = usage["total_tokens"]
+                finally:
+                    scheduler.release(grant)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                delay = self._retry_delay(policy, scheduler, attempt, e)
+                if delay is None:
                     break
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count >= max_retry:
-                        raise RuntimeError(f"LLM调用失败: Connection error, 已重试{max_retry}次仍未成功。最后错误: {e}")
-                    time.sleep(1)
-        except Exception as e:
-            raw_response = f"LLM调用失败: {str(e)}"
-            response_content = raw_response
-            reasoning = None
-            estimated_others_avg_ratio = None
-            output_ratio = None
+                await asyncio.sleep(delay)
+        
+        if error is None and cache_key:
+            get_response_cache().put(cache_key, self.provider, self.model, list(result[:4]))
+        return result if error is None else None, error, attempt, queue_seconds, "miss" if cache_key else None
+
+    def _cache_key(self, messages, structured_output):
+        """启用响应缓存时返回请求的缓存键，否则返回None
+        
+        cache_salt（如重复实验的序号）参与哈希，使需要独立采样的重复实验互不命中
+        """
+        if not self.game_config.get("use_cache", CACHE_CONFIG["enabled"]):
+            return None
+        return make_cache_key(self.provider, self.model, messages, structured_output,
+                              salt=self.game_config.get("cache_salt"))
+
+    def _retry_delay(self, policy, scheduler, attempt, error):
+        """按错误类型决定是否重试及等待时间；限流错误同时让调度器暂停该提供商"""
+        error_class = classify_error(error)
+        delay = policy.next_delay(attempt, error_class, error)
+        if delay is not None and error_class == RATE_LIMITED:
+            scheduler.pause(self.provider, delay)
+        if delay is not None and self.debug_prompts:
+            print(f"[Agent {self.name}] LLM调用失败（{error_class}，第{attempt}次）：{error}，{delay:.1f}秒后重试")
+        return delay
+
+    def _finish_call(self, messages, debug_label, structured_output, start_time, result, error, attempts, queue_seconds,
+                     cache_status=None, batch_job=None, group=None):
+        """记录交互；调用最终失败时记录错误后抛出 LLMCallError，避免失败被当作有效回答解析"""
+        error_class = classify_error(error) if error is not None else None
+        if error is not None:
+            result = (f"LLM调用失败: {str(error)}", None, None, None)
+        response_content = self._record_interaction(messages, debug_label, structured_output, start_time, result,
+                                                    queue_seconds=queue_seconds, retry_count=attempts - 1,
+                                                    error_class=error_class, cache_status=cache_status,
+                                                    batch_job=batch_job, group=group)
+        if error is not None:
+            raise LLMCallError(
+                f"Agent {self.name} {debug_label} LLM调用失败（{error_class}，共尝试{attempts}次）: {error}",
+                error_class=error_class,
+                attempts=attempts
+            ) from error
+        return response_content
+
+    @profiled("agent.record_interaction")
+    def _record_interaction(self, messages, debug_label, structured_output, start_time, result, queue_seconds=0.0,
+                            retry_count=0, error_class=None, cache_status=None, batch_job=None, group=None):
+        """记录一次LLM交互（含调试输出），返回response_content"""
+        response_content, reasoning, estimated_others_avg_ratio, output_ratio = result[:4]
+        usage = result_usage(result)
         
         # 记录交互结束时间
         end_time = datetime.datetime.now()
@@ -316,7 +530,12 @@ class Agent:
         interaction_record = {
             "timestamp": start_time.isoformat(),
             "debug_label": debug_label,
+            "round": self.round_number,
             "duration_seconds": (end_time - start_time).total_seconds(),
+            "queue_seconds": queue_seconds,  # 在调度器中等待限流/排队的时间（已包含在duration_seconds中）
+            "retry_count": retry_count,      # 重试次数（0 表示首次即成功或首次即放弃）
+            "error_class": error_class,      # 失败时的错误类型：transient / rate_limited / permanent
+            "cache": cache_status,           # 响应缓存：hit / miss（未启用缓存时为None）
             "model": self.model,
             "provider": self.provider,
             "input": {
@@ -329,42 +548,82 @@ class Agent:
                 "estimated_others_avg_ratio": estimated_others_avg_ratio if estimated_others_avg_ratio else None,
                 "output_ratio": output_ratio if output_ratio else None,
                 "structured_output_type": structured_output.__name__ if structured_output else None,
-                "status": "success" if not response_content.startswith("LLM调用失败") else "error"
+                "status": "error" if error_class else "success"
             }
         }
+        if usage:
+            # 提供商报告的token用量，cached_input_tokens 为命中提示缓存的输入token数
+            interaction_record["usage"] = usage
+        if batch_job:
+            # 批处理模式下该调用所属的任务
+            interaction_record["batch_job"] = batch_job
+        if group:
+            # 小组决策模式下该调用的小组信息（同一次请求中的所有玩家共享同一个 call_id）
+            interaction_record["group"] = group
+        
+        get_metrics().observe_interaction(interaction_record, self.id)
         
         # 添加到智能体的交互历史
-        self.llm_interactions.append(interaction_record)
+        if self.event_sink is not None:
+            self.event_sink("interaction", self, interaction_record)
+        if self.retain_interactions:
+            self.llm_interactions.append(interaction_record)
         # 自动写入reasoning记忆（只存字符串）
         if reasoning:
             self.reasoning.append(reasoning)
         
         # 添加调试输出：显示LLM返回结果
         if self.debug_prompts:
-            try:
-                print(f"\n{'🤖'*40}")
-                print(f"【Agent {self.name} 的 LLM 返回结果】")
-                print(f"{'🤖'*40}")
-                print(f"模型: {self.provider}/{self.model}")
-                print(f"耗时: {(end_time - start_time).total_seconds():.2f}秒")
-                if structured_output:
-                    print(f"\n📊 结构化输出:")
-                    if estimated_others_avg_ratio is not None:
-                        print(f"  • 估算他人平均投入比例: {estimated_others_avg_ratio}%")
-                    if output_ratio is not None:
-                        print(f"  • 自己投入比例: {output_ratio}%")
-                    print(f"  • 投入金额: {response_content}")
-                    if reasoning:
-                        print(f"  • 推理过程: {reasoning[:200]}..." if len(reasoning) > 200 else f"  • 推理过程: {reasoning}")
-                else:
-                    print(f"\n📝 原始输出: {response_content}")
-                print(f"{'🤖'*40}\n")
-            except Exception as debug_error:
-                print(f"调试输出错误: {debug_error}")
+            with phase("agent.debug_print"):
+                try:
+                    lines = [
+                        f"\n{'🤖'*40}",
+                        f"【Agent {self.name} 的 LLM 返回结果】",
+                        f"{'🤖'*40}",
+                        f"模型: {self.provider}/{self.model}",
+                        f"耗时: {(end_time - start_time).total_seconds():.2f}秒"
+                    ]
+                    if structured_output:
+                        lines.append(f"\n📊 结构化输出:")
+                        if estimated_others_avg_ratio is not None:
+                            lines.append(f"  • 估算他人平均投入比例: {estimated_others_avg_ratio}%")
+                        if output_ratio is not None:
+                            lines.append(f"  • 自己投入比例: {output_ratio}%")
+                        lines.append(f"  • 投入金额: {response_content}")
+                        if reasoning:
+                            lines.append(f"  • 推理过程: {reasoning[:200]}..." if len(reasoning) > 200 else f"  • 推理过程: {reasoning}")
+                    else:
+                        lines.append(f"\n📝 原始输出: {response_content}")
+                    lines.append(f"{'🤖'*40}\n")
+                    _print_block(lines)
+                except Exception as debug_error:
+                    print(f"调试输出错误: {debug_error}")
         
         return response_content
 
-    def decide_contribution(self, round_number, r, num_players, all_history=None, mode="public", avg_contrib_ratio=None):
+    def _begin_batch_call(self, call):
+        """批处理模式：打印调试信息并查响应缓存，命中时直接完成调用并返回True"""
+        call.start_time = datetime.datetime.now()
+        self._print_prompt_debug(call.messages, call.debug_label, call.structured_output)
+        call.cache_key = self._cache_key(call.messages, call.structured_output)
+        if call.cache_key:
+            cached = get_response_cache().get(call.cache_key)
+            if cached is not None:
+                call.complete(self._finish_call(call.messages, call.debug_label, call.structured_output, call.start_time,
+                                                tuple(cached), None, 1, 0.0, cache_status="hit"))
+                return True
+        return False
+
+    def _finish_batch_call(self, call, result, error, batch_job):
+        """记录批处理返回的结果并完成调用；失败时与交互式调用一样记录错误后抛出 LLMCallError"""
+        if error is None and call.cache_key:
+            get_response_cache().put(call.cache_key, self.provider, self.model, list(result[:4]))
+        answer = self._finish_call(call.messages, call.debug_label, call.structured_output, call.start_time, result, error,
+                                   1, 0.0, cache_status="miss" if call.cache_key else None, batch_job=batch_job)
+        call.complete(answer)
+
+    def decide_contribution(self, round_number, r, num_players, all_history=None, mode="public", avg_contrib_ratio=None,
+                            history_view=None):
         """决定本轮的投入金额
         
         Args:
@@ -374,15 +633,56 @@ class Agent:
             all_history: 所有玩家的历史记录
             mode: 信息模式 ("public" 或 "anonymous")
             avg_contrib_ratio: 匿名模式下上一轮的平均贡献比例
+            history_view: GameController 增量维护的 HistoryAggregates；提供时直接使用其中的汇总，
+                          不再遍历 all_history
         """
         # 锚定智能体直接返回全部当前金额（100%投入）
         if self.is_anchor:
             return self.current_total_money
+        messages, structured_output = self._build_contribution_request(round_number, r, num_players, all_history, mode,
+                                                                       history_view)
+        answer = self._call_llm(messages, debug_label="决策阶段", structured_output=structured_output)
+        return self._parse_amount(answer, self.current_total_money)
+
+    async def adecide_contribution(self, round_number, r, num_players, all_history=None, mode="public", avg_contrib_ratio=None,
+                                   history_view=None):
+        """decide_contribution 的异步版本"""
+        if self.is_anchor:
+            return self.current_total_money
+        messages, structured_output = self._build_contribution_request(round_number, r, num_players, all_history, mode,
+                                                                       history_view)
+        answer = await self._acall_llm(messages, debug_label="决策阶段", structured_output=structured_output)
+        return self._parse_amount(answer, self.current_total_money)
 
+    def prepare_contribution(self, round_number, r, num_players, all_history=None, mode="public", avg_contrib_ratio=None,
+                             history_view=None):
+        """decide_contribution 的批处理版本：返回待提交的 PreparedCall，锚定智能体直接返回投入金额"""
+        if self.is_anchor:
+            return self.current_total_money
+        messages, structured_output = self._build_contribution_request(round_number, r, num_players, all_history, mode,
+                                                                       history_view)
+        upper = self.current_total_money
+        return PreparedCall(self, messages, "决策阶段", structured_output,
+                            lambda answer: self._parse_amount(answer, upper))
+
+    @staticmethod
+    def _parse_amount(answer, upper):
+        """将LLM返回的投入金额解析为 0 到 upper 之间的整数"""
+        try:
+            value = int(answer)
+        except ValueError:
+            value = 0
+        return max(0, min(upper, value))
+
+    @profiled("agent.build_prompt")
+    def _build_contribution_request(self, round_number, r, num_players, all_history, mode, history_view=None):
+        """构建决策阶段的 (messages, structured_output)"""
+        if self.game_config.get("prompt_layout", PROMPT_CONFIG["layout"]) == "prefix":
+            return self._build_prefix_contribution_request(round_number, r, all_history, mode, history_view)
         # 构建提示信息
         # 根据指导语类型确定轮数描述
-        instruction_type = GAME_CONFIG.get("instruction_type", "certain")
-        total_rounds = GAME_CONFIG.get("rounds", 10)
+        instruction_type = self.game_config.get("instruction_type", "certain")
+        total_rounds = self.game_config.get("rounds", 10)
         
         if instruction_type == "certain":
             round_info = f"当前第 {round_number} 轮，总共有 {total_rounds} 轮"
@@ -403,21 +703,18 @@ class Agent:
             
             # 添加自己的历史投入
             base_prompt += f"\n你的历史投入："
-            for r in range(1, round_number):
-                if r <= len(self.history):
-                    history_entry = self.history[r-1]
-                    my_contrib = history_entry['contribution']
-                    my_payoff = history_entry['payoff']
-                    my_total_before = history_entry.get('total_money_before_round', my_contrib + my_payoff)
-                    my_ratio = (my_contrib / my_total_before * 100) if my_total_before > 0 else 0
-                    base_prompt += f"\n  第{r}轮: 投入{my_contrib}/{my_total_before} ({my_ratio:.1f}%), 收益{my_payoff:.1f}"
+            base_prompt += self._format_own_history(round_number)
             
             # 匿名模式下，加入上一轮平均贡献比例
             # if mode == "anonymous" and avg_contrib_ratio is not None:
             #     base_prompt += f"\n上一轮所有玩家平均贡献比例为: {avg_contrib_ratio:.1%}"
             
             # 根据模式添加其他玩家历史信息
-            if all_history and mode == "public":
+            if history_view is not None:
+                # 使用控制器增量维护的汇总
+                if mode in ["public", "anonymous"]:
+                    base_prompt += history_view.others_block(self.id, mode)
+            elif all_history and mode == "public":
                 # 公开模式：显示所有玩家所有轮次的贡献
                 base_prompt += f"\n\n其他玩家历史投入："
                 for player_id, player_data in all_history.items():
@@ -452,7 +749,7 @@ class Agent:
                                 if init_amt is None:
                                     init_amt = player_history[r-1].get('total_money_before_round', None)
                                 if init_amt is None and r == 1:
-                                    init_amt = GAME_CONFIG.get('endowment', 10)
+                                    init_amt = self.game_config.get('endowment', 10)
                                 round_total += contrib
                                 if init_amt is not None and init_amt > 0:
                                     round_init_total += init_amt
@@ -476,44 +773,80 @@ class Agent:
             {"role": "user", "content": base_prompt}
         ]
         
-        # 创建用于结构化输出的动态模型
-        class DynamicContributionDecision(BaseModel):
-            estimated_others_avg_ratio: float = Field(
-                ...,
-                ge=0,
-                le=100,
-                description=f"估计其他玩家本轮的平均投入比例（0-100之间的百分比数值，例如50表示50%）"
-            )
-            output: int = Field(
-                ...,
-                ge=0,
-                le=self.current_total_money,
-                description=f"本轮投入金额，必须是 0–{self.current_total_money} 之间的整数"
-            )
-            output_ratio: float = Field(
-                ...,
-                ge=0,
-                le=100,
-                description=f"本轮投入比例（0-100之间的百分比数值，应该等于 output/{self.current_total_money}*100）"
-            )
-            reasoning: str = Field(
-                ...,
-                description="完整决策理由：先说明你如何认知其他玩家（为什么估计他们会这样投入），再解释你自己的决策逻辑（考虑边际收益、风险以及博弈策略）"
-            )
+        # 结构化输出模型按投入上限缓存，不在每次调用时重新定义
+        DynamicContributionDecision = contribution_decision_model(self.current_total_money)
         
-        # 调用LLM，使用结构化输出
-        if self.provider in ["openai", "gemini", "deepseek"]:
-            # OpenAI, Gemini和DeepSeek都支持结构化输出
-            answer = self._call_llm(messages, debug_label="决策阶段", structured_output=DynamicContributionDecision)
-        else:
-            # 其他模型使用非结构化输出
-            answer = self._call_llm(messages, debug_label="决策阶段")
-            
-        try:
-            value = int(answer)
-        except ValueError:
-            value = 0
-        return max(0, min(self.current_total_money, value))
+        # OpenAI, Gemini和DeepSeek（以及假提供商）都支持结构化输出，其他模型使用非结构化输出
+        if self.provider in ["openai", "gemini", "deepseek", "fake"]:
+            return messages, DynamicContributionDecision
+        return messages, None
+
+    def _build_prefix_contribution_request(self, round_number, r, all_history, mode, history_view=None):
+        """prefix 布局的决策请求：静态规则 → 共享历史 → 玩家特定信息
+        
+        system 只包含同一局游戏中所有玩家、所有轮次都相同的规则和任务说明；user 先放本轮所有玩家共享的历史
+        （公开模式），最后才是性格设定、玩家名、轮次、金额和自己的历史。结构化输出使用不含玩家特定上限的schema，
+        使各玩家的请求从schema开始就有相同的前缀。
+        """
+        if history_view is None and all_history:
+            histories = {player_id: data.get('history', data) if isinstance(data, dict) else data
+                         for player_id, data in all_history.items()}
+            history_view = HistoryAggregates.from_histories(list(histories), self.game_config.get("endowment", 10),
+                                                            histories)
+        if self.game_config.get("instruction_type", "certain") == "certain":
+            rounds_rule = f"游戏总共有 {self.game_config.get('rounds', 10)} 轮"
+        else:  # uncertain
+            rounds_rule = "游戏将持续若干轮，可能在任意一轮结束"
+        
+        system_prompt = f"""你正在参与一个多人公共品博弈。
+
+游戏规则：
+- {rounds_rule}
+- 每轮每名玩家可将自己当前的代币（包括初始禀赋和之前的收益）投入公共池，投入范围：0 到自己的当前金额
+- 本轮公共池由所有玩家的投入累积形成
+- 公共池总额 × {r} 后，将平均分配给所有玩家
+
+每轮请完成以下任务：
+1. 估计其他玩家本轮的平均投入比例（0-100%之间，基于历史表现和当前情况）
+2. 决定你本轮的具体投入金额（必须在0到你当前金额之间的整数）
+3. 说明你的完整决策理由（包括：你如何认知其他玩家的行为、你考虑的边际收益和风险、以及你的博弈策略）
+
+你的性格设定和本轮的具体情况在用户消息的最后给出。"""
+        
+        user_prompt = ""
+        if round_number > 1 and mode == "public" and history_view is not None:
+            # 公开模式下本轮所有玩家看到的历史相同
+            user_prompt += history_view.public_block().lstrip("\n") + "\n\n"
+        user_prompt += f"""你的性格设定：{self.get_current_system_prompt()}
+
+你是玩家"{self.name}"（历史记录中的玩家{self.id}）。
+当前第 {round_number} 轮
+你有 {self.current_total_money} 枚代币可投入公共池，你的投入范围：0 到 {self.current_total_money}"""
+        if round_number > 1:
+            user_prompt += f"\n\n你的历史投入：{self._format_own_history(round_number)}"
+            if mode == "anonymous" and history_view is not None:
+                user_prompt += history_view.others_block(self.id, mode)
+        
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        if self.provider in ["openai", "gemini", "deepseek", "fake"]:
+            return messages, contribution_decision_model(None)
+        return messages, None
+
+    def _format_own_history(self, round_number):
+        """第1轮到 round_number-1 轮自己的投入、投入范围和收益（每轮一行）"""
+        lines = ""
+        for r in range(1, round_number):
+            if r <= len(self.history):
+                history_entry = self.history[r-1]
+                my_contrib = history_entry['contribution']
+                my_payoff = history_entry['payoff']
+                my_total_before = history_entry.get('total_money_before_round', my_contrib + my_payoff)
+                my_ratio = (my_contrib / my_total_before * 100) if my_total_before > 0 else 0
+                lines += f"\n  第{r}轮: 投入{my_contrib}/{my_total_before} ({my_ratio:.1f}%), 收益{my_payoff:.1f}"
+        return lines
 
     def get_current_system_prompt(self):
         """获取当前的系统提示（可能已被信念记忆更新）"""
@@ -550,6 +883,7 @@ class Agent:
         # 新的记忆系统不再使用此方法，但保留以确保向后兼容
         pass
 
+    @profiled("agent.record_round_data")
     def record_round_data(self, round_num, contribution, group_total, payoff, total_money_before_round=None):
         """
         记录每轮的基本数据
@@ -607,6 +941,30 @@ class Agent:
         """每轮更新信念记忆，输入为最近reasoning，输出为更宏观的自我反思"""
         if self.is_anchor:
             return  # anchor不更新信念
+        messages, user_prompt = self._build_belief_request()
+        # 调用 LLM，直接获取文本输出（不需要reasoning）
+        updated_personality = self._call_llm(messages, debug_label="信念更新")
+        self._apply_belief_update(round_number, updated_personality, user_prompt)
+
+    async def _aupdate_belief_memory(self, round_number, reveal_mode, all_history):
+        """_update_belief_memory 的异步版本"""
+        if self.is_anchor:
+            return
+        messages, user_prompt = self._build_belief_request()
+        updated_personality = await self._acall_llm(messages, debug_label="信念更新")
+        self._apply_belief_update(round_number, updated_personality, user_prompt)
+
+    def prepare_belief_update(self, round_number, reveal_mode, all_history):
+        """_update_belief_memory 的批处理版本：返回待提交的 PreparedCall（anchor不更新信念，返回None）"""
+        if self.is_anchor:
+            return None
+        messages, user_prompt = self._build_belief_request()
+        return PreparedCall(self, messages, "信念更新", None,
+                            lambda answer: self._apply_belief_update(round_number, answer, user_prompt))
+
+    @profiled("agent.build_prompt")
+    def _build_belief_request(self):
+        """构建信念更新的 (messages, user_prompt)"""
         # 收集所有 reasoning，全部为字符串
         recent_reasonings = "\n".join(self.reasoning[-3:])  # 取最近3轮，也可调整为全部
         
@@ -627,15 +985,19 @@ class Agent:
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ]
-        # 调用 LLM，直接获取文本输出（不需要reasoning）
-        updated_personality = self._call_llm(messages, debug_label="信念更新")
-        
+        return messages, user_prompt
+
+    def _apply_belief_update(self, round_number, updated_personality, user_prompt):
+        """记录信念记忆并据此更新system_prompt"""
         # 记录信念记忆
-        self.belief_memory.append({
+        belief = {
             "round": round_number,
             "updated_personality": updated_personality,
             "prompt": user_prompt
-        })
+        }
+        self.belief_memory.append(belief)
+        if self.event_sink is not None:
+            self.event_sink("belief", self, belief)
         # 信念更新后自动更新system_prompt，自动将“我”替换为“你”
         self.system_prompt = updated_personality.replace("我", "你")
 
@@ -652,7 +1014,29 @@ class Agent:
         """
         if self.is_anchor:
             return initial_endowment
+        messages, structured_output = self._build_final_decision_request(initial_endowment, r, num_players)
+        answer = self._call_llm(messages, debug_label="最终一次性决策", structured_output=structured_output)
+        return self._parse_amount(answer, initial_endowment)
+
+    async def amake_final_decision(self, initial_endowment, r, num_players):
+        """make_final_decision 的异步版本"""
+        if self.is_anchor:
+            return initial_endowment
+        messages, structured_output = self._build_final_decision_request(initial_endowment, r, num_players)
+        answer = await self._acall_llm(messages, debug_label="最终一次性决策", structured_output=structured_output)
+        return self._parse_amount(answer, initial_endowment)
 
+    def prepare_final_decision(self, initial_endowment, r, num_players):
+        """make_final_decision 的批处理版本：返回待提交的 PreparedCall，锚定智能体直接返回投入金额"""
+        if self.is_anchor:
+            return initial_endowment
+        messages, structured_output = self._build_final_decision_request(initial_endowment, r, num_players)
+        return PreparedCall(self, messages, "最终一次性决策", structured_output,
+                            lambda answer: self._parse_amount(answer, initial_endowment))
+
+    @profiled("agent.build_prompt")
+    def _build_final_decision_request(self, initial_endowment, r, num_players):
+        """构建最终一次性决策的 (messages, structured_output)"""
         prompt = f"""现在你面临一个全新的一次性公共品博弈：
 
         游戏规则：
@@ -668,35 +1052,20 @@ class Agent:
             {"role": "user", "content": prompt}
         ]
         
-        # 创建用于结构化输出的动态模型
-        class FinalDecision(BaseModel):
-            reasoning: str = Field(
-                ...,
-                description="思考过程：解释在最终一次性决策中考虑的因素"
-            )
-            output: int = Field(
-                ...,
-                ge=0,
-                le=initial_endowment,
-                description=f"投入金额，必须是0–{initial_endowment}之间的整数"
-            )
+        # 结构化输出模型按投入上限缓存，不在每次调用时重新定义
+        FinalDecision = final_decision_model(initial_endowment)
         
-        # 调用LLM，使用结构化输出
-        if self.provider in ["openai", "gemini", "deepseek"]:
-            # OpenAI, Gemini和DeepSeek都支持结构化输出
-            answer = self._call_llm(messages, debug_label="最终一次性决策", structured_output=FinalDecision)
-        else:
-            # 其他模型使用非结构化输出
-            answer = self._call_llm(messages, debug_label="最终一次性决策")
-            
-        try:
-            value = int(answer)
-        except ValueError:
-            value = 0
-        return max(0, min(initial_endowment, value))
+        # OpenAI, Gemini和DeepSeek（以及假提供商）都支持结构化输出，其他模型使用非结构化输出
+        if self.provider in ["openai", "gemini", "deepseek", "fake"]:
+            return messages, FinalDecision
+        return messages, None
 
-    def _format_recent_rounds_info(self, round_number, reveal_mode, all_history):
-        """格式化最近2轮的各玩家投入信息"""
+    @profiled("agent.build_prompt")
+    def _format_recent_rounds_info(self, round_number, reveal_mode, all_history, history_view=None):
+        """格式化最近2轮的各玩家投入信息
+        
+        提供 history_view（HistoryAggregates）时直接使用其中的每轮数据和他人平均值
+        """
         info_text = ""
         start_round = max(1, round_number - 1)  # 最近2轮
         
@@ -713,7 +1082,26 @@ class Agent:
                 info_text += f"\n  你: {my_contrib}/{my_total_before}({my_ratio:.1f}%)"
             
             # 根据模式添加其他玩家信息
-            if all_history and reveal_mode == "public":
+            if history_view is not None:
+                if r > history_view.rounds:
+                    continue
+                if reveal_mode == "public":
+                    for player_id, contrib, total_before in history_view.round_entries(r, exclude=self.id):
+                        if total_before is not None:
+                            ratio = (contrib / total_before * 100) if total_before > 0 else 0
+                            info_text += f"\n  玩家{player_id}: {contrib}/{total_before}(投入比例：{ratio:.1f}%)"
+                        else:
+                            info_text += f"\n  玩家{player_id}: {contrib}"
+                else:
+                    average = history_view.others_average(self.id, r)
+                    if average is not None:
+                        avg_contrib, avg_total = average
+                        if avg_total is not None:
+                            avg_ratio = (avg_contrib / avg_total * 100) if avg_total > 0 else 0
+                            info_text += f"\n  其他玩家平均: {avg_contrib:.1f}/{avg_total:.1f}({avg_ratio:.1f}%)"
+                        else:
+                            info_text += f"\n  其他玩家平均: {avg_contrib:.1f}"
+            elif all_history and reveal_mode == "public":
                 for player_id, player_data in all_history.items():
                     if player_id != self.id:
                         # 兼容新旧数据格式
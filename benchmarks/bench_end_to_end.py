@@ -0,0 +1,272 @@
+"""
+端到端基准测试（确定性假提供商）
+
+对 num_players × rounds × reveal_mode × instruction_type 网格中的每个组合，在独立的子进程中用
+provider="fake"（见 llm_fake.py，可配置延迟）运行 GameController.setup_game() 和 play()，
+记录 rounds/sec、calls/sec（LLM请求数）、峰值RSS和输出文件的总字节数。
+每个组合在单独的进程中运行，峰值RSS互不影响；输出写入临时目录，结束后删除。
+
+结果以JSON输出（--output），可与之前某次提交的结果比较（--compare），
+rounds/sec 下降或峰值RSS、输出字节数增长超过 --threshold 时以非零状态退出。
+
+用法：
+python benchmarks/bench_end_to_end.py [--preset quick|full] [--players 10 100] [--rounds 10 50]
+                                      [--latency 0] [--repeat 1] [--output results.json] [--compare baseline.json]
+完整网格（--preset full，最多1000名玩家、200轮）耗时和内存都很大，可用 --max-player-rounds 跳过过大的组合。
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PRESETS = {
+    "quick": {"players": [10, 100], "rounds": [10, 50]},
+    "full": {"players": [10, 100, 1000], "rounds": [10, 50, 200]}
+}
+REVEAL_MODES = ["public", "anonymous"]
+INSTRUCTION_TYPES = ["certain", "uncertain"]
+# 用于匹配两次结果中同一组合的字段
+CELL_KEYS = ["num_players", "rounds", "reveal_mode", "instruction_type"]
+
+
+def _dir_bytes(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(directory, name))
+    return total
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以KB为单位，macOS 以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_cell(cell, options):
+    """在当前进程中运行一局游戏并返回测量结果（由子进程调用）"""
+    sys.path.insert(0, ROOT)
+    import random
+    from config import GAME_CONFIG
+    from game_controller import GameController
+    from llm_metrics import get_metrics
+
+    output_dir = tempfile.mkdtemp(prefix="pgg_bench_")
+    game_config = dict(GAME_CONFIG)
+    game_config.update(
+        provider="fake",
+        model="fake",
+        num_players=cell["num_players"],
+        rounds=cell["rounds"],
+        reveal_mode=cell["reveal_mode"],
+        instruction_type=cell["instruction_type"],
+        output_dir=output_dir,
+        fake_latency=options["latency"],
+        fake_jitter=options["jitter"],
+        async_mode=options["async_mode"],
+        group_size=options["group_size"],
+        stream_history=options["stream"]
+    )
+    if options["max_workers"] is not None:
+        game_config["max_workers"] = options["max_workers"]
+    random.seed(0)
+    stdout = sys.stdout
+    try:
+        with open(os.devnull, "w", encoding="utf-8") as devnull:
+            sys.stdout = devnull
+            start = time.perf_counter()
+            game = GameController(game_config)
+            game.setup_game()
+            game.play()
+            elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+    calls = sum(get_metrics().calls.values())
+    output_bytes = _dir_bytes(output_dir)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return dict(
+        cell,
+        seconds=elapsed,
+        rounds_per_sec=cell["rounds"] / elapsed,
+        calls=calls,
+        calls_per_sec=calls / elapsed,
+        peak_rss_mb=_peak_rss_mb(),
+        output_bytes=output_bytes
+    )
+
+
+def measure(cell, options, repeat, timeout):
+    """在子进程中运行 repeat 次，取耗时最短的一次（峰值RSS和输出字节数取最大值）"""
+    runs = []
+    for _ in range(repeat):
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            result_path = f.name
+        try:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--cell", json.dumps(cell),
+                 "--options", json.dumps(options), "--result-file", result_path],
+                cwd=ROOT, check=True, timeout=timeout
+            )
+            with open(result_path, "r", encoding="utf-8") as f:
+                runs.append(json.load(f))
+        except subprocess.TimeoutExpired:
+            return dict(cell, error=f"超时（{timeout}s）")
+        except subprocess.CalledProcessError as e:
+            return dict(cell, error=f"子进程退出码 {e.returncode}")
+        finally:
+            os.remove(result_path)
+    best = min(runs, key=lambda run: run["seconds"])
+    best["peak_rss_mb"] = max((run["peak_rss_mb"] or 0) for run in runs) or None
+    best["output_bytes"] = max(run["output_bytes"] for run in runs)
+    return best
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'玩家':>6} {'轮数':>5} {'模式':<10} {'指导语':<10} {'耗时(s)':>9} {'rounds/s':>9} {'calls/s':>9} "
+          f"{'峰值RSS(MB)':>12} {'输出(KB)':>10}")
+    for result in results:
+        prefix = (f"{result['num_players']:>6} {result['rounds']:>5} {result['reveal_mode']:<10} "
+                  f"{result['instruction_type']:<10}")
+        if "error" in result:
+            print(f"{prefix} {result['error']}")
+            continue
+        rss = f"{result['peak_rss_mb']:.1f}" if result["peak_rss_mb"] is not None else "-"
+        print(f"{prefix} {result['seconds']:>9.2f} {result['rounds_per_sec']:>9.2f} {result['calls_per_sec']:>9.1f} "
+              f"{rss:>12} {result['output_bytes'] / 1024:>10.1f}")
+
+
+def compare(results, baseline_path, threshold):
+    """与基线结果比较，返回退步的组合数"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("options") != results["options"]:
+        print(f"注意：基线的运行选项与本次不同：{baseline.get('options')}")
+    baseline_cells = {tuple(item[key] for key in CELL_KEYS): item for item in baseline["results"] if "error" not in item}
+    print(f"\n与基线 {baseline_path}（提交 {baseline.get('commit')}）比较，阈值 {threshold:.0%}：")
+    regressions = 0
+    for result in results["results"]:
+        key = tuple(result[k] for k in CELL_KEYS)
+        base = baseline_cells.get(key)
+        if base is None or "error" in result:
+            continue
+        problems = []
+        speed = result["rounds_per_sec"] / base["rounds_per_sec"]
+        if speed < 1 - threshold:
+            problems.append(f"rounds/sec ×{speed:.2f}")
+        if result["peak_rss_mb"] and base["peak_rss_mb"]:
+            rss = result["peak_rss_mb"] / base["peak_rss_mb"]
+            if rss > 1 + threshold:
+                problems.append(f"峰值RSS ×{rss:.2f}")
+        if base["output_bytes"]:
+            size = result["output_bytes"] / base["output_bytes"]
+            if size > 1 + threshold:
+                problems.append(f"输出字节 ×{size:.2f}")
+        status = "退步：" + "，".join(problems) if problems else "正常"
+        regressions += bool(problems)
+        print(f"  {key}: rounds/sec {base['rounds_per_sec']:.2f} → {result['rounds_per_sec']:.2f}（×{speed:.2f}）{status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='确定性假提供商上的端到端基准测试')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick', help='网格预设')
+    parser.add_argument('--players', type=int, nargs='+', default=None, help='num_players 取值（覆盖预设）')
+    parser.add_argument('--rounds', type=int, nargs='+', default=None, help='rounds 取值（覆盖预设）')
+    parser.add_argument('--reveal-modes', nargs='+', default=REVEAL_MODES, choices=REVEAL_MODES)
+    parser.add_argument('--instruction-types', nargs='+', default=INSTRUCTION_TYPES, choices=INSTRUCTION_TYPES)
+    parser.add_argument('--max-player-rounds', type=int, default=None,
+                        help='跳过 玩家数×轮数 超过该值的组合')
+    parser.add_argument('--latency', type=float, default=0.0, help='假提供商每次请求的固定延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='假提供商的延迟抖动上限（秒）')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='使用异步模式')
+    parser.add_argument('--max-workers', type=int, default=None, help='每个阶段并发LLM调用数上限')
+    parser.add_argument('--group-size', type=int, default=1, help='小组决策的组大小')
+    parser.add_argument('--stream', action='store_true', help='使用流式记录')
+    parser.add_argument('--repeat', type=int, default=1, help='每个组合运行次数（取最快的一次）')
+    parser.add_argument('--timeout', type=float, default=None, help='单个组合的超时时间（秒）')
+    parser.add_argument('--output', default=None, help='结果JSON的保存路径')
+    parser.add_argument('--compare', default=None, metavar='BASELINE', help='与之前保存的结果JSON比较')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定退步的相对变化阈值')
+    # 子进程内部使用
+    parser.add_argument('--cell', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--options', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cell:
+        result = run_cell(json.loads(args.cell), json.loads(args.options))
+        with open(args.result_file, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return 0
+
+    options = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "async_mode": args.async_mode,
+        "max_workers": args.max_workers,
+        "group_size": args.group_size,
+        "stream": args.stream
+    }
+    players = args.players or PRESETS[args.preset]["players"]
+    rounds_list = args.rounds or PRESETS[args.preset]["rounds"]
+    cells = []
+    for num_players, rounds, reveal_mode, instruction_type in itertools.product(
+            players, rounds_list, args.reveal_modes, args.instruction_types):
+        if args.max_player_rounds and num_players * rounds > args.max_player_rounds:
+            print(f"跳过 {num_players} 名玩家 × {rounds} 轮（超过 --max-player-rounds）")
+            continue
+        cells.append({"num_players": num_players, "rounds": rounds, "reveal_mode": reveal_mode,
+                      "instruction_type": instruction_type})
+
+    results = []
+    for index, cell in enumerate(cells, start=1):
+        print(f"[{index}/{len(cells)}] {cell}", flush=True)
+        results.append(measure(cell, options, args.repeat, args.timeout))
+    print_results(results)
+
+    report = {
+        "commit": _commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": options,
+        "results": results
+    }
+    if args.output:
+        directory = os.path.dirname(os.path.abspath(args.output))
+        os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到：{args.output}")
+    if args.compare:
+        regressions = compare(report, args.compare, args.threshold)
+        if regressions:
+            print(f"\n{regressions} 个组合退步")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+启动导入耗时报告
+
+在独立的子进程中运行 python -X importtime -c "import <模块>"，汇总每个入口模块的总导入耗时、
+耗时最多的模块，以及是否加载了提供商SDK（openai / zhipuai / google.genai）。
+run_experiments --workers 的每个 spawn 子进程都要重新导入一次，启动耗时会随并行进程数放大。
+
+用法：python benchmarks/bench_import_time.py [--modules main agents] [--top 10] [--repeat 3] [--max-ms 300]
+指定 --max-ms 时，任一模块的导入耗时超过预算则以非零状态退出。
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ["main", "agents", "game_controller", "run_experiments"]
+SDK_MODULES = ["openai", "zhipuai", "google.genai"]
+
+
+def measure(module):
+    """导入一次模块，返回 [(模块名, 自身耗时us, 累计耗时us), ...]（按导入顺序）"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败：\n{result.stderr[-2000:]}")
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def report(module, repeat, top):
+    """多次测量取总耗时最小的一次（排除磁盘缓存等干扰）并打印报告，返回总耗时（毫秒）"""
+    runs = [measure(module) for _ in range(repeat)]
+    entries = min(runs, key=lambda run: sum(self_us for _, self_us, _ in run))
+    total_ms = sum(self_us for _, self_us, _ in entries) / 1000
+    loaded = {name for name, _, _ in entries}
+    sdks = [sdk for sdk in SDK_MODULES if sdk in loaded]
+
+    print(f"\n{'='*60}")
+    print(f"import {module}: {total_ms:.1f} ms，共 {len(entries)} 个模块")
+    print(f"已加载的提供商SDK: {', '.join(sdks) if sdks else '无'}")
+    print(f"累计耗时最多的模块:")
+    heaviest = sorted(entries, key=lambda entry: entry[2], reverse=True)[:top]
+    for name, self_us, cumulative_us in heaviest:
+        print(f"  {cumulative_us / 1000:8.1f} ms（自身 {self_us / 1000:6.1f} ms）  {name}")
+    return total_ms
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='入口模块的导入耗时报告')
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help='要测量的模块')
+    parser.add_argument('--top', type=int, default=10, help='列出累计耗时最多的模块数')
+    parser.add_argument('--repeat', type=int, default=3, help='每个模块测量次数（取最快的一次）')
+    parser.add_argument('--max-ms', type=float, default=None, help='导入耗时预算（毫秒），超出时以非零状态退出')
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        total_ms = report(module, args.repeat, args.top)
+        if args.max_ms is not None and total_ms > args.max_ms:
+            over_budget.append((module, total_ms))
+
+    if over_budget:
+        print(f"\n超出导入耗时预算 {args.max_ms:.0f} ms：")
+        for module, total_ms in over_budget:
+            print(f"  {module}: {total_ms:.1f} ms")
+        sys.exit(1)
@@ -0,0 +1,80 @@
+"""
+结构化输出模型的单次调用开销对比
+
+legacy：每次调用重新定义 DynamicContributionDecision 并生成/序列化JSON schema（旧实现）
+cached：通过 llm_schemas 中按投入上限缓存的模型与schema文本
+
+用法：python benchmarks/bench_schemas.py [--calls 2000] [--distinct 50]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pydantic import BaseModel, Field
+from llm_schemas import contribution_decision_model, model_schema_text
+
+
+def legacy_call(max_amount):
+    """旧实现：每次调用定义新类并序列化schema"""
+    class DynamicContributionDecision(BaseModel):
+        estimated_others_avg_ratio: float = Field(
+            ...,
+            ge=0,
+            le=100,
+            description=f"估计其他玩家本轮的平均投入比例（0-100之间的百分比数值，例如50表示50%）"
+        )
+        output: int = Field(
+            ...,
+            ge=0,
+            le=max_amount,
+            description=f"本轮投入金额，必须是 0–{max_amount} 之间的整数"
+        )
+        output_ratio: float = Field(
+            ...,
+            ge=0,
+            le=100,
+            description=f"本轮投入比例（0-100之间的百分比数值，应该等于 output/{max_amount}*100）"
+        )
+        reasoning: str = Field(
+            ...,
+            description="完整决策理由：先说明你如何认知其他玩家（为什么估计他们会这样投入），再解释你自己的决策逻辑（考虑边际收益、风险以及博弈策略）"
+        )
+    return json.dumps(DynamicContributionDecision.model_json_schema(), indent=2)
+
+
+def cached_call(max_amount):
+    """新实现：缓存的模型与schema文本"""
+    return model_schema_text(contribution_decision_model(max_amount))
+
+
+def bench(func, calls, distinct):
+    start = time.perf_counter()
+    for i in range(calls):
+        func(10 + i % distinct)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="结构化输出模型开销基准")
+    parser.add_argument("--calls", type=int, default=2000, help="调用次数")
+    parser.add_argument("--distinct", type=int, default=50, help="不同投入上限的个数")
+    args = parser.parse_args()
+
+    # 两种实现生成的schema文本必须一致
+    assert legacy_call(123) == cached_call(123)
+
+    legacy_us = bench(legacy_call, args.calls, args.distinct)
+    cached_us = bench(cached_call, args.calls, args.distinct)
+    print(f"调用次数: {args.calls}，不同投入上限: {args.distinct}")
+    print(f"legacy: {legacy_us:.1f} µs/次")
+    print(f"cached: {cached_us:.1f} µs/次（含首次构建）")
+    print(f"加速: {legacy_us / cached_us:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
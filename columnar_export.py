@@ -0,0 +1,224 @@
+"""
+按列存储的逐轮数据导出
+
+把一局游戏的数值结果展开为每个 (游戏, 轮次, 玩家) 一行、游戏配置作为列的表，写成列式文件：
+- 安装了 pyarrow 时写 Parquet
+- 否则安装了 numpy 时写 NPZ（每列一个数组）
+- 两者都没有时跳过导出
+
+除了每局一个文件外，还可以追加到整个实验的数据集目录（每局一个分片），
+跨实验分析用 load_dataset() 只读取需要的列。
+
+用法（为已有的游戏记录补充导出）：python columnar_export.py game_history/*completed*.json*
+"""
+
+import argparse
+import glob
+import os
+from config import EXPORT_CONFIG
+
+# 配置列（取自 game_config）
+CONFIG_COLUMNS = [
+    "model", "provider", "personality_type", "endowment", "r", "rounds", "num_players",
+    "reveal_mode", "anchor_ratio", "instruction_type"
+]
+# 每行的数值列及其类型
+VALUE_COLUMNS = {
+    "round": "int",
+    "is_anchor": "bool",
+    "contribution": "float",
+    "payoff": "float",
+    "total_money_before_round": "float",
+    "group_total": "float",
+    "estimated_others_avg_ratio": "float",
+    "output_ratio": "float"
+}
+COLUMNS = ["game", "game_id", "game_status"] + CONFIG_COLUMNS + ["agent_id"] + list(VALUE_COLUMNS)
+_STRING_COLUMNS = {"game", "game_id", "game_status", "model", "provider", "personality_type",
+                   "reveal_mode", "instruction_type", "agent_id"}
+_INT_CONFIG_COLUMNS = {"endowment", "rounds", "num_players"}
+
+
+def _column_type(name):
+    """列的存储类型：string / int / bool / float"""
+    if name in _STRING_COLUMNS:
+        return "string"
+    if name in _INT_CONFIG_COLUMNS:
+        return "int"
+    return VALUE_COLUMNS.get(name, "float")
+
+
+def _backend(preferred=None):
+    """选择可用的写出格式：parquet / npz / None"""
+    preferred = preferred or EXPORT_CONFIG["format"]
+    candidates = ["parquet", "npz"] if preferred == "auto" else [preferred]
+    for name in candidates:
+        try:
+            if name == "parquet":
+                import pyarrow  # noqa: F401
+            else:
+                import numpy  # noqa: F401
+            return name
+        except ImportError:
+            continue
+    return None
+
+
+def game_rows(game_record, game_name):
+    """把一局游戏展开为行列表，每行对应一个 (轮次, 玩家)
+
+    Args:
+        game_record: 完整的游戏记录（load_game_history 的返回值）
+        game_name: 游戏标识（通常为输出文件名去掉扩展名）
+    """
+    game_config = game_record.get("game_config", {})
+    config_values = {column: game_config.get(column) for column in CONFIG_COLUMNS}
+    if config_values["anchor_ratio"] is None:
+        config_values["anchor_ratio"] = game_record.get("anchor_ratio")
+    anchors = {agent["id"]: agent.get("is_anchor", False) for agent in game_record.get("agents", [])}
+    # 按交互记录中的轮次匹配决策（同一轮的失败重试、批处理回退或小组决策回退会产生多条"决策阶段"交互，
+    # 取该轮最后一条成功的）；没有轮次字段的旧记录按第k次成功的"决策阶段"交互对应第k轮
+    decisions = {}
+    for agent_id, data in game_record.get("llm_interactions", {}).get("interactions_by_agent", {}).items():
+        outputs = [
+            (interaction.get("round"), interaction.get("output", {})) for interaction in data.get("interactions", [])
+            if interaction.get("debug_label") == "决策阶段" and interaction.get("output", {}).get("status") != "error"
+        ]
+        if all(round_number is not None for round_number, _ in outputs):
+            decisions[agent_id] = dict(outputs)
+        else:
+            decisions[agent_id] = {index: output for index, (_, output) in enumerate(outputs, start=1)}
+    rows = []
+    for round_record in game_record.get("rounds", []):
+        round_number = round_record["round"]
+        for entry in round_record["agents"]:
+            agent_id = entry["id"]
+            output = decisions.get(agent_id, {}).get(round_number, {})
+            row = {
+                "game": game_name,
+                "game_id": game_config.get("game_id"),
+                "game_status": game_record.get("game_status"),
+                **config_values,
+                "agent_id": agent_id,
+                "round": round_number,
+                "is_anchor": anchors.get(agent_id, False),
+                "contribution": entry.get("contribution"),
+                "payoff": entry.get("payoff"),
+                "total_money_before_round": entry.get("total_money_before_round"),
+                "group_total": entry.get("group_total"),
+                "estimated_others_avg_ratio": output.get("estimated_others_avg_ratio"),
+                "output_ratio": output.get("output_ratio")
+            }
+            rows.append(row)
+    return rows
+
+
+def _columns(rows):
+    """行列表转为 {列名: 值列表}"""
+    return {column: [row.get(column) for row in rows] for column in COLUMNS}
+
+
+def _write_parquet(columns, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {"string": pa.string(), "int": pa.int64(), "bool": pa.bool_(), "float": pa.float64()}
+    schema = pa.schema([(name, types[_column_type(name)]) for name in COLUMNS])
+    table = pa.table(columns, schema=schema)
+    pq.write_table(table, path, compression="zstd")
+
+
+def _write_npz(columns, path):
+    import numpy as np
+    arrays = {}
+    for name, values in columns.items():
+        column_type = _column_type(name)
+        if column_type == "string":
+            arrays[name] = np.array(["" if v is None else str(v) for v in values], dtype=str)
+        elif column_type == "bool":
+            arrays[name] = np.array([bool(v) for v in values], dtype=bool)
+        elif column_type == "int" and None not in values:
+            arrays[name] = np.array(values, dtype=np.int64)
+        else:
+            # 缺失值用 NaN 表示
+            arrays[name] = np.array([np.nan if v is None else v for v in values], dtype=float)
+    np.savez_compressed(path, **arrays)
+
+
+def export_game(game_record, source_path, output_dir=None, dataset_dir=None, backend=None):
+    """导出一局游戏的列式文件
+
+    Args:
+        game_record: 完整的游戏记录
+        source_path: 游戏记录文件路径（决定游戏标识和默认的输出位置）
+        output_dir: 单局文件的输出目录（None 表示与游戏记录相同目录，False 表示不写单局文件）
+        dataset_dir: 整个实验的数据集目录（None 表示不追加）
+        backend: parquet / npz / auto（默认使用 EXPORT_CONFIG["format"]）
+
+    Returns:
+        list: 写出的文件路径；没有可用的写出库时返回空列表
+    """
+    backend = _backend(backend)
+    if backend is None:
+        print("[columnar_export.py] 未安装 pyarrow 或 numpy，跳过列式导出")
+        return []
+    from history_format import strip_extension
+    game_name = os.path.basename(strip_extension(source_path))
+    columns = _columns(game_rows(game_record, game_name))
+    writer = _write_parquet if backend == "parquet" else _write_npz
+    ext = ".parquet" if backend == "parquet" else ".npz"
+    paths = []
+    if output_dir is not False:
+        directory = output_dir if output_dir is not None else os.path.dirname(source_path)
+        paths.append(os.path.join(directory, game_name + ext))
+    if dataset_dir is not None:
+        os.makedirs(dataset_dir, exist_ok=True)
+        # 每局一个分片，重复导出同一局会覆盖而不是重复追加
+        paths.append(os.path.join(dataset_dir, f"part-{game_name}{ext}"))
+    for path in paths:
+        writer(columns, path)
+    return paths
+
+
+def load_dataset(dataset_dir=None, columns=None):
+    """读取数据集目录中的所有分片，只加载需要的列
+
+    Args:
+        dataset_dir: 数据集目录（默认 game_history/<EXPORT_CONFIG["dataset_dir"]>）
+        columns: 需要的列名列表（None 表示全部）
+
+    Returns:
+        Parquet 分片返回 pyarrow.Table；NPZ 分片返回 {列名: numpy数组}
+    """
+    dataset_dir = dataset_dir or os.path.join("game_history", EXPORT_CONFIG["dataset_dir"])
+    parquet_parts = sorted(glob.glob(os.path.join(dataset_dir, "part-*.parquet")))
+    if parquet_parts:
+        import pyarrow.dataset as ds
+        return ds.dataset(parquet_parts, format="parquet").to_table(columns=columns)
+    import numpy as np
+    npz_parts = sorted(glob.glob(os.path.join(dataset_dir, "part-*.npz")))
+    columns = columns or COLUMNS
+    result = {}
+    for name in columns:
+        arrays = []
+        for part in npz_parts:
+            with np.load(part) as data:
+                arrays.append(data[name])
+        result[name] = np.concatenate(arrays) if arrays else np.array([])
+    return result
+
+
+if __name__ == "__main__":
+    from game_recorder import load_game_history
+    parser = argparse.ArgumentParser(description='为已有的游戏记录导出列式文件')
+    parser.add_argument('paths', nargs='+', help='游戏记录文件（支持通配符）')
+    parser.add_argument('--format', default=None, choices=['auto', 'parquet', 'npz'], help='写出格式')
+    parser.add_argument('--no-per-game', action='store_true', help='只追加到数据集，不写单局文件')
+    args = parser.parse_args()
+    files = sorted({path for pattern in args.paths for path in glob.glob(pattern)})
+    for path in files:
+        record = load_game_history(path)
+        dataset_dir = os.path.join(os.path.dirname(path), EXPORT_CONFIG["dataset_dir"])
+        written = export_game(record, path, output_dir=False if args.no_per_game else None,
+                              dataset_dir=dataset_dir, backend=args.format)
+        for written_path in written:
+            print(f"已导出：{written_path}")
@@ -3,18 +3,49 @@
 """
 
 import os
-from dotenv import load_dotenv
+import threading
+from collections.abc import Mapping
+
+# 各提供商API Key对应的环境变量
+API_KEY_ENV_VARS = {
+    "openai": "OPENAI_API_KEY",
+    "zhipuai": "ZHIPUAI_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "deepseek": "DEEPSEEK_API_KEY"
+}
+
+
+class _LazyAPIKeys(Mapping):
+    """首次读取API Key时才加载 .env 文件，导入本模块时不做任何文件读取"""
+
+    def __init__(self, env_vars):
+        self._env_vars = env_vars
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if not self._loaded:
+                from dotenv import load_dotenv
+                # 加载 .env 文件中的环境变量
+                load_dotenv()
+                self._loaded = True
+
+    def __getitem__(self, provider):
+        env_var = self._env_vars[provider]
+        if not self._loaded:
+            self._load()
+        return os.getenv(env_var)
+
+    def __iter__(self):
+        return iter(self._env_vars)
+
+    def __len__(self):
+        return len(self._env_vars)
 
-# 加载 .env 文件中的环境变量
-load_dotenv()
 
 # API Keys配置
-API_KEYS = {
-    "openai": os.getenv("OPENAI_API_KEY"),
-    "zhipuai": os.getenv("ZHIPUAI_API_KEY"),
-    "gemini": os.getenv("GEMINI_API_KEY"),
-    "deepseek": os.getenv("DEEPSEEK_API_KEY")
-}
+API_KEYS = _LazyAPIKeys(API_KEY_ENV_VARS)
 
 # 模型配置
 MODEL_CONFIG = {
@@ -29,6 +60,15 @@ MODEL_CONFIG = {
     "temperature": 0  # 温度参数
 }
 
+# 不访问API的离线提供商（replay：按已保存的游戏记录回放响应；fake：确定性的假提供商，见 llm_fake.py）
+OFFLINE_PROVIDERS = ["replay", "fake"]
+
+# 假提供商的模拟延迟（也可通过游戏配置的 fake_latency / fake_jitter 单独设置）
+FAKE_PROVIDER_CONFIG = {
+    "latency": 0.0,                  # 每次请求的固定延迟（秒）
+    "jitter": 0.0                    # 额外的抖动上限（秒），由请求内容确定性地决定
+}
+
 # 游戏参数配置
 GAME_CONFIG = {
     "model": "gemini-2.5-flash",              # 模型名称
@@ -42,8 +82,170 @@ GAME_CONFIG = {
     "personality_type": "neutral"    # 性格类型：selfish, altruistic, neutral
 }
 
-def validate_config():
-    """验证配置是否有效"""
+# 并发配置
+CONCURRENCY_CONFIG = {
+    "max_workers": 8,                # 每个阶段同时进行的LLM调用数上限（1 表示串行）
+    "async_mode": False              # True：使用异步客户端在单个事件循环中并发调用（可设置更大的max_workers）
+}
+
+# 共享客户端连接池配置（同一进程内按 provider/base_url/api_key 共享客户端）
+CLIENT_POOL_CONFIG = {
+    "max_connections": 100,          # 每个客户端的最大连接数
+    "max_keepalive_connections": 20, # 保持空闲的长连接数
+    "keepalive_expiry": 30.0,        # 空闲连接保持时间（秒）
+    "timeout": 120.0                 # 单次请求超时（秒）
+}
+
+# 请求调度与限流配置（所有LLM调用都经过 llm_scheduler 的统一调度）
+# rpm：每分钟请求数上限；tpm：每分钟token数上限；None 表示不限制
+# 限额按进程计算，run_experiments 并行运行时会按进程数平分
+RATE_LIMIT_CONFIG = {
+    "max_in_flight": 64,             # 进程内同时在途的LLM调用数上限（None 表示不限制）
+    "providers": {                   # 按提供商的限额
+        "openai": {"rpm": None, "tpm": None},
+        "zhipuai": {"rpm": None, "tpm": None},
+        "gemini": {"rpm": None, "tpm": None},
+        "deepseek": {"rpm": None, "tpm": None}
+    },
+    "models": {                      # 按模型的限额，例如 "gpt-4.1": {"rpm": 500, "tpm": 30000}
+    },
+    "chars_per_token": 1.5,          # 估算输入token数时每个token对应的字符数
+    "output_tokens_estimate": 800    # 预估的单次输出token数（调用结束后按实际用量修正）
+}
+
+# LLM调用重试配置（错误分类见 llm_retry.py）
+RETRY_CONFIG = {
+    "max_attempts": {                # 各类错误的最大尝试次数（含首次）
+        "transient": 6,              # 网络错误、超时、5xx
+        "rate_limited": 10,          # 429 / 配额耗尽
+        "permanent": 1               # 参数错误、鉴权失败、输出校验失败等，不重试
+    },
+    "base_delay": 1.0,               # 指数退避的初始等待（秒）
+    "max_delay": 60.0,               # 单次退避等待上限（秒）
+    "max_retry_after": 300.0         # 服务端 Retry-After 建议的最长遵循时间（秒）
+}
+
+# LLM响应缓存配置（SQLite，多进程可共享）
+CACHE_CONFIG = {
+    "enabled": False,                # 是否启用响应缓存（也可通过游戏配置的 use_cache 单独开启）
+    "path": os.path.join("game_history", "cache", "llm_responses.sqlite"),
+    "max_age_days": 30,              # 条目最长保留天数（None 表示不过期）
+    "max_bytes": 2 * 1024 ** 3,      # 缓存内容总大小上限（字节，None 表示不限制）
+    "evict_every": 200               # 每写入多少条检查一次淘汰
+}
+
+# 游戏记录配置
+RECORDER_CONFIG = {
+    "stream": False,                 # 流式记录：每轮数据和每次LLM交互立即追加到JSONL（也可通过游戏配置的 stream_history 单独开启）
+    "stream_dir": "streams",         # JSONL 文件所在目录（相对于游戏的输出目录）
+    "flush_every": 1,                # 每写入多少条记录 flush 一次（1 表示每次调用后立即写入操作系统）
+    "fsync_every_round": True,       # 每轮结束时 fsync，保证断电等情况下已完成的轮次不丢失
+    "compact": True,                 # 游戏结束时由JSONL生成完整的JSON/TXT记录
+    "keep_stream": True,             # 生成JSON后是否保留JSONL文件
+    "format": "pretty",              # 输出格式：pretty（缩进JSON）或 compact（压缩JSON，省略可由交互记录重建的 reasoning_summary）
+    "compression": None,             # compact 格式的压缩方式：None / "gzip" / "zstd"（需安装 zstandard）
+    "serializer": "json",            # compact 格式的序列化库：json 或 orjson（未安装时回退为 json）
+    "string_table": True,            # compact 格式下用段落级字符串表去重 system prompt、规则说明等重复文本
+    "write_text": True               # 是否同时保存TXT格式的可读记录
+}
+
+# 实验目录（SQLite索引，位于每个输出目录下）
+CATALOG_CONFIG = {
+    "enabled": True,                 # 保存游戏记录时是否登记到索引
+    "filename": "catalog.sqlite"     # 索引文件名
+}
+
+# 列式导出配置（逐轮数值结果，每个 (游戏, 轮次, 玩家) 一行）
+EXPORT_CONFIG = {
+    "columnar": False,               # 保存游戏记录时是否同时导出列式文件
+    "format": "auto",                # parquet（需安装 pyarrow）/ npz（需安装 numpy）/ auto（按此顺序选择可用的格式）
+    "per_game": True,                # 是否在游戏记录旁写出单局文件
+    "dataset": True,                 # 是否追加到整个实验的数据集目录
+    "dataset_dir": "dataset"         # 数据集目录（相对于游戏的输出目录）
+}
+
+# Prompt结构配置
+PROMPT_CONFIG = {
+    "layout": "legacy",              # 投入决策prompt的结构（也可通过游戏配置的 prompt_layout 单独设置）：
+                                     # legacy：原结构（system为性格设定，user以玩家名、金额和轮次开头）
+                                     # prefix：静态游戏规则在前，其次为所有玩家共享的历史，玩家特定的信息放在最后，
+                                     #         使同一局中的请求共享尽量长的前缀，命中提供商的提示缓存
+    "cache_key": True                # OpenAI 请求附带 prompt_cache_key（同一局游戏共用），提高前缀缓存的命中率
+}
+
+# 价格表：每百万token的价格，用于按交互记录中的用量（见 llm_usage.py）估算每局游戏和批量实验的费用
+# 未列出的模型只统计token数，不计算费用；价格会变动，使用前请按提供商的官方价格核对
+PRICING_CONFIG = {
+    "currency": "USD",
+    "batch_discount": 0.5,           # 批处理（Batch API）请求的价格系数
+    "models": {                      # input：未命中缓存的输入；cached_input：命中提示缓存的输入；output：输出（含思考token）
+        "gpt-4.1": {"input": 2.00, "cached_input": 0.50, "output": 8.00},
+        "gpt-4.1-mini": {"input": 0.40, "cached_input": 0.10, "output": 1.60},
+        "gpt-4": {"input": 30.00, "cached_input": 30.00, "output": 60.00},
+        "gemini-2.5-flash": {"input": 0.30, "cached_input": 0.03, "output": 2.50},
+        "gemini-2.0-flash-exp": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+        "gemini-1.5-flash": {"input": 0.075, "cached_input": 0.01875, "output": 0.30},
+        "gemini-1.5-pro": {"input": 1.25, "cached_input": 0.3125, "output": 5.00},
+        "deepseek-chat": {"input": 0.28, "cached_input": 0.028, "output": 0.42},
+        "deepseek-reasoner": {"input": 0.28, "cached_input": 0.028, "output": 0.42}
+    }
+}
+
+# LLM调用指标配置（见 llm_metrics.py）
+METRICS_CONFIG = {
+    "buckets": [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300, 900, 3600],   # 耗时直方图的桶上界（秒）
+    "textfile": os.path.join("game_history", "metrics", "llm_metrics.prom"),  # Prometheus 文本文件（None 表示不写）
+    "http_port": None,               # 大于0时在该端口提供 /metrics（也可用 --metrics-port 指定）
+    "print_summary": True            # 每局游戏和批量实验结束时打印调用指标摘要
+}
+
+# 性能分析配置（main.py / run_experiments.py 的 --profile，见 profiling.py）
+PROFILE_CONFIG = {
+    "dir": os.path.join("game_history", "profiles"),   # .prof 和 .txt 报告的输出目录
+    "top": 40                        # 报告中列出的函数数（按自身时间排序）
+}
+
+# 小组决策配置：一次结构化输出请求为多名玩家做出本轮投入决策（每名玩家保留各自的性格设定、金额和历史）
+GROUP_DECISION_CONFIG = {
+    "group_size": 1                  # 每次请求包含的玩家数（1 表示每名玩家单独调用；也可通过游戏配置的 group_size 单独设置）
+}
+
+# 批处理（Batch API）配置：每个阶段所有智能体的请求打包为一个批处理任务，以延迟换取更低的价格和更高的限额
+BATCH_CONFIG = {
+    "enabled": False,                # 是否使用批处理模式（也可通过游戏配置的 batch_mode 单独开启）
+    "backends": {                    # 各提供商使用的批处理后端，未列出的提供商使用 local（本地文件替身，逐条调用提供商）
+        "openai": "openai"
+    },
+    "batch_dir": "batches",          # 请求/结果JSONL所在目录（相对于游戏的输出目录）
+    "keep_files": False,             # 结果分发完成后是否保留任务目录
+    "completion_window": "24h",      # OpenAI 批处理任务的完成时限
+    "poll_interval": 30.0,           # 轮询任务状态的间隔（秒）
+    "timeout": 24 * 3600,            # 等待单个阶段的任务完成的最长时间（秒），超时后取消任务
+    "collect_window": 5.0,           # 多局游戏同步推进时，等待其他游戏提交同一阶段请求的最长时间（秒）
+    "local_workers": 8,              # local 后端及交互式回退时的并发调用数
+    "fallback_interactive": True     # 批处理中失败或缺失的请求改为逐个交互式调用（含重试）
+}
+
+# 智能体内存配置
+MEMORY_CONFIG = {
+    "bounded": False,                # 有界内存：只在内存中保留工作集，其余记录溢出到磁盘（也可通过游戏配置的 bounded_memory 单独开启）
+    "spill_dir": "spill",            # 溢出文件所在目录（相对于游戏的输出目录）
+    "reasoning_window": 3,           # 内存中保留的最近reasoning条数（信念更新读取最近3条）
+    "belief_window": 1,              # 内存中保留的最近信念记忆条数
+    "interaction_window": 0          # 内存中保留的最近LLM交互记录条数
+}
+
+def validate_config(game_config=None):
+    """验证配置是否有效
+    
+    Args:
+        game_config: 要验证的游戏配置（默认验证全局 GAME_CONFIG）
+    """
+    if game_config is None:
+        game_config = GAME_CONFIG
+    # 离线提供商（如回放）不需要模型和API密钥检查
+    if game_config.get("provider") in OFFLINE_PROVIDERS:
+        return validate_game_params(game_config)
     # 检查模型配置
     provider = MODEL_CONFIG["provider"]
     model = MODEL_CONFIG["model"]
@@ -60,12 +262,17 @@ def validate_config():
     if not API_KEYS.get(provider):
         raise ValueError(f"缺少 {provider} 的API密钥")
     
-    # 检查游戏参数是否在合理范围内
-    if GAME_CONFIG["r"] <= 1:
+    validate_game_params(game_config)
+
+def validate_game_params(game_config):
+    """检查游戏参数是否在合理范围内"""
+    if game_config["r"] <= 1:
         raise ValueError("r必须大于1")
-    if GAME_CONFIG["endowment"] <= 0:
+    if game_config["endowment"] <= 0:
         raise ValueError("endowment必须为正数")
-    if GAME_CONFIG["rounds"] <= 0:
+    if game_config["rounds"] <= 0:
         raise ValueError("rounds必须为正数")
-    if GAME_CONFIG["num_players"] <= 0:
+    if game_config["num_players"] <= 0:
         raise ValueError("num_players必须为正数")
+    if game_config.get("max_workers", CONCURRENCY_CONFIG["max_workers"]) < 1:
+        raise ValueError("max_workers必须为正整数")
@@ -0,0 +1,261 @@
+"""
+实验目录（SQLite索引）
+
+GameRecorder 每次保存游戏记录时把配置、状态、完成轮数、文件路径和耗时写入输出目录下的 catalog.sqlite，
+批量实验和分析直接查询索引获取完成次数和文件路径，不再对 game_history 目录做 glob 扫描，
+也不依赖输出文件名的格式。
+
+已有的游戏记录可用以下命令补录（同时删除文件已不存在的条目）：
+python experiment_catalog.py --rebuild [game_history]
+
+批量实验的token用量和估算费用（按模型和实验条件汇总）：
+python experiment_catalog.py --cost [game_history]
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import threading
+import time
+from config import CATALOG_CONFIG
+
+_COLUMNS = [
+    "path", "text_path", "output_dir", "game_id", "model", "provider", "personality_type", "endowment", "r",
+    "rounds", "num_players", "reveal_mode", "anchor_ratio", "anchor_pct", "instruction_type", "status",
+    "completed_rounds", "started_at", "saved_at", "duration_seconds", "llm_calls", "input_tokens",
+    "cached_input_tokens", "output_tokens", "cost"
+]
+
+# 早期版本的索引中没有的列，打开时补上
+_ADDED_COLUMNS = {
+    "llm_calls": "INTEGER", "input_tokens": "INTEGER", "cached_input_tokens": "INTEGER", "output_tokens": "INTEGER",
+    "cost": "REAL"
+}
+
+# 费用报告的分组条件
+_CONDITION_COLUMNS = ["model", "personality_type", "num_players", "rounds", "reveal_mode", "anchor_pct",
+                      "instruction_type"]
+
+
+class ExperimentCatalog:
+    def __init__(self, path):
+        """
+        Args:
+            path: SQLite文件路径
+        """
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            " path TEXT PRIMARY KEY, text_path TEXT, output_dir TEXT, game_id TEXT,"
+            " model TEXT, provider TEXT, personality_type TEXT, endowment REAL, r REAL,"
+            " rounds INTEGER, num_players INTEGER, reveal_mode TEXT, anchor_ratio REAL, anchor_pct INTEGER,"
+            " instruction_type TEXT, status TEXT, completed_rounds INTEGER,"
+            " started_at REAL, saved_at REAL, duration_seconds REAL, llm_calls INTEGER, input_tokens INTEGER,"
+            " cached_input_tokens INTEGER, output_tokens INTEGER, cost REAL)"
+        )
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(games)")}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE games ADD COLUMN {column} {column_type}")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_games_condition ON games"
+            " (model, personality_type, num_players, rounds, reveal_mode, anchor_pct, instruction_type, status)"
+        )
+        conn.commit()
+
+    def _conn(self):
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def record_game(self, game_record, path, text_path=None, started_at=None, saved_at=None):
+        """登记（或更新）一局游戏的记录文件
+
+        Args:
+            game_record: 完整的游戏记录
+            path: 游戏记录文件路径
+            text_path: TXT记录路径
+            started_at: 游戏开始时间（Unix时间戳）
+            saved_at: 保存时间（Unix时间戳，默认当前时间）
+        """
+        game_config = game_record.get("game_config", {})
+        anchor_ratio = game_config.get("anchor_ratio", game_record.get("anchor_ratio"))
+        saved_at = saved_at if saved_at is not None else time.time()
+        token_usage = game_record.get("llm_interactions", {}).get("summary", {}).get("token_usage") or {}
+        row = {
+            "path": os.path.abspath(path),
+            "text_path": os.path.abspath(text_path) if text_path else None,
+            "output_dir": os.path.abspath(os.path.dirname(path)),
+            "game_id": game_config.get("game_id"),
+            "model": game_config.get("model"),
+            "provider": game_config.get("provider"),
+            "personality_type": game_config.get("personality_type"),
+            "endowment": game_config.get("endowment"),
+            "r": game_config.get("r"),
+            "rounds": game_config.get("rounds"),
+            "num_players": game_config.get("num_players"),
+            "reveal_mode": game_config.get("reveal_mode"),
+            "anchor_ratio": anchor_ratio,
+            # 与输出文件名中的 anchor{pct}pct 相同的取整方式
+            "anchor_pct": int(float(anchor_ratio) * 100) if anchor_ratio is not None else None,
+            "instruction_type": game_config.get("instruction_type", game_record.get("instruction_type")),
+            "status": game_record.get("game_status"),
+            # 按实际保存的轮次计数（game_config 中的 completed_rounds 是当前轮号，中途中断时比已完成的轮数多1）
+            "completed_rounds": len(game_record.get("rounds", [])),
+            "started_at": started_at,
+            "saved_at": saved_at,
+            "duration_seconds": saved_at - started_at if started_at is not None else None,
+            "llm_calls": token_usage.get("calls"),
+            "input_tokens": token_usage.get("input_tokens"),
+            "cached_input_tokens": token_usage.get("cached_input_tokens"),
+            "output_tokens": token_usage.get("output_tokens"),
+            "cost": token_usage.get("cost")
+        }
+        conn = self._conn()
+        conn.execute(
+            f"INSERT OR REPLACE INTO games ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' for _ in _COLUMNS)})",
+            [row[column] for column in _COLUMNS]
+        )
+        conn.commit()
+
+    def _where(self, filters):
+        clauses, params = [], []
+        for column, value in filters.items():
+            if value is None:
+                continue
+            if column == "anchor_ratio":
+                column, value = "anchor_pct", int(float(value) * 100)
+            clauses.append(f"{column} = ?")
+            params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def count(self, status="completed", **filters):
+        """统计满足条件的游戏数（filters 为列名=值，anchor_ratio 按百分比取整匹配）"""
+        where, params = self._where(dict(filters, status=status))
+        return self._conn().execute(f"SELECT COUNT(*) FROM games{where}", params).fetchone()[0]
+
+    def find(self, status="completed", **filters):
+        """返回满足条件的游戏记录文件路径（按保存时间排序）"""
+        where, params = self._where(dict(filters, status=status))
+        rows = self._conn().execute(f"SELECT path FROM games{where} ORDER BY saved_at", params).fetchall()
+        return [row[0] for row in rows]
+
+    def cost_report(self, since=None):
+        """按模型和实验条件汇总token用量和估算费用（包括中断的游戏）
+
+        Args:
+            since: 只统计该时间（Unix时间戳）之后保存的游戏，用于报告本次批量实验
+        Returns:
+            list[dict]: 每个条件一项，含 games、llm_calls、各类token数和 cost
+        """
+        where, params = (" WHERE saved_at >= ?", [since]) if since is not None else ("", [])
+        conditions = ", ".join(_CONDITION_COLUMNS)
+        rows = self._conn().execute(
+            f"SELECT {conditions}, COUNT(*), SUM(llm_calls), SUM(input_tokens), SUM(cached_input_tokens),"
+            f" SUM(output_tokens), SUM(cost) FROM games{where} GROUP BY {conditions} ORDER BY {conditions}",
+            params
+        ).fetchall()
+        totals = ["games", "llm_calls", "input_tokens", "cached_input_tokens", "output_tokens", "cost"]
+        return [dict(zip(_CONDITION_COLUMNS + totals, row)) for row in rows]
+
+    def rebuild(self, output_dir):
+        """从输出目录中已有的游戏记录文件补录索引，并删除文件已不存在的条目"""
+        from game_recorder import load_game_history
+        from history_format import strip_extension
+        conn = self._conn()
+        known = {row[0] for row in conn.execute("SELECT path FROM games")}
+        paths = sorted(
+            path for pattern in ("*.json", "*.json.gz", "*.json.zst")
+            for path in glob.glob(os.path.join(output_dir, pattern))
+        )
+        added = 0
+        for path in paths:
+            if os.path.abspath(path) in known:
+                continue
+            try:
+                game_record = load_game_history(path)
+            except (OSError, ValueError) as e:
+                print(f"跳过无法读取的文件 {path}: {e}")
+                continue
+            if not isinstance(game_record, dict) or "game_config" not in game_record:
+                continue
+            text_path = strip_extension(path) + ".txt"
+            self.record_game(game_record, path, text_path if os.path.exists(text_path) else None,
+                             saved_at=os.path.getmtime(path))
+            added += 1
+        stale = [(path,) for path in known if not os.path.exists(path)]
+        conn.executemany("DELETE FROM games WHERE path = ?", stale)
+        conn.commit()
+        return added, len(stale)
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def print_cost_report(catalog, since=None):
+    """打印 cost_report 的结果及总计"""
+    from config import PRICING_CONFIG
+    report = catalog.cost_report(since)
+    if not report:
+        print("没有可统计的游戏记录")
+        return
+    currency = PRICING_CONFIG["currency"]
+    print(f"{'条件':<60} {'局数':>5} {'调用':>7} {'输入token':>12} {'缓存命中':>12} {'输出token':>11} {'费用':>10}")
+    for item in report:
+        condition = "/".join(str(item[column]) for column in _CONDITION_COLUMNS)
+        cost = f"{item['cost']:.4f}" if item["cost"] is not None else "-"
+        print(f"{condition:<60} {item['games']:>5} {item['llm_calls'] or 0:>7} {item['input_tokens'] or 0:>12} "
+              f"{item['cached_input_tokens'] or 0:>12} {item['output_tokens'] or 0:>11} {cost:>10}")
+    total_cost = sum(item["cost"] or 0 for item in report)
+    total_tokens = sum((item["input_tokens"] or 0) + (item["output_tokens"] or 0) for item in report)
+    print(f"总计：{sum(item['games'] for item in report)} 局，{total_tokens} tokens，估算费用 {total_cost:.4f} {currency}")
+
+
+def catalog_path(output_dir="game_history"):
+    """输出目录对应的索引文件路径"""
+    return os.path.join(output_dir, CATALOG_CONFIG["filename"])
+
+
+def get_catalog(output_dir="game_history"):
+    """获取输出目录对应的索引（进程内共享）；索引文件不存在时先从已有文件补录"""
+    path = catalog_path(output_dir)
+    with _catalogs_lock:
+        if path not in _catalogs:
+            is_new = not os.path.exists(path)
+            catalog = ExperimentCatalog(path)
+            if is_new and os.path.isdir(output_dir):
+                catalog.rebuild(output_dir)
+            _catalogs[path] = catalog
+        return _catalogs[path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='实验目录（SQLite索引）')
+    parser.add_argument('output_dir', nargs='?', default='game_history', help='游戏输出目录')
+    parser.add_argument('--rebuild', action='store_true', help='从已有的游戏记录文件补录索引')
+    parser.add_argument('--cost', action='store_true', help='按模型和实验条件汇总token用量和估算费用')
+    args = parser.parse_args()
+    catalog = get_catalog(args.output_dir)
+    if args.rebuild:
+        added, removed = catalog.rebuild(args.output_dir)
+        print(f"补录 {added} 条，删除 {removed} 条文件已不存在的记录")
+    if args.cost:
+        print_cost_report(catalog)
+    else:
+        rows = catalog._conn().execute(
+            "SELECT model, personality_type, num_players, rounds, reveal_mode, anchor_pct, instruction_type, status, COUNT(*)"
+            " FROM games GROUP BY model, personality_type, num_players, rounds, reveal_mode, anchor_pct, instruction_type, status"
+        ).fetchall()
+        for row in rows:
+            print(" | ".join(str(value) for value in row))
@@ -1,10 +1,22 @@
 # game_controller.py
+import asyncio
+import contextvars
 import random
 import signal
 import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from agents import Agent
-from config import GAME_CONFIG, MODEL_CONFIG
+import os
+from config import GAME_CONFIG, MODEL_CONFIG, CONCURRENCY_CONFIG, RECORDER_CONFIG, MEMORY_CONFIG, BATCH_CONFIG, GROUP_DECISION_CONFIG, \
+    PROMPT_CONFIG
 from game_recorder import GameRecorder
+from history_aggregates import HistoryAggregates
+from llm_clients import aclose_async_clients
+from llm_scheduler import get_scheduler
+from llm_batch import PreparedCall, get_batch_runner, run_batch_phase
+from group_decision import decide_group, adecide_group
+from profiling import profiled
 
 class GameController:
     def __init__(self, config):
@@ -17,12 +29,28 @@ class GameController:
         print(f"[game_controller.py] 初始化时 config: {self.config}")
         self.agents = []
         self.current_round = 0
+        # 上一次保存的 ((已完成轮数, 是否中断), 记录路径)，避免 play() 和 main() 的异常处理重复保存同一状态
+        self._last_save = None
+        # 本局游戏的唯一标识（调度器据此在同一进程内的多局游戏之间公平排队）
+        self.game_id = uuid.uuid4().hex[:12]
         self.reveal_mode = config["reveal_mode"]
+        # 每个阶段并发LLM调用的上限
+        self.max_workers = config.get("max_workers", CONCURRENCY_CONFIG["max_workers"])
+        # 异步模式：所有LLM调用由同一个事件循环驱动
+        self.async_mode = config.get("async_mode", CONCURRENCY_CONFIG["async_mode"])
+        self._loop = None
+        # 批处理模式：每个阶段所有智能体的请求打包为一个批处理任务（优先于 async_mode）
+        self.batch_mode = config.get("batch_mode", BATCH_CONFIG["enabled"])
+        self.batch_runner = get_batch_runner() if self.batch_mode else None
+        # 小组决策：每 group_size 名非anchor玩家的投入决策合并为一次请求（批处理模式下不使用）
+        self.group_size = config.get("group_size", GROUP_DECISION_CONFIG["group_size"]) or 1
+        if self.group_size > 1 and self.batch_mode:
+            print("[game_controller.py] 批处理模式下不使用小组决策，各玩家单独提交请求")
         # 移除讨论相关功能
         # self.allow_discussion = config["allow_discussion"]
 
         # 初始化游戏记录器
-        self.recorder = GameRecorder()
+        self.recorder = GameRecorder(output_dir=config.get("output_dir", "game_history"))
 
     def set_debug_mode(self, debug=True):
         """设置所有智能体的调试模式"""
@@ -36,8 +64,11 @@ class GameController:
         num_anchors = int(num_agents * anchor_ratio)
         if anchor_ratio > 0 and num_anchors == 0:
             num_anchors = 1  # 至少1个anchor
-        # 随机选取anchor的位置
-        anchor_indices = set(random.sample(range(num_agents), num_anchors))
+        # 随机选取anchor的位置（回放等场景可通过 anchor_ids 指定）
+        if self.config.get("anchor_ids") is not None:
+            anchor_indices = {int(agent_id) for agent_id in self.config["anchor_ids"]}
+        else:
+            anchor_indices = set(random.sample(range(num_agents), num_anchors))
         for i in range(num_agents):
             if i in anchor_indices:
                 agent = Agent(
@@ -45,16 +76,75 @@ class GameController:
                     personality_type="anchor",
                     is_anchor=True,
                     model=self.config.get("model"),
-                    provider=self.config.get("provider")
+                    provider=self.config.get("provider"),
+                    game_config=self.config,
+                    game_id=self.game_id
                 )
             else:
                 agent = Agent(
                     agent_id=str(i),
                     personality_type=self.config["personality_type"],
                     model=self.config.get("model"),
-                    provider=self.config.get("provider")
+                    provider=self.config.get("provider"),
+                    game_config=self.config,
+                    game_id=self.game_id
                 )
             self.agents.append(agent)
+        # 增量维护的历史汇总，每轮结算后追加，供所有智能体构建决策prompt
+        self.history_aggregates = HistoryAggregates([agent.id for agent in self.agents], self.config["endowment"])
+        # 有界内存：每个智能体只在内存中保留工作集，其余记录溢出到磁盘，保存时由记录器读回
+        if self.config.get("bounded_memory", MEMORY_CONFIG["bounded"]):
+            spill_dir = os.path.join(self.recorder.output_dir, MEMORY_CONFIG["spill_dir"], self.game_id)
+            for agent in self.agents:
+                agent.enable_bounded_memory(
+                    os.path.join(spill_dir, f"agent_{agent.id}.jsonl"),
+                    reasoning_window=MEMORY_CONFIG["reasoning_window"],
+                    belief_window=MEMORY_CONFIG["belief_window"],
+                    interaction_window=MEMORY_CONFIG["interaction_window"]
+                )
+        # 流式记录：每轮数据和每次LLM交互立即追加到JSONL，交互记录不再保留在内存中
+        if self.config.get("stream_history", RECORDER_CONFIG["stream"]):
+            self.recorder.start_stream(self.game_id, self.config, self.agents)
+            for agent in self.agents:
+                agent.event_sink = self.recorder.record_agent_event
+                agent.retain_interactions = False
+
+    def restore_state(self, game_record):
+        """从中断的游戏记录恢复到最后一个完整结束的轮次，之后调用 play() 从下一轮继续
+        
+        中断可能发生在某一轮进行中，此时部分智能体的history、信念和LLM交互已包含未完成的轮次，
+        这里统一截断到记录中已完成的轮数 len(rounds)
+        
+        Args:
+            game_record: setup_game() 之后传入的中断游戏记录（load_game_history / load_stream_record 的结果）
+        """
+        rounds = game_record.get("rounds", [])
+        completed = len(rounds)
+        agent_records = {agent["id"]: agent for agent in game_record.get("agents", [])}
+        interactions_by_agent = game_record.get("llm_interactions", {}).get("interactions_by_agent", {})
+        for round_record in rounds:
+            self.recorder.record_round(round_record["round"], round_record["stats"], round_record["agents"])
+        for agent in self.agents:
+            history = [entry for round_record in rounds for entry in round_record["agents"] if entry["id"] == agent.id]
+            beliefs = [belief for belief in agent_records.get(agent.id, {}).get("belief_memory", [])
+                       if belief.get("round", 0) <= completed]
+            # 保留到第 completed 次成功的信念更新为止的交互（之后是未完成轮次的调用）
+            interactions = []
+            belief_updates = 0
+            for interaction in interactions_by_agent.get(agent.id, {}).get("interactions", []):
+                if belief_updates >= completed:
+                    break
+                interactions.append(interaction)
+                if (interaction.get("debug_label") == "信念更新"
+                        and interaction.get("output", {}).get("status") != "error"):
+                    belief_updates += 1
+            agent.restore_state(history, beliefs, interactions)
+        self.history_aggregates = HistoryAggregates.from_histories(
+            [agent.id for agent in self.agents], self.config["endowment"],
+            {agent.id: agent.history for agent in self.agents}
+        )
+        self.current_round = completed
+        print(f"已从中断记录恢复到第 {completed} 轮结束时的状态")
 
     def signal_handler(self, signum, frame):
         """处理程序意外退出的情况"""
@@ -62,26 +152,38 @@ class GameController:
         self.save_game_state(interrupted=True)
         sys.exit(0)
 
+    @profiled("controller.final_decision")
     def conduct_final_decision(self):
         """进行游戏结束后的最终一次性PGG决策"""
         final_decisions = {}
         print("\n各玩家进行最终一次性PGG决策:")
         
-        for agent in self.agents:
-            final_contribution = agent.make_final_decision(
-                initial_endowment=self.config["endowment"],
-                r=self.config["r"],
-                num_players=len(self.agents)
-            )
+        kwargs = {
+            "initial_endowment": self.config["endowment"],
+            "r": self.config["r"],
+            "num_players": len(self.agents)
+        }
+        results = self._run_phase(
+            lambda agent: agent.make_final_decision(**kwargs),
+            lambda agent: agent.amake_final_decision(**kwargs),
+            self.agents,
+            lambda agent: agent.prepare_final_decision(**kwargs)
+        )
+        for agent, final_contribution in zip(self.agents, results):
             final_decisions[agent.id] = final_contribution
             print(f"玩家 {agent.id}: 最终一次性投入 {final_contribution}")
             
         return final_decisions
 
+    @profiled("controller.save")
     def save_game_state(self, interrupted=True, final_decisions=None):
-        """保存当前游戏状态"""
+        """保存当前游戏状态（同一状态已保存过时不再重复写出文件和目录记录）"""
+        if self._last_save is not None and self._last_save[0] == (self.current_round, interrupted):
+            print(f"第 {self.current_round} 回合的游戏记录已保存：{self._last_save[1]}")
+            return
         if self.current_round > 0:  # 只在游戏已经开始后保存
             game_config = {
+                "game_id": self.game_id,
                 "model": self.config["model"],  # ✅ 使用实际传入的model
                 "provider": self.config.get("provider", "openai"),  # ✅ 添加provider
                 "personality_type": self.config["personality_type"],
@@ -95,11 +197,32 @@ class GameController:
                 "anchor_ratio": self.config.get("anchor_ratio", None),  # 确保anchor_ratio写入
                 "instruction_type": self.config.get("instruction_type", "certain")  # 确保instruction_type写入
             }
-            self.recorder.save_game_history(game_config, self.agents, interrupted=interrupted)
+            if self.config.get("resumed_from"):
+                game_config["resumed_from"] = self.config["resumed_from"]
+            if self.group_size > 1 and not self.batch_mode:
+                game_config["group_size"] = self.group_size
+            prompt_layout = self.config.get("prompt_layout", PROMPT_CONFIG["layout"])
+            if prompt_layout != "legacy":
+                game_config["prompt_layout"] = prompt_layout
+            filepath, _ = self.recorder.save_game_history(game_config, self.agents, interrupted=interrupted)
+            self._last_save = ((self.current_round, interrupted), filepath)
             if interrupted:
                 print(f"已保存到第 {self.current_round} 回合的游戏记录")
             else:
                 print(f"游戏完成，已保存完整游戏记录（包含最终决策）")
+                # 完整记录已写出，删除有界内存模式的溢出文件（中断时保留，可能再次保存）
+                self._remove_spill_files()
+
+    def _remove_spill_files(self):
+        """删除各智能体的溢出文件"""
+        spill_dirs = set()
+        for agent in self.agents:
+            if agent.spill_store is not None:
+                agent.spill_store.remove()
+                spill_dirs.add(os.path.dirname(agent.spill_store.path))
+        for spill_dir in spill_dirs:
+            if os.path.isdir(spill_dir) and not os.listdir(spill_dir):
+                os.rmdir(spill_dir)
 
     def reveal_contributions(self, contributions):
         """根据不同的揭示模式返回贡献信息"""
@@ -134,12 +257,20 @@ class GameController:
 
     def play(self):
         """运行完整游戏流程"""
+        if self.batch_runner is not None:
+            self.batch_runner.register()
         try:
             # 初始化游戏状态
             self.last_payoffs = {ag.id: self.config["endowment"] for ag in self.agents}
+            if self.recorder.round_records:
+                # 续跑的游戏：从恢复的最后一轮继续
+                for agent_data in self.recorder.round_records[-1]["agents"]:
+                    self.last_payoffs[agent_data["id"]] = agent_data["payoff"]
             
-            for round_num in range(1, self.config["rounds"] + 1):
+            for round_num in range(self.current_round + 1, self.config["rounds"] + 1):
                 self.current_round = round_num
+                for agent in self.agents:
+                    agent.round_number = round_num
                 print(f"\n{'='*20} 第 {round_num} 轮 {'='*20}")
                 
                 # 显示当前状态
@@ -169,6 +300,8 @@ class GameController:
                 )
                 
             # 游戏正常结束后，进行最终一次性PGG决策
+            for agent in self.agents:
+                agent.round_number = None
             print("\n=== 最终一次性PGG决策 ===")
             final_decisions = self.conduct_final_decision()
             
@@ -180,7 +313,14 @@ class GameController:
             print(f"\n游戏过程中发生错误: {str(e)}")
             self.save_game_state(interrupted=True)  # 发生错误时保存当前进度
             raise
+        finally:
+            if self.batch_runner is not None:
+                self.batch_runner.unregister()
+            get_scheduler().release_game(self.game_id)
+            self._close_loop()
+            self.recorder.close_stream()
 
+    @profiled("controller.play_round")
     def play_round(self):
         """执行一轮游戏的具体流程"""
         round_data = {
@@ -214,17 +354,29 @@ class GameController:
                 ratio = a['contribution'] / initial_money if initial_money else 0
                 ratios.append(ratio)
             avg_contrib_ratio = sum(ratios) / len(ratios) if ratios else 0
-        # 1. 收集贡献决策
+        # 1. 收集贡献决策（所有决策只依赖本轮开始时的快照，可并发进行）
         print("\n=== 各玩家本轮决策 ===")
-        for agent in self.agents:
-            contribution = agent.decide_contribution(
-                self.current_round,
-                self.config["r"],
-                len(self.agents),
-                all_history_with_current_money,
-                self.reveal_mode,
-                avg_contrib_ratio=avg_contrib_ratio
+        decision_args = (
+            self.current_round,
+            self.config["r"],
+            len(self.agents),
+            all_history_with_current_money,
+            self.reveal_mode
+        )
+        decision_kwargs = {
+            "avg_contrib_ratio": avg_contrib_ratio,
+            "history_view": self.history_aggregates
+        }
+        if self.group_size > 1 and not self.batch_mode:
+            decisions = self._decide_in_groups(decision_args, decision_kwargs)
+        else:
+            decisions = self._run_phase(
+                lambda agent: agent.decide_contribution(*decision_args, **decision_kwargs),
+                lambda agent: agent.adecide_contribution(*decision_args, **decision_kwargs),
+                self.agents,
+                lambda agent: agent.prepare_contribution(*decision_args, **decision_kwargs)
             )
+        for agent, contribution in zip(self.agents, decisions):
             contribution = min(contribution, agent.current_total_money)  # 确保不超过当前总金额
             round_data['contributions'][agent.id] = contribution
             print(f"\n玩家 {agent.id}{'（锚定智能体）' if agent.is_anchor else ''}:")
@@ -257,15 +409,98 @@ class GameController:
                 all_history=all_history
             )
         round_data['agents_data'] = agents_data
+        self.history_aggregates.add_round(agents_data)
         # 信念每轮都更新
         self._update_agents_memory(all_history)
         return round_data
     
+    def _decide_in_groups(self, decision_args, decision_kwargs):
+        """小组决策：非anchor玩家按座次每 group_size 人一组，每组一次请求，结果按agents顺序返回"""
+        deciders = [agent for agent in self.agents if not agent.is_anchor]
+        groups = [deciders[i:i + self.group_size] for i in range(0, len(deciders), self.group_size)]
+        results = self._run_phase(
+            lambda group: decide_group(group, *decision_args, **decision_kwargs),
+            lambda group: adecide_group(group, *decision_args, **decision_kwargs),
+            groups
+        )
+        contributions = {}
+        for group, group_results in zip(groups, results):
+            contributions.update((agent.id, contribution) for agent, contribution in zip(group, group_results))
+        # 锚定智能体直接全部投入
+        return [agent.current_total_money if agent.is_anchor else contributions[agent.id] for agent in self.agents]
+
+    def _run_phase(self, sync_func, async_func, agents, prepare_func=None):
+        """执行一个LLM阶段，结果按agents顺序返回
+        
+        batch_mode 下由 prepare_func 构建每个智能体的请求（PreparedCall），打包为批处理任务执行；
+        async_mode 下在事件循环中并发执行 async_func 返回的协程，否则使用线程池执行 sync_func
+        """
+        if self.batch_mode and prepare_func is not None:
+            return self._run_batch_phase(prepare_func, agents)
+        if self.async_mode:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+            return self._loop.run_until_complete(self._amap_agents(async_func, agents))
+        return self._map_agents(sync_func, agents)
+
+    def _run_batch_phase(self, prepare_func, agents):
+        """构建所有智能体的请求后一次性提交；不需要调用LLM的智能体（如anchor）直接使用prepare_func的返回值"""
+        prepared = [prepare_func(agent) for agent in agents]
+        run_batch_phase([item for item in prepared if isinstance(item, PreparedCall)], self.batch_runner)
+        return [item.value if isinstance(item, PreparedCall) else item for item in prepared]
+
+    async def _amap_agents(self, afunc, agents):
+        """并发等待每个智能体的协程，同时在途的调用数不超过max_workers
+        
+        任一智能体出错时取消其余仍在运行或排队的协程，等待它们结束后再抛出原异常，
+        避免它们在保存中断记录时继续修改智能体状态或在下一次 run_until_complete 中继续运行
+        """
+        semaphore = asyncio.Semaphore(self.max_workers)
+        async def run(agent):
+            async with semaphore:
+                return await afunc(agent)
+        tasks = [asyncio.ensure_future(run(agent)) for agent in agents]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _close_loop(self):
+        """关闭异步客户端和事件循环"""
+        if self._loop is None:
+            return
+        self._loop.run_until_complete(aclose_async_clients())
+        self._loop.close()
+        self._loop = None
+
+    def _map_agents(self, func, agents):
+        """对每个智能体执行func，最多max_workers个并发，结果按agents顺序返回
+        
+        每个智能体只在自己的线程中被调用一次，因此其llm_interactions的顺序不受影响；
+        工作线程在调用者上下文的副本中执行（同步推进多局游戏时输出仍写入本局的日志）
+        """
+        if self.max_workers <= 1 or len(agents) <= 1:
+            return [func(agent) for agent in agents]
+        contexts = [contextvars.copy_context() for _ in agents]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(agents))) as executor:
+            return list(executor.map(lambda context, agent: context.run(func, agent), contexts, agents))
+
     def _update_agents_memory(self, all_history):
-        """统一更新所有智能体的信念记忆（每轮都更新）"""
+        """统一更新所有智能体的信念记忆（每轮都更新）
+        
+        各智能体的信念更新互不依赖，与决策阶段共用同一并发上限；全部完成后再按智能体顺序打印
+        """
         print("\n=== 信念记忆更新 ===")
+        self._run_phase(
+            lambda agent: agent._update_belief_memory(self.current_round, self.reveal_mode, all_history),
+            lambda agent: agent._aupdate_belief_memory(self.current_round, self.reveal_mode, all_history),
+            [agent for agent in self.agents if not agent.is_anchor],
+            lambda agent: agent.prepare_belief_update(self.current_round, self.reveal_mode, all_history)
+        )
         for agent in self.agents:
-            agent._update_belief_memory(self.current_round, self.reveal_mode, all_history)
             if agent.belief_memory:
                 print(f"\n玩家 {agent.id} 的信念记忆更新：\n{agent.belief_memory[-1]['updated_personality']}")
 
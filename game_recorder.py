@@ -1,19 +1,97 @@
 import os
 import json
+import sqlite3
+import threading
+import time
 from datetime import datetime
+from config import RECORDER_CONFIG, EXPORT_CONFIG, CATALOG_CONFIG, METRICS_CONFIG
+from columnar_export import export_game
+from experiment_catalog import get_catalog
+from llm_usage import usage_totals, usage_by_phase
+from llm_metrics import interaction_metrics, format_summary
+from profiling import profiled, phase
+from history_format import encode_record, load_record, file_extension, strip_extension
 
 class GameRecorder:
-    def __init__(self, output_dir="game_history"):
+    def __init__(self, output_dir="game_history", recorder_config=None):
         """
         初始化游戏记录器
         
         Args:
             output_dir: 输出目录的路径
+            recorder_config: 记录配置（默认使用 RECORDER_CONFIG）
         """
         self.output_dir = output_dir
         self.round_records = []
+        self.started_at = time.time()  # 游戏开始时间，登记到实验目录
+        self.recorder_config = recorder_config if recorder_config is not None else RECORDER_CONFIG
+        # 流式记录（JSONL）
+        self.stream_path = None
+        self._stream = None
+        self._stream_lock = threading.Lock()
+        self._unflushed = 0
         os.makedirs(output_dir, exist_ok=True)
     
+    def start_stream(self, game_id, game_config, agents):
+        """开启流式记录：之后的每轮数据和每次LLM交互都会立即追加到JSONL文件
+        
+        Args:
+            game_id: 本局游戏的唯一标识
+            game_config: 本局游戏配置
+            agents: 参与游戏的所有agent
+        """
+        stream_dir = os.path.join(self.output_dir, self.recorder_config["stream_dir"])
+        os.makedirs(stream_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.stream_path = os.path.join(stream_dir, f"{timestamp}_{game_id}.jsonl")
+        self._stream = open(self.stream_path, "a", encoding="utf-8")
+        self._write_event({
+            "type": "game_start",
+            "game_id": game_id,
+            "timestamp": datetime.now().isoformat(),
+            "game_config": game_config,
+            "agents": [
+                {
+                    "id": agent.id,
+                    "name": agent.name,
+                    "personality_type": agent.personality_type,
+                    "is_anchor": agent.is_anchor
+                }
+                for agent in agents
+            ]
+        }, durable=True)
+        print(f"流式记录已开启：{self.stream_path}")
+        return self.stream_path
+
+    @profiled("recorder.stream")
+    def _write_event(self, event, durable=False):
+        """向JSONL追加一条记录；durable=True 时立即 flush（并按配置 fsync）"""
+        line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        with self._stream_lock:
+            if self._stream is None:
+                return
+            self._stream.write(line)
+            self._unflushed += 1
+            if durable or self._unflushed >= self.recorder_config["flush_every"]:
+                self._stream.flush()
+                self._unflushed = 0
+            if durable and self.recorder_config["fsync_every_round"]:
+                os.fsync(self._stream.fileno())
+
+    def record_agent_event(self, kind, agent, record):
+        """智能体的事件回调：kind 为 "interaction"（一次LLM交互）或 "belief"（一条信念记忆）"""
+        self._write_event({"type": kind, "agent_id": agent.id, kind: record})
+
+    def close_stream(self):
+        """关闭JSONL文件"""
+        with self._stream_lock:
+            if self._stream is not None:
+                self._stream.flush()
+                os.fsync(self._stream.fileno())
+                self._stream.close()
+                self._stream = None
+
+    @profiled("recorder.record_round")
     def record_round(self, round_number, stats, agents_data):
         """
         记录一轮游戏的数据
@@ -29,96 +107,141 @@ class GameRecorder:
             "agents": agents_data
         }
         self.round_records.append(round_record)
+        if self._stream is not None:
+            self._write_event({"type": "round", "round": round_record}, durable=True)
         
     def save_game_history(self, game_config, agents, interrupted=False):
         """
         保存游戏历史到文件
         
+        流式记录模式下先写入结束标记，再由JSONL生成完整记录（RECORDER_CONFIG["compact"] 为 False 时只保留JSONL）
+        
         Args:
             game_config: 游戏配置信息
             agents: 参与游戏的所有agent
             interrupted: 是否是因为中断而保存（默认False）
         """
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        agent_records = [self._agent_record(agent, game_config) for agent in agents]
+        if self.stream_path is not None:
+            self._write_event({
+                "type": "game_end",
+                "game_status": "interrupted" if interrupted else "completed",
+                "game_config": game_config
+            }, durable=True)
+            self.close_stream()
+            if not self.recorder_config["compact"]:
+                print(f"\n游戏历史JSONL已保存到：{self.stream_path}")
+                return self.stream_path, None
+            stream = read_stream(self.stream_path)
+            interactions = [
+                (agent.id, agent.name, agent.personality_type, stream["interactions"].get(agent.id, []))
+                for agent in agents
+            ]
+            rounds = stream["rounds"]
+        else:
+            interactions = [
+                (agent.id, agent.name, agent.personality_type, list(agent.llm_interactions))
+                for agent in agents if hasattr(agent, 'llm_interactions')
+            ]
+            rounds = self.round_records
+        game_record = self._build_game_record(game_config, rounds, agent_records, interactions, interrupted)
+        if METRICS_CONFIG["print_summary"]:
+            print(format_summary(game_record["llm_interactions"]["summary"]["call_metrics"], "本局LLM调用指标"))
+        filepath, text_filepath = self._write_game_record(game_config, game_record, interrupted, len(agents))
+        if self.stream_path is not None and not self.recorder_config["keep_stream"]:
+            os.remove(self.stream_path)
+        return filepath, text_filepath
+
+    @staticmethod
+    def _agent_record(agent, game_config):
+        """单个agent的完整历史记录"""
+        return {
+            "id": agent.id,
+            "name": agent.name,
+            "personality_type": agent.personality_type,
+            "is_anchor": agent.is_anchor,
+            "game_history": agent.history,
+            "belief_memory": list(agent.belief_memory),      # 信念记忆（有界内存模式下从溢出文件读回）
+            "current_total_money": agent.current_total_money,  # 当前总金额
+            "final_decision": game_config.get("final_decisions", {}).get(agent.id) if game_config.get("final_decisions") else None
+        }
+
+    @staticmethod
+    @profiled("recorder.build_record")
+    def _build_game_record(game_config, rounds, agent_records, interactions, interrupted):
+        """
+        组装完整的游戏记录
         
+        Args:
+            game_config: 游戏配置信息
+            rounds: 每轮记录列表
+            agent_records: 每个agent的历史记录
+            interactions: [(agent_id, agent_name, personality_type, 交互记录列表)]
+            interrupted: 是否中断
+        """
         # 创建游戏记录
         game_record = {
             "game_config": game_config,
             "game_status": "interrupted" if interrupted else "completed",
-            "rounds": self.round_records,
-            "agents": []
+            "rounds": rounds,
+            "agents": agent_records
         }
         
-        # 收集每个agent的完整历史记录
-        for agent in agents:
-            agent_record = {
-                "id": agent.id,
-                "name": agent.name,
-                "personality_type": agent.personality_type,
-                "is_anchor": agent.is_anchor,
-                "game_history": agent.history,
-                "belief_memory": agent.belief_memory,      # 信念记忆
-                "current_total_money": agent.current_total_money,  # 当前总金额
-                "final_decision": game_config.get("final_decisions", {}).get(agent.id) if game_config.get("final_decisions") else None
-            }
-            game_record["agents"].append(agent_record)
-        
         # 添加详细的LLM交互记录
         game_record["llm_interactions"] = {
             "summary": {
-                "total_interactions": sum(len(agent.llm_interactions) for agent in agents),
-                "agents_count": len(agents)
+                "total_interactions": sum(len(agent_interactions) for _, _, _, agent_interactions in interactions),
+                "agents_count": len(agent_records)
             },
             "interactions_by_agent": {}
         }
+        # 提供商报告的token用量和估算费用（整局、按阶段、按玩家），离线提供商没有用量信息
+        all_interactions = [
+            interaction for _, _, _, agent_interactions in interactions for interaction in agent_interactions
+        ]
+        token_usage = usage_totals(all_interactions)
+        if token_usage:
+            game_record["llm_interactions"]["summary"]["token_usage"] = token_usage
+            game_record["llm_interactions"]["summary"]["token_usage_by_phase"] = usage_by_phase(all_interactions)
+        # 按提供商/模型/阶段汇总的调用数、错误率、重试次数和耗时分位数
+        game_record["llm_interactions"]["summary"]["call_metrics"] = interaction_metrics(
+            (agent_id, interaction) for agent_id, _, _, agent_interactions in interactions
+            for interaction in agent_interactions
+        )
         
         # 额外添加一个独立的reasoning摘要部分，便于查看思考过程
         game_record["reasoning_summary"] = {}
         
-        for agent in agents:
-            if hasattr(agent, 'llm_interactions') and agent.llm_interactions:
+        for agent_id, agent_name, personality_type, agent_interactions in interactions:
+            if agent_interactions:
                 # 保存完整交互记录
-                game_record["llm_interactions"]["interactions_by_agent"][agent.id] = {
-                    "agent_name": agent.name,
-                    "personality_type": agent.personality_type,
-                    "total_interactions": len(agent.llm_interactions),
-                    "interactions": agent.llm_interactions
+                game_record["llm_interactions"]["interactions_by_agent"][agent_id] = {
+                    "agent_name": agent_name,
+                    "personality_type": personality_type,
+                    "total_interactions": len(agent_interactions),
+                    "interactions": agent_interactions
                 }
+                if token_usage:
+                    game_record["llm_interactions"]["interactions_by_agent"][agent_id]["token_usage"] = \
+                        usage_totals(agent_interactions)
                 
-                # 创建reasoning摘要
-                reasoning_by_round = {}
-                for interaction in agent.llm_interactions:
-                    debug_label = interaction.get("debug_label", "未知")
-                    reasoning = interaction.get("output", {}).get("reasoning")
-                    estimated_others_avg_ratio = interaction.get("output", {}).get("estimated_others_avg_ratio")
-                    output_ratio = interaction.get("output", {}).get("output_ratio")
-                    if reasoning:
-                        if debug_label not in reasoning_by_round:
-                            reasoning_by_round[debug_label] = []
-                        entry = {
-                            "timestamp": interaction.get("timestamp"),
-                            "reasoning": reasoning
-                        }
-                        # 如果有estimated_others_avg_ratio字段，也加入
-                        if estimated_others_avg_ratio is not None:
-                            entry["estimated_others_avg_ratio"] = estimated_others_avg_ratio
-                        # 如果有output_ratio字段，也加入
-                        if output_ratio is not None:
-                            entry["output_ratio"] = output_ratio
-                        reasoning_by_round[debug_label].append(entry)
-                
-                game_record["reasoning_summary"][agent.id] = {
-                    "agent_name": agent.name,
-                    "reasoning_by_type": reasoning_by_round
+                game_record["reasoning_summary"][agent_id] = {
+                    "agent_name": agent_name,
+                    "reasoning_by_type": reasoning_by_type(agent_interactions)
                 }
+        return game_record
+
+    def _write_game_record(self, game_config, game_record, interrupted, num_agents):
+        """按配置和游戏状态命名并写出JSON和TXT文件"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         # 根据config信息和游戏状态构建文件名
         # 格式: [模型]_[personality]_[players]p_[rounds]r_[status]_[timestamp].json
         model_name = game_config.get("model", "unknown")
         personality = game_config.get("personality_type", "unknown")
-        num_players = game_config.get("num_players", len(agents))
+        num_players = game_config.get("num_players", num_agents)
         total_rounds = game_config.get("rounds", "unknown")
-        completed_rounds = game_config.get("completed_rounds", len(self.round_records))
+        completed_rounds = len(game_record["rounds"])  # 实际保存的轮数（中途中断时当前轮未完成，不计入）
         reveal_mode = game_config.get("reveal_mode", "unknown")
         instruction_type = game_config.get("instruction_type", "certain")
         anchor_ratio = game_config.get("anchor_ratio", None)
@@ -136,17 +259,67 @@ class GameRecorder:
         game_record["anchor_ratio"] = anchor_ratio
         game_record["instruction_type"] = instruction_type
         
-        filepath = os.path.join(self.output_dir, filename)
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(game_record, f, ensure_ascii=False, indent=2)
+        pretty = self.recorder_config["format"] != "compact"
+        compression = None if pretty else self.recorder_config["compression"]
+        saved_record = game_record
+        if not pretty:
+            # reasoning_summary 可由交互记录重建（load_game_history 读取时自动补全）
+            saved_record = {key: value for key, value in game_record.items() if key != "reasoning_summary"}
+        with phase("recorder.json_encode"):
+            data = encode_record(
+                saved_record,
+                pretty=pretty,
+                compression=compression,
+                serializer=self.recorder_config["serializer"],
+                string_table=self.recorder_config["string_table"]
+            )
+            filepath = self._reserve_filepath(strip_extension(filename) + file_extension(compression))
+            with open(filepath, "wb") as f:
+                f.write(data)
         
         print(f"\n游戏历史JSON格式已保存到：{filepath}")
         
+        # 导出逐轮数值结果的列式文件
+        if EXPORT_CONFIG["columnar"]:
+            with phase("recorder.columnar_export"):
+                dataset_dir = os.path.join(self.output_dir, EXPORT_CONFIG["dataset_dir"]) if EXPORT_CONFIG["dataset"] else None
+                for columnar_path in export_game(game_record, filepath,
+                                                 output_dir=None if EXPORT_CONFIG["per_game"] else False,
+                                                 dataset_dir=dataset_dir):
+                    print(f"列式数据已导出到：{columnar_path}")
+        
         # 同时保存文本格式的历史记录
-        text_filepath = self.save_text_history(game_config, agents, game_record, filepath)
+        text_filepath = None
+        if self.recorder_config["write_text"]:
+            text_filepath = self.save_text_history(game_config, game_record["agents"], game_record, filepath)
+        
+        # 登记到实验目录（索引写入失败不影响已保存的文件）
+        if CATALOG_CONFIG["enabled"]:
+            try:
+                get_catalog(self.output_dir).record_game(game_record, filepath, text_filepath, started_at=self.started_at)
+            except sqlite3.Error as e:
+                print(f"[game_recorder.py] 登记实验目录失败: {e}")
         
         return filepath, text_filepath
 
+    def _reserve_filepath(self, filename):
+        """以独占方式创建输出文件，避免并行运行的同配置游戏在同一秒保存时互相覆盖
+        
+        文件已存在时在时间戳后追加序号，例如 ..._20250101_120000_2.json
+        """
+        stem = strip_extension(filename)
+        ext = filename[len(stem):]
+        suffix = 1
+        while True:
+            candidate = stem + (f"_{suffix}" if suffix > 1 else "") + ext
+            filepath = os.path.join(self.output_dir, candidate)
+            try:
+                with open(filepath, "x", encoding="utf-8"):
+                    return filepath
+            except FileExistsError:
+                suffix += 1
+
+    @profiled("recorder.format_round_summary")
     def format_round_summary(self, round_number, stats, agents_data):
         """
         格式化一轮游戏的摘要信息
@@ -315,7 +488,7 @@ class GameRecorder:
         sections.append(f"性格特征: {game_config.get('personality_type', 'unknown')}")
         sections.append(f"玩家数量: {game_config.get('num_players', len(agents))}")
         sections.append(f"总回合数: {game_config.get('rounds', 'unknown')}")
-        sections.append(f"完成回合: {len(self.round_records)}")
+        sections.append(f"完成回合: {len(game_record['rounds'])}")
         sections.append(f"公开方式: {game_config.get('reveal_mode', 'unknown')}")
         sections.append(f"游戏状态: {'已中断' if game_record['game_status'] == 'interrupted' else '已完成'}")
         
@@ -334,7 +507,7 @@ class GameRecorder:
 
         # 3. 每轮详情
         sections.append("\n" + "="*20 + " 回合详情 " + "="*20)
-        for round_record in self.round_records:
+        for round_record in game_record["rounds"]:
             round_num = round_record["round"]
             stats = round_record["stats"]
             agents_data = round_record["agents"]
@@ -428,6 +601,7 @@ class GameRecorder:
         
         return "\n".join(sections)
 
+    @profiled("recorder.text_history")
     def save_text_history(self, game_config, agents, game_record, filepath):
         """
         保存游戏历史的文本格式到文件
@@ -442,7 +616,7 @@ class GameRecorder:
         text_content = self.format_game_history_text(game_config, agents, game_record)
         
         # 构造文本文件路径（将.json替换为.txt）
-        text_filepath = filepath.rsplit('.', 1)[0] + '.txt'
+        text_filepath = strip_extension(filepath) + '.txt'
         
         # 保存文本文件
         with open(text_filepath, "w", encoding="utf-8") as f:
@@ -450,3 +624,153 @@ class GameRecorder:
         
         print(f"游戏历史文本版本已保存到：{text_filepath}")
         return text_filepath
+
+
+def reasoning_by_type(agent_interactions):
+    """按交互类型汇总单个agent的reasoning（reasoning_summary 的内容）"""
+    reasoning_by_round = {}
+    for interaction in agent_interactions:
+        debug_label = interaction.get("debug_label", "未知")
+        reasoning = interaction.get("output", {}).get("reasoning")
+        estimated_others_avg_ratio = interaction.get("output", {}).get("estimated_others_avg_ratio")
+        output_ratio = interaction.get("output", {}).get("output_ratio")
+        if reasoning:
+            if debug_label not in reasoning_by_round:
+                reasoning_by_round[debug_label] = []
+            entry = {
+                "timestamp": interaction.get("timestamp"),
+                "reasoning": reasoning
+            }
+            # 如果有estimated_others_avg_ratio字段，也加入
+            if estimated_others_avg_ratio is not None:
+                entry["estimated_others_avg_ratio"] = estimated_others_avg_ratio
+            # 如果有output_ratio字段，也加入
+            if output_ratio is not None:
+                entry["output_ratio"] = output_ratio
+            reasoning_by_round[debug_label].append(entry)
+    return reasoning_by_round
+
+
+def load_game_history(path):
+    """读取游戏历史文件（pretty/compact、.json/.json.gz/.json.zst 均可），返回与 pretty 格式相同结构的记录"""
+    game_record = load_record(path)
+    if "reasoning_summary" not in game_record:
+        game_record["reasoning_summary"] = {
+            agent_id: {
+                "agent_name": data["agent_name"],
+                "reasoning_by_type": reasoning_by_type(data["interactions"])
+            }
+            for agent_id, data in game_record.get("llm_interactions", {}).get("interactions_by_agent", {}).items()
+        }
+    return game_record
+
+
+def read_stream(path):
+    """读取流式记录的JSONL文件
+    
+    最后一行可能因进程崩溃而不完整，读取时忽略无法解析的末尾行
+    
+    Returns:
+        dict: game_start（开始记录）、rounds（每轮记录）、interactions（agent_id -> 交互记录列表）、
+              beliefs（agent_id -> 信念记忆列表）、game_end（结束记录，未正常结束时为None）
+    """
+    stream = {"game_start": None, "rounds": [], "interactions": {}, "beliefs": {}, "game_end": None}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            kind = event.get("type")
+            if kind == "game_start":
+                stream["game_start"] = event
+            elif kind == "round":
+                stream["rounds"].append(event["round"])
+            elif kind == "interaction":
+                stream["interactions"].setdefault(event["agent_id"], []).append(event["interaction"])
+            elif kind == "belief":
+                stream["beliefs"].setdefault(event["agent_id"], []).append(event["belief"])
+            elif kind == "game_end":
+                stream["game_end"] = event
+    return stream
+
+
+def load_stream_record(path):
+    """由JSONL文件（包括进程崩溃后留下的文件）组装完整的游戏记录
+    
+    Returns:
+        tuple: (game_config, game_record, interrupted, started_at)
+    """
+    stream = read_stream(path)
+    if stream["game_start"] is None:
+        raise ValueError(f"{path} 中没有游戏开始记录")
+    start = stream["game_start"]
+    end = stream["game_end"]
+    rounds = stream["rounds"]
+    if end is not None:
+        game_config = end["game_config"]
+        interrupted = end["game_status"] == "interrupted"
+    else:
+        # 进程未正常结束：按已完成的轮次保存为中断记录
+        config = start["game_config"]
+        game_config = {
+            "game_id": start.get("game_id"),
+            "model": config.get("model"),
+            "provider": config.get("provider", "openai"),
+            "personality_type": config.get("personality_type"),
+            "endowment": config.get("endowment"),
+            "r": config.get("r"),
+            "rounds": config.get("rounds"),
+            "num_players": len(start["agents"]),
+            "reveal_mode": config.get("reveal_mode"),
+            "completed_rounds": len(rounds),
+            "final_decisions": None,
+            "anchor_ratio": config.get("anchor_ratio", None),
+            "instruction_type": config.get("instruction_type", "certain")
+        }
+        interrupted = True
+    final_decisions = game_config.get("final_decisions") or {}
+    agent_records = []
+    interactions = []
+    for agent in start["agents"]:
+        history = [entry for round_record in rounds for entry in round_record["agents"] if entry["id"] == agent["id"]]
+        if history:
+            # 与 Agent.record_round_data / update_memory 的结算方式一致
+            last = history[-1]
+            if agent["is_anchor"]:
+                current_total_money = int(round(last["total_money_before_round"] - last["contribution"] + last["payoff"]))
+            else:
+                current_total_money = int(round(last["payoff"]))
+        else:
+            current_total_money = start["game_config"].get("endowment")
+        agent_records.append({
+            "id": agent["id"],
+            "name": agent["name"],
+            "personality_type": agent["personality_type"],
+            "is_anchor": agent["is_anchor"],
+            "game_history": history,
+            "belief_memory": stream["beliefs"].get(agent["id"], []),
+            "current_total_money": current_total_money,
+            "final_decision": final_decisions.get(agent["id"]) if final_decisions else None
+        })
+        interactions.append((agent["id"], agent["name"], agent["personality_type"],
+                             stream["interactions"].get(agent["id"], [])))
+    game_record = GameRecorder._build_game_record(game_config, rounds, agent_records, interactions, interrupted)
+    started_at = datetime.fromisoformat(start["timestamp"]).timestamp() if start.get("timestamp") else None
+    return game_config, game_record, interrupted, started_at
+
+
+def compact_stream(path, output_dir=None):
+    """由JSONL文件（包括进程崩溃后留下的文件）离线生成完整的JSON/TXT游戏记录
+    
+    Args:
+        path: JSONL文件路径
+        output_dir: 输出目录（默认为JSONL所在目录的上一级，即游戏的输出目录）
+    """
+    game_config, game_record, interrupted, started_at = load_stream_record(path)
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+    recorder = GameRecorder(output_dir=output_dir)
+    if started_at is not None:
+        recorder.started_at = started_at
+    return recorder._write_game_record(game_config, game_record, interrupted, len(game_record["agents"]))
@@ -0,0 +1,169 @@
+"""
+小组决策模式
+
+默认每个非anchor玩家每轮单独调用一次LLM做投入决策，而各次请求中的游戏规则和历史信息大部分相同。
+小组决策模式下，GameController 把非anchor玩家按座次每 group_size 人分为一组，每组只发出一次结构化输出请求：
+游戏规则和（公开模式下的）所有玩家历史只出现一次，每名玩家附上自己的性格设定（get_current_system_prompt）、
+当前金额和历史，模型返回每名玩家的 {estimated_others_avg_ratio, output, output_ratio, reasoning}。
+
+结果按玩家拆分后与单独调用时一样记录为各自的"决策阶段"交互（reasoning、估计比例、投入金额都写入该玩家），
+每条交互的 group 字段记录同一次请求的 call_id 和组员。模型漏掉某名玩家或输出无法解析时，该玩家改为单独调用。
+"""
+
+import datetime
+import json
+import uuid
+from llm_retry import LLMCallError
+from llm_schemas import group_decision_model
+from llm_usage import result_usage
+from profiling import profiled
+
+# 支持结构化输出的提供商（其他提供商只按文本解析JSON）
+_STRUCTURED_PROVIDERS = ["openai", "gemini", "deepseek", "fake"]
+
+
+@profiled("agent.build_prompt")
+def build_group_request(members, round_number, r, mode, history_view):
+    """构建一组玩家的 (messages, structured_output)
+
+    Args:
+        members: 组内的智能体（按座次）
+        round_number: 当前轮数
+        r: 公共池倍数
+        mode: 信息模式 ("public" 或 "anonymous")
+        history_view: GameController 增量维护的 HistoryAggregates
+    """
+    leader = members[0]
+    instruction_type = leader.game_config.get("instruction_type", "certain")
+    total_rounds = leader.game_config.get("rounds", 10)
+    if instruction_type == "certain":
+        round_info = f"当前第 {round_number} 轮，总共有 {total_rounds} 轮"
+    else:  # uncertain
+        round_info = f"当前第 {round_number} 轮，游戏将持续若干轮，可能在任意一轮结束"
+
+    system_prompt = f"""你将同时为以下 {len(members)} 名玩家分别做出本轮公共品博弈的投入决策。
+每名玩家有各自的性格设定、当前金额和历史记录。请严格以每名玩家自己的身份和信息独立决策，
+不要让玩家之间共享信息或互相协调。"""
+
+    user_prompt = f"""游戏规则：
+- {round_info}
+- 每名玩家可将自己当前的全部代币（包括初始禀赋和之前的收益）投入公共池，投入范围：0 到该玩家的当前金额
+- 本轮公共池由所有玩家的投入累积形成
+- 公共池总额 × {r} 后，将平均分配给所有玩家"""
+    if round_number > 1 and mode == "public":
+        # 公开模式下所有玩家看到的历史相同，只写一次
+        user_prompt += history_view.public_block()
+
+    for member in members:
+        user_prompt += f"""
+
+【玩家{member.id}】
+性格设定：{member.get_current_system_prompt()}
+当前金额：{member.current_total_money}，投入范围：0 到 {member.current_total_money}"""
+        if round_number > 1:
+            user_prompt += f"\n该玩家的历史投入：{member._format_own_history(round_number)}"
+            if mode == "anonymous":
+                user_prompt += history_view.others_block(member.id, mode)
+
+    user_prompt += f"""
+
+请为上面的每名玩家分别完成以下任务：
+1. 估计其他玩家本轮的平均投入比例（0-100%之间，基于历史表现和当前情况）
+2. 决定该玩家本轮的具体投入金额（必须在0到该玩家当前金额之间的整数）
+3. 说明该玩家的完整决策理由（包括：如何认知其他玩家的行为、考虑的边际收益和风险、以及博弈策略）
+按上面的玩家顺序在 decisions 中为每名玩家输出一项，player_id 填写玩家编号。"""
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    structured_output = group_decision_model(max(member.current_total_money for member in members))
+    if leader.provider in _STRUCTURED_PROVIDERS:
+        return messages, structured_output
+    return messages, None
+
+
+def _parse_decisions(content):
+    """把小组请求的输出解析为 {player_id: decision}，无法解析时返回空字典"""
+    try:
+        decisions = json.loads(content)["decisions"]
+        return {str(decision["player_id"]): decision for decision in decisions}
+    except (TypeError, ValueError, KeyError):
+        return {}
+
+
+def _distribute(members, messages, structured_output, start_time, outcome):
+    """把一次小组请求的结果拆分记录到各玩家
+
+    Returns:
+        tuple: ({player_id: 投入金额}, 需要单独调用的玩家列表)
+    """
+    result, error, attempts, queue_seconds, cache_status = outcome
+    group = {"call_id": uuid.uuid4().hex[:12], "leader": members[0].id, "members": [member.id for member in members]}
+    if error is not None:
+        # 每名玩家都记录这次失败，然后与单独调用一样抛出 LLMCallError
+        failure = None
+        for member in members:
+            try:
+                member._finish_call(messages, "决策阶段", structured_output, start_time, None, error, attempts,
+                                    queue_seconds, cache_status, group=group)
+            except LLMCallError as e:
+                failure = failure or e
+        raise failure
+    decisions = _parse_decisions(result[0])
+    # 整次请求的token用量只记在第一个得到决策的组员的交互上（缺少决策的组员改为单独调用，不记录这次请求），避免汇总时重复计算
+    carrier = next((member for member in members if member.id in decisions), None)
+    if carrier is not None:
+        # 调用指标按 leader 计数一次，与记录用量的组员保持一致
+        group["leader"] = carrier.id
+    contributions = {}
+    missing = []
+    for member in members:
+        decision = decisions.get(member.id)
+        if decision is None:
+            missing.append(member)
+            continue
+        member_result = (
+            str(decision.get("output")),
+            decision.get("reasoning"),
+            decision.get("estimated_others_avg_ratio"),
+            decision.get("output_ratio")
+        )
+        if member is carrier and result_usage(result):
+            member_result += (result_usage(result),)
+        answer = member._finish_call(messages, "决策阶段", structured_output, start_time, member_result, None, attempts,
+                                     queue_seconds, cache_status, group=group)
+        contributions[member.id] = member._parse_amount(answer, member.current_total_money)
+    if missing:
+        print(f"[group_decision.py] 小组决策的输出中缺少玩家 {', '.join(member.id for member in missing)}，改为单独调用")
+    return contributions, missing
+
+
+def decide_group(members, round_number, r, num_players, all_history=None, mode="public", avg_contrib_ratio=None,
+                 history_view=None):
+    """一次请求为一组玩家做出本轮投入决策，返回按 members 顺序排列的投入金额（参数同 Agent.decide_contribution）"""
+    leader = members[0]
+    messages, structured_output = build_group_request(members, round_number, r, mode, history_view)
+    start_time = datetime.datetime.now()
+    leader._print_prompt_debug(messages, "小组决策阶段", structured_output)
+    outcome = leader._execute_call(messages, structured_output)
+    contributions, missing = _distribute(members, messages, structured_output, start_time, outcome)
+    for member in missing:
+        contributions[member.id] = member.decide_contribution(round_number, r, num_players, all_history, mode,
+                                                              avg_contrib_ratio, history_view)
+    return [contributions[member.id] for member in members]
+
+
+async def adecide_group(members, round_number, r, num_players, all_history=None, mode="public", avg_contrib_ratio=None,
+                        history_view=None):
+    """decide_group 的异步版本"""
+    leader = members[0]
+    messages, structured_output = build_group_request(members, round_number, r, mode, history_view)
+    start_time = datetime.datetime.now()
+    leader._print_prompt_debug(messages, "小组决策阶段", structured_output)
+    outcome = await leader._aexecute_call(messages, structured_output)
+    contributions, missing = _distribute(members, messages, structured_output, start_time, outcome)
+    for member in missing:
+        contributions[member.id] = await member.adecide_contribution(round_number, r, num_players, all_history, mode,
+                                                                     avg_contrib_ratio, history_view)
+    return [contributions[member.id] for member in members]
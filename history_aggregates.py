@@ -0,0 +1,152 @@
+"""
+每轮增量维护的历史汇总，供智能体构建决策prompt
+
+GameController 在每轮结算后调用 add_round() 追加一轮数据：
+- 公开模式：每个玩家的历史投入行只追加本轮的一段文本，不再对每个智能体重复格式化所有玩家的所有轮次
+- 匿名模式：记录每轮所有玩家的投入总额和投入范围总额，某个玩家看到的"他人"数据用留一法（总额减去自己）得到
+
+生成的文本与 Agent 中逐轮遍历 all_history 的旧实现逐字一致。
+"""
+
+
+class HistoryAggregates:
+    def __init__(self, player_ids, endowment):
+        """
+        Args:
+            player_ids: 按座次排列的玩家id列表
+            endowment: 初始禀赋（缺少投入范围记录时作为第1轮的投入范围）
+        """
+        self.player_ids = list(player_ids)
+        self.endowment = endowment
+        self._index = {player_id: i for i, player_id in enumerate(self.player_ids)}
+        self.rounds = 0
+        # 公开模式：每个玩家一行 "\n玩家{id}: 第1轮:...(..%) 第2轮:..."，逐轮追加
+        self._public_lines = [f"\n玩家{player_id}: " for player_id in self.player_ids]
+        # 每轮每个玩家的 (投入, 匿名汇总使用的投入范围, total_money_before_round)，缺失时为None
+        self._rows = []
+        # 每轮汇总：(投入总额, 有效投入范围总额, 有效投入范围人数)
+        self._totals = []
+        # 每轮汇总：(人数, 投入范围总额, 有投入范围记录的人数)，用于计算他人平均值
+        self._sums = []
+
+    @classmethod
+    def from_histories(cls, player_ids, endowment, histories):
+        """由各玩家已有的history（player_id -> 每轮数据列表）重建汇总"""
+        aggregates = cls(player_ids, endowment)
+        num_rounds = min((len(histories[player_id]) for player_id in player_ids), default=0)
+        for r in range(num_rounds):
+            aggregates.add_round([histories[player_id][r] for player_id in player_ids])
+        return aggregates
+
+    def _init_amount(self, entry, round_number):
+        """本轮投入范围：优先用init_amount，没有则用total_money_before_round，再没有用endowment（仅第1轮）"""
+        init_amt = entry.get('init_amount', None)
+        if init_amt is None:
+            init_amt = entry.get('total_money_before_round', None)
+        if init_amt is None and round_number == 1:
+            init_amt = self.endowment
+        return init_amt
+
+    def add_round(self, agents_data):
+        """追加一轮数据
+
+        Args:
+            agents_data: 本轮每个玩家的数据（record_round_data 的返回值），需包含 id 和 contribution
+        """
+        self.rounds += 1
+        r = self.rounds
+        row = [None] * len(self.player_ids)
+        round_total = 0
+        round_init_total = 0
+        round_count = 0
+        total_before_sum = 0
+        total_before_count = 0
+        for entry in agents_data:
+            i = self._index[entry['id']]
+            contrib = entry['contribution']
+            if 'total_money_before_round' in entry:
+                total_before = entry['total_money_before_round']
+                ratio = (contrib / total_before * 100) if total_before > 0 else 0
+                self._public_lines[i] += f"第{r}轮:{contrib}/{total_before}({ratio:.1f}%) "
+                total_before_sum += total_before
+                total_before_count += 1
+            else:
+                self._public_lines[i] += f"第{r}轮:{contrib} "
+            init_amt = self._init_amount(entry, r)
+            row[i] = (contrib, init_amt, entry.get('total_money_before_round'))
+            round_total += contrib
+            if init_amt is not None and init_amt > 0:
+                round_init_total += init_amt
+                round_count += 1
+        self._rows.append(row)
+        self._totals.append((round_total, round_init_total, round_count))
+        self._sums.append((len(agents_data), total_before_sum, total_before_count))
+
+    def _others_round_totals(self, player_id, r):
+        """第r轮除player_id以外玩家的 (投入总额, 有效投入范围总额, 有效人数)"""
+        round_total, round_init_total, round_count = self._totals[r - 1]
+        own = self._rows[r - 1][self._index[player_id]] if player_id in self._index else None
+        if own is not None:
+            contrib, init_amt, _ = own
+            round_total -= contrib
+            if init_amt is not None and init_amt > 0:
+                round_init_total -= init_amt
+                round_count -= 1
+        return round_total, round_init_total, round_count
+
+    def others_block(self, player_id, mode):
+        """决策prompt中"其他玩家"部分的文本（round_number > 1 时使用）"""
+        if self.rounds == 0:
+            return ""
+        if mode == "public":
+            # 公开模式：显示所有玩家所有轮次的贡献
+            i = self._index.get(player_id)
+            if i is None:
+                others = "".join(self._public_lines)
+            else:
+                others = "".join(self._public_lines[:i]) + "".join(self._public_lines[i + 1:])
+            return f"\n\n其他玩家历史投入：{others}"
+        # 匿名模式：显示每轮他人平均贡献比例
+        lines = ["\n\n其他玩家汇总信息："]
+        for r in range(1, self.rounds + 1):
+            round_total, round_init_total, round_count = self._others_round_totals(player_id, r)
+            if round_count > 0 and round_init_total > 0:
+                avg_contrib_ratio = (round_total / round_init_total) * 100
+                lines.append(f"\n  第{r}轮: 他人平均贡献比例{avg_contrib_ratio:.1f}%")
+            else:
+                lines.append(f"\n  第{r}轮: 他人平均贡献比例--%")
+        return "".join(lines)
+
+    def public_block(self):
+        """公开模式下所有玩家（不排除任何人）的历史投入，供小组决策的共享部分使用"""
+        if self.rounds == 0:
+            return ""
+        return f"\n\n所有玩家历史投入：{''.join(self._public_lines)}"
+
+    def round_entries(self, r, exclude=None):
+        """第r轮各玩家的 (player_id, 投入, 投入范围)，投入范围缺失时为None"""
+        return [
+            (player_id, row[0], row[2])
+            for player_id, row in zip(self.player_ids, self._rows[r - 1])
+            if row is not None and player_id != exclude
+        ]
+
+    def others_average(self, player_id, r):
+        """第r轮除player_id以外玩家的 (平均投入, 平均投入范围)
+
+        没有其他玩家的数据时返回None；有玩家缺少投入范围记录时平均投入范围为None
+        """
+        count, total_before_sum, total_before_count = self._sums[r - 1]
+        contrib_total = self._totals[r - 1][0]
+        own = self._rows[r - 1][self._index[player_id]] if player_id in self._index else None
+        if own is not None:
+            contrib, _, total_before = own
+            count -= 1
+            contrib_total -= contrib
+            if total_before is not None:
+                total_before_sum -= total_before
+                total_before_count -= 1
+        if count <= 0:
+            return None
+        avg_total = total_before_sum / total_before_count if total_before_count == count else None
+        return contrib_total / count, avg_total
@@ -0,0 +1,143 @@
+"""
+游戏历史文件的编码格式
+
+- pretty：缩进的JSON（原格式，便于直接阅读）
+- compact：压缩的JSON，可选 gzip / zstd 压缩、orjson 序列化，以及字符串表去重：
+  长文本按段落（"\\n\\n" 分隔）拆分后存入字符串表，system prompt、规则说明等在每次调用中重复出现的段落只保存一次；
+  段落引用写作 {"$p": [...]}，记录中本身以 "$" 开头的键编码时再加一个 "$"，因此不会与段落引用混淆
+
+读取统一使用 load_record()，按扩展名和内容自动识别格式。
+"""
+
+import gzip
+import json
+
+COMPACT_FORMAT = "pgg-compact/2"
+# 不转义 "$" 开头的键的旧版本，仍可读取
+_LEGACY_COMPACT_FORMAT = "pgg-compact/1"
+# 字符串表只收录不短于该长度的段落
+_MIN_INTERN_LENGTH = 32
+_PARAGRAPH_SEPARATOR = "\n\n"
+
+
+def _zstd():
+    """zstd 为可选依赖（pip install zstandard）"""
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("使用 zstd 压缩需要安装 zstandard：pip install zstandard")
+    return zstandard
+
+
+def file_extension(compression=None):
+    """对应压缩方式的文件扩展名"""
+    return {None: ".json", "gzip": ".json.gz", "zstd": ".json.zst"}[compression]
+
+
+def strip_extension(path):
+    """去掉 .json / .json.gz / .json.zst 扩展名"""
+    for ext in (".json.gz", ".json.zst", ".json"):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path.rsplit('.', 1)[0]
+
+
+class StringTable:
+    """段落级字符串表"""
+
+    def __init__(self):
+        self.strings = []
+        self._index = {}
+
+    def intern(self, text):
+        index = self._index.get(text)
+        if index is None:
+            index = len(self.strings)
+            self._index[text] = index
+            self.strings.append(text)
+        return index
+
+    def encode(self, obj):
+        """把长字符串替换为 {"$p": [段落序号, ...]}，并转义 "$" 开头的键"""
+        if isinstance(obj, str):
+            if len(obj) < _MIN_INTERN_LENGTH:
+                return obj
+            return {"$p": [self.intern(part) for part in obj.split(_PARAGRAPH_SEPARATOR)]}
+        if isinstance(obj, dict):
+            return {_escape_key(key): self.encode(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.encode(value) for value in obj]
+        return obj
+
+
+def _escape_key(key):
+    return "$" + key if isinstance(key, str) and key.startswith("$") else key
+
+
+def _unescape_key(key):
+    return key[1:] if key.startswith("$") else key
+
+
+def _decode(obj, strings, escaped=True):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and "$p" in obj:
+            return _PARAGRAPH_SEPARATOR.join(strings[i] for i in obj["$p"])
+        return {(_unescape_key(key) if escaped else key): _decode(value, strings, escaped) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(value, strings, escaped) for value in obj]
+    return obj
+
+
+def _serialize(obj, serializer, pretty):
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    if serializer == "orjson":
+        try:
+            import orjson
+        except ImportError:
+            orjson = None
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_record(record, pretty=True, compression=None, serializer="json", string_table=False):
+    """把游戏记录编码为文件内容（bytes）
+
+    Args:
+        record: 游戏记录
+        pretty: 是否使用缩进的JSON（pretty 模式下忽略 serializer 和 string_table）
+        compression: None / "gzip" / "zstd"
+        serializer: "json" 或 "orjson"（未安装 orjson 时回退为 json）
+        string_table: 是否使用段落级字符串表去重
+    """
+    if string_table and not pretty:
+        table = StringTable()
+        encoded = table.encode(record)
+        record = {"format": COMPACT_FORMAT, "strings": table.strings, "record": encoded}
+    data = _serialize(record, serializer, pretty)
+    if compression == "gzip":
+        data = gzip.compress(data, compresslevel=6)
+    elif compression == "zstd":
+        data = _zstd().ZstdCompressor(level=10).compress(data)
+    return data
+
+
+def dump_record(record, path, **options):
+    """写出游戏记录（path 的扩展名应与 compression 对应，见 file_extension；options 同 encode_record）"""
+    with open(path, "wb") as f:
+        f.write(encode_record(record, **options))
+
+
+def load_record(path):
+    """读取任意格式的游戏记录文件"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".gz"):
+        data = gzip.decompress(data)
+    elif path.endswith(".zst"):
+        data = _zstd().ZstdDecompressor().decompress(data)
+    record = json.loads(data.decode("utf-8"))
+    if isinstance(record, dict) and record.get("format") in (COMPACT_FORMAT, _LEGACY_COMPACT_FORMAT):
+        record = _decode(record["record"], record["strings"], escaped=record["format"] == COMPACT_FORMAT)
+    return record
@@ -0,0 +1,432 @@
+"""
+批处理（Batch API）执行模式
+
+交互式模式下每个智能体的每次调用都单独发出请求。批处理模式下，一轮中的每个阶段（投入决策、信念更新）
+以及最终决策中所有智能体的请求被打包为一个批处理任务：提交 → 轮询 → 按 custom_id 把结果分发回各智能体。
+提供商的批处理接口价格更低、限额更高，适合对延迟不敏感的大规模实验。
+
+多局游戏在同一进程中同步推进时（run_experiments --batch --lockstep N），各局同一时刻提交的阶段请求
+会在 collect_window 内合并为同一个批处理任务。
+
+后端（在 config.py 的 BATCH_CONFIG["backends"] 中按提供商选择）：
+- openai：OpenAI Batch API（/v1/responses），按模型拆分为多个任务
+- local：基于文件的本地替身，请求和结果写入 batch_dir 下的JSONL，由本进程逐条调用提供商完成（与交互式调用一样经过调度器限流和重试），
+  用于测试以及没有批处理接口的提供商
+
+批处理中失败或缺失的请求默认改为逐个交互式调用（含重试）。
+"""
+
+import contextvars
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from config import BATCH_CONFIG
+from llm_usage import normalize_usage
+
+
+class BatchItemError(RuntimeError):
+    """批处理任务中单个请求失败"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PreparedCall:
+    """一次待提交的LLM调用：请求内容，以及收到回答后由智能体执行的后续处理"""
+
+    def __init__(self, agent, messages, debug_label, structured_output, finish):
+        """
+        Args:
+            agent: 发出调用的智能体
+            messages: 消息列表
+            debug_label: 调用阶段标签（与交互式调用相同）
+            structured_output: 结构化输出模型（None 表示文本输出）
+            finish: 以回答内容为参数的处理函数，其返回值即该阶段的结果
+        """
+        self.agent = agent
+        self.messages = messages
+        self.debug_label = debug_label
+        self.structured_output = structured_output
+        self.finish = finish
+        self.custom_id = None
+        self.cache_key = None
+        self.start_time = None
+        self.value = None
+        # 创建调用时（所属游戏线程中）的上下文：同步推进多局游戏时其中绑定了该局的日志输出，
+        # 批处理的工作线程在其中执行这次调用，输出写入所属游戏的日志
+        self.context = contextvars.copy_context()
+
+    def complete(self, answer):
+        self.value = self.finish(answer)
+        return self.value
+
+
+def _notify(calls, message):
+    """在 calls 所属的每局游戏的上下文中各打印一次任务级别的消息"""
+    games = {}
+    for call in calls:
+        games.setdefault(call.agent.game_id, call)
+    for call in games.values():
+        call.context.run(print, message)
+
+
+def _write_jsonl(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def _read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LocalBatchBackend:
+    """基于文件的批处理替身：提交时写出 requests.jsonl，首次轮询时逐条调用提供商并写出 results.jsonl"""
+
+    name = "local"
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or BATCH_CONFIG["local_workers"]
+        self._jobs = {}   # 任务名 -> (任务目录, [PreparedCall, ...])
+
+    def submit(self, calls, job_dir):
+        _write_jsonl(os.path.join(job_dir, "requests.jsonl"), [
+            {
+                "custom_id": call.custom_id,
+                "provider": call.agent.provider,
+                "model": call.agent.model,
+                "messages": call.messages,
+                "structured_output": call.structured_output.__name__ if call.structured_output else None
+            }
+            for call in calls
+        ])
+        job_id = os.path.basename(job_dir)
+        self._jobs[job_id] = (job_dir, calls)
+        return job_id
+
+    def _respond(self, call):
+        """逐条调用与交互式调用一样经过调度器（限流、在途上限、公平排队）和重试策略，失败记为该行的错误"""
+        try:
+            result, error, _, _ = call.agent._scheduled_request(call.messages, call.structured_output)
+        except Exception as e:
+            error = e
+        if error is not None:
+            return {"custom_id": call.custom_id, "result": None, "error": f"{type(error).__name__}: {error}"}
+        return {"custom_id": call.custom_id, "result": list(result), "error": None}
+
+    def poll(self, job_id):
+        """处理整个任务，返回True表示已完成"""
+        job_dir, calls = self._jobs[job_id]
+        results_path = os.path.join(job_dir, "results.jsonl")
+        if not os.path.exists(results_path):
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(calls)))) as executor:
+                _write_jsonl(results_path, executor.map(lambda call: call.context.run(self._respond, call), calls))
+        return True
+
+    def results(self, job_id):
+        """返回 {custom_id: (结果元组, 错误)}"""
+        job_dir, _ = self._jobs.pop(job_id)
+        outcomes = {}
+        for entry in _read_jsonl(os.path.join(job_dir, "results.jsonl")):
+            if entry["error"] is None:
+                outcomes[entry["custom_id"]] = (tuple(entry["result"]), None)
+            else:
+                outcomes[entry["custom_id"]] = (None, BatchItemError(entry["error"]))
+        return outcomes
+
+    def cancel(self, job_id):
+        self._jobs.pop(job_id, None)
+
+
+class OpenAIBatchBackend:
+    """OpenAI Batch API：上传请求文件、创建任务、轮询状态并下载结果文件"""
+
+    name = "openai"
+    endpoint = "/v1/responses"
+    _finished = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, completion_window=None):
+        self.completion_window = completion_window or BATCH_CONFIG["completion_window"]
+        self._calls = {}     # 任务ID -> {custom_id: PreparedCall}
+        self._batches = {}   # 任务ID -> 最近一次查询到的任务状态
+
+    @property
+    def client(self):
+        from llm_clients import get_client
+        return get_client("openai")
+
+    def _request_line(self, call):
+        """与交互式调用（responses.parse / responses.create）相同的请求体"""
+        body = call.agent._openai_params(call.messages)
+        if call.structured_output:
+            from openai.lib._parsing._responses import type_to_text_format_param
+            body["text"] = {"format": type_to_text_format_param(call.structured_output)}
+        return {"custom_id": call.custom_id, "method": "POST", "url": self.endpoint, "body": body}
+
+    def submit(self, calls, job_dir):
+        path = os.path.join(job_dir, "requests.jsonl")
+        _write_jsonl(path, [self._request_line(call) for call in calls])
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=self.endpoint,
+            completion_window=self.completion_window,
+            metadata={"job": os.path.basename(job_dir)}
+        )
+        self._calls[batch.id] = {call.custom_id: call for call in calls}
+        with open(os.path.join(job_dir, "job.json"), "w", encoding="utf-8") as f:
+            json.dump({"backend": self.name, "batch_id": batch.id, "input_file_id": input_file.id}, f)
+        return batch.id
+
+    def poll(self, job_id):
+        batch = self.client.batches.retrieve(job_id)
+        self._batches[job_id] = batch
+        return batch.status in self._finished
+
+    @staticmethod
+    def _output_text(body):
+        parts = []
+        for item in body.get("output", []):
+            if item.get("type") != "message":
+                continue
+            for content in item.get("content", []):
+                if content.get("type") == "output_text":
+                    parts.append(content.get("text", ""))
+        return "".join(parts)
+
+    def _parse(self, call, body):
+        text = self._output_text(body)
+        if call.structured_output:
+            result = call.agent._parse_structured_response(call.structured_output.model_validate_json(text))
+        else:
+            result = (text, None, None, None)
+        return tuple(result) + (normalize_usage("openai", body.get("usage")),)
+
+    def results(self, job_id):
+        batch = self._batches.pop(job_id)
+        calls = self._calls.pop(job_id)
+        outcomes = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                call = calls.get(entry.get("custom_id"))
+                if call is None:
+                    continue
+                response = entry.get("response") or {}
+                status_code = response.get("status_code")
+                if entry.get("error") or status_code != 200:
+                    message = entry.get("error") or response.get("body", {}).get("error")
+                    outcomes[call.custom_id] = (None, BatchItemError(f"批处理请求失败: {message}", status_code))
+                    continue
+                try:
+                    outcomes[call.custom_id] = (self._parse(call, response["body"]), None)
+                except Exception as e:
+                    outcomes[call.custom_id] = (None, e)
+        for custom_id in calls:
+            outcomes.setdefault(custom_id, (None, BatchItemError(f"批处理任务状态为 {batch.status}，没有该请求的结果")))
+        return outcomes
+
+    def cancel(self, job_id):
+        self._calls.pop(job_id, None)
+        self._batches.pop(job_id, None)
+        try:
+            self.client.batches.cancel(job_id)
+        except Exception as e:
+            print(f"[llm_batch.py] 取消批处理任务 {job_id} 失败: {e}")
+
+
+BACKENDS = {
+    "local": LocalBatchBackend,
+    "openai": OpenAIBatchBackend
+}
+
+
+class _Group:
+    """同一时刻提交、合并为一批的请求"""
+
+    def __init__(self):
+        self.calls = []
+        self.participants = 0
+        self.created = time.monotonic()
+        self.closed = False
+        self.done = threading.Event()
+        self.outcomes = {}
+
+
+class BatchRunner:
+    """收集各阶段（及同步推进的各局游戏）的请求，提交批处理任务并等待结果"""
+
+    def __init__(self, config=None):
+        """
+        Args:
+            config: 批处理配置（默认使用 BATCH_CONFIG）
+        """
+        self.config = config if config is not None else BATCH_CONFIG
+        self._backends = {}
+        self._cond = threading.Condition()
+        self._group = None
+        self._participants = 0
+        self._sequence = 0
+
+    def register(self):
+        """一局游戏开始使用批处理（决定合并请求时需等待的游戏数）"""
+        with self._cond:
+            self._participants += 1
+
+    def unregister(self):
+        """一局游戏结束，不再等待它提交请求"""
+        with self._cond:
+            self._participants = max(0, self._participants - 1)
+            self._cond.notify_all()
+
+    def _backend(self, provider):
+        name = self.config["backends"].get(provider, "local")
+        if name not in self._backends:
+            self._backends[name] = BACKENDS[name]()
+        return self._backends[name]
+
+    def run(self, calls):
+        """提交请求并阻塞等待结果
+
+        Returns:
+            list: 与 calls 对应的 (结果元组, 错误, 批处理任务标识)
+        """
+        with self._cond:
+            if self._group is None:
+                self._group = _Group()
+            group = self._group
+            group.calls.extend(calls)
+            group.participants += 1
+            self._cond.notify_all()
+            # 等待其他游戏提交同一阶段的请求，人数到齐或超过 collect_window 后由最后一个到达者提交
+            while not group.closed:
+                remaining = self.config["collect_window"] - (time.monotonic() - group.created)
+                if group.participants >= self._participants or remaining <= 0:
+                    group.closed = True
+                    self._group = None
+                    leader = True
+                    break
+                self._cond.wait(timeout=remaining)
+            else:
+                leader = False
+        if leader:
+            try:
+                group.outcomes = self._execute(group.calls)
+            finally:
+                group.done.set()
+        else:
+            group.done.wait()
+        return [group.outcomes.get(call.custom_id, (None, BatchItemError("批处理任务执行失败"), None)) for call in calls]
+
+    def _execute(self, calls):
+        """按 (后端, 提供商, 模型, 输出目录) 拆分为多个任务，全部完成后返回 {custom_id: (结果, 错误, 任务标识)}
+
+        任务目录为各局游戏输出目录下的 batch_dir，与记录文件和溢出文件的位置一致
+        """
+        jobs = {}
+        for call in calls:
+            backend = self._backend(call.agent.provider)
+            output_dir = call.agent.game_config.get("output_dir", "game_history")
+            jobs.setdefault((backend.name, call.agent.provider, call.agent.model, output_dir), []).append(call)
+        pending = {}
+        outcomes = {}
+        for (backend_name, provider, model, output_dir), job_calls in jobs.items():
+            with self._cond:
+                self._sequence += 1
+                sequence = self._sequence
+            job_name = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{sequence:05d}_{uuid.uuid4().hex[:6]}"
+            job_dir = os.path.join(output_dir, self.config["batch_dir"], job_name)
+            os.makedirs(job_dir, exist_ok=True)
+            for index, call in enumerate(job_calls):
+                call.custom_id = f"{job_name}-{index}"
+            backend = self._backends[backend_name]
+            try:
+                job_id = backend.submit(job_calls, job_dir)
+            except Exception as e:
+                _notify(job_calls, f"[llm_batch.py] 提交批处理任务失败（{backend_name} {provider}/{model}）: {e}")
+                for call in job_calls:
+                    outcomes[call.custom_id] = (None, e, None)
+                if not self.config["keep_files"]:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            _notify(job_calls, f"[llm_batch.py] 已提交批处理任务 {job_id}（{backend_name} {provider}/{model}，{len(job_calls)} 个请求）")
+            pending[job_id] = (backend, job_calls, job_dir)
+
+        deadline = time.monotonic() + self.config["timeout"]
+        while pending:
+            for job_id, (backend, job_calls, job_dir) in list(pending.items()):
+                try:
+                    finished = backend.poll(job_id)
+                except Exception as e:
+                    _notify(job_calls, f"[llm_batch.py] 查询批处理任务 {job_id} 状态失败: {e}")
+                    continue
+                if not finished:
+                    continue
+                del pending[job_id]
+                results = backend.results(job_id)
+                for call in job_calls:
+                    result, error = results[call.custom_id]
+                    outcomes[call.custom_id] = (result, error, job_id)
+                if not self.config["keep_files"]:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+            if not pending:
+                break
+            if time.monotonic() >= deadline:
+                for job_id, (backend, job_calls, _) in pending.items():
+                    backend.cancel(job_id)
+                    for call in job_calls:
+                        outcomes[call.custom_id] = (None, BatchItemError(f"批处理任务 {job_id} 超时"), job_id)
+                break
+            time.sleep(self.config["poll_interval"])
+        return outcomes
+
+
+def run_batch_phase(calls, runner=None):
+    """以批处理方式执行一个阶段的调用，结果按 calls 顺序返回
+
+    命中响应缓存的调用不提交；批处理中失败的调用按 BATCH_CONFIG["fallback_interactive"] 改为交互式调用
+    """
+    runner = runner or get_batch_runner()
+    pending = [call for call in calls if not call.agent._begin_batch_call(call)]
+    if pending:
+        failed = []
+        for call, (result, error, job_id) in zip(pending, runner.run(pending)):
+            if error is not None and runner.config["fallback_interactive"]:
+                print(f"[llm_batch.py] 玩家 {call.agent.id} 的{call.debug_label}请求在批处理中失败（{error}），改为交互式调用")
+                failed.append(call)
+            else:
+                call.agent._finish_batch_call(call, result, error, job_id)
+        if failed:
+            with ThreadPoolExecutor(max_workers=min(runner.config["local_workers"], len(failed))) as executor:
+                list(executor.map(
+                    lambda call: call.context.run(
+                        lambda: call.complete(call.agent._call_llm(call.messages, call.debug_label, call.structured_output))
+                    ),
+                    failed
+                ))
+    return [call.value for call in calls]
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_batch_runner():
+    """进程内共享的批处理执行器（同一进程中的多局游戏据此合并请求）"""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = BatchRunner()
+        return _runner
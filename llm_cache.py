@@ -0,0 +1,138 @@
+"""
+LLM响应的持久化缓存
+
+以 (provider, model, messages, 结构化输出schema, salt) 的哈希为键，把成功的响应保存在SQLite中。
+SQLite 使用 WAL 模式，多个进程（run_experiments 的并行子进程）可以同时读写同一个缓存文件。
+缓存按存活时间和总大小淘汰，参数在 config.py 的 CACHE_CONFIG 中设置。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from config import CACHE_CONFIG
+from llm_schemas import model_schema
+
+
+def make_cache_key(provider, model, messages, structured_output=None, salt=None):
+    """计算请求的内容哈希"""
+    payload = {
+        "provider": provider,
+        "model": model,
+        "messages": messages,
+        "schema_name": structured_output.__name__ if structured_output else None,
+        "schema": model_schema(structured_output) if structured_output else None,
+        "salt": salt
+    }
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=None, max_age_days=None, max_bytes=None):
+        """
+        Args:
+            path: SQLite文件路径（默认 CACHE_CONFIG["path"]）
+            max_age_days: 缓存条目最长保留天数（None 表示不过期）
+            max_bytes: 缓存内容总大小上限（字节，None 表示不限制）
+        """
+        self.path = path or CACHE_CONFIG["path"]
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._puts = 0
+        self._puts_lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " provider TEXT, model TEXT,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        conn.commit()
+
+    def _conn(self):
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """读取缓存，未命中或已过期返回None"""
+        conn = self._conn()
+        row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        now = time.time()
+        if self.max_age and now - created_at > self.max_age:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.commit()
+            return None
+        conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        conn.commit()
+        return json.loads(value)
+
+    def put(self, key, provider, model, value):
+        """写入缓存，每写入 evict_every 条检查一次淘汰"""
+        text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, provider, model, value, size, created_at, last_access)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, provider, model, text, len(text.encode("utf-8")), now, now)
+        )
+        conn.commit()
+        with self._puts_lock:
+            self._puts += 1
+            should_evict = self._puts % CACHE_CONFIG["evict_every"] == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        """删除过期条目；总大小超过上限时按最近访问时间从旧到新删除"""
+        conn = self._conn()
+        if self.max_age:
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+        if self.max_bytes:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                rows = conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+                stale = []
+                for key, size in rows:
+                    if excess <= 0:
+                        break
+                    stale.append((key,))
+                    excess -= size
+                conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        conn.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """获取进程内共享的缓存实例"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                max_age_days=CACHE_CONFIG["max_age_days"],
+                max_bytes=CACHE_CONFIG["max_bytes"]
+            )
+        return _cache
@@ -0,0 +1,144 @@
+"""
+LLM提供商客户端注册表
+
+同一进程内按 (provider, base_url, api_key) 共享客户端，所有智能体复用同一个连接池，
+避免每个智能体各自建立HTTP连接和TLS握手。连接池大小和keep-alive参数在 config.py 的
+CLIENT_POOL_CONFIG 中设置。
+"""
+
+import sys
+import threading
+import weakref
+import asyncio
+from config import API_KEYS, CLIENT_POOL_CONFIG
+
+# 各提供商的默认API地址（None 表示使用SDK默认值）
+PROVIDER_BASE_URLS = {
+    "openai": None,
+    "zhipuai": None,
+    "gemini": None,
+    "deepseek": "https://api.deepseek.com"
+}
+
+_lock = threading.Lock()
+_clients = {}                                  # (provider, base_url, api_key) -> 同步客户端
+_async_clients = weakref.WeakKeyDictionary()   # 事件循环 -> {(provider, base_url, api_key): 异步客户端}
+
+
+def _resolve(provider, api_key=None, base_url=None):
+    """补全默认的api_key和base_url，返回注册表的键"""
+    if api_key is None:
+        api_key = API_KEYS.get(provider)
+    if base_url is None:
+        base_url = PROVIDER_BASE_URLS.get(provider)
+    return (provider, base_url, api_key)
+
+
+def _sdk_httpx(default_http_client_cls):
+    """返回SDK默认HTTP客户端所基于的httpx模块（不同版本的SDK可能使用不同的httpx实现）"""
+    return sys.modules[default_http_client_cls.__mro__[1].__module__.split(".")[0]]
+
+
+def _pool_kwargs(httpx_module):
+    """构造传给HTTP客户端的连接池和超时参数"""
+    return {
+        "limits": httpx_module.Limits(
+            max_connections=CLIENT_POOL_CONFIG["max_connections"],
+            max_keepalive_connections=CLIENT_POOL_CONFIG["max_keepalive_connections"],
+            keepalive_expiry=CLIENT_POOL_CONFIG["keepalive_expiry"]
+        ),
+        "timeout": CLIENT_POOL_CONFIG["timeout"]
+    }
+
+
+def _create_client(provider, base_url, api_key):
+    if provider in ["openai", "deepseek"]:
+        import openai
+        return openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=openai.DefaultHttpxClient(**_pool_kwargs(_sdk_httpx(openai.DefaultHttpxClient)))
+        )
+    elif provider == "zhipuai":
+        import httpx
+        from zhipuai import ZhipuAI
+        return ZhipuAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=httpx.Client(**_pool_kwargs(httpx))
+        )
+    elif provider == "gemini":
+        return _create_gemini_client(base_url, api_key)
+    return None
+
+
+def _create_gemini_client(base_url, api_key):
+    """创建 genai.Client，连接池参数与其他提供商一致；HttpOptions 的超时以毫秒为单位"""
+    import httpx
+    from google import genai
+    from google.genai import types
+    client_args = {"limits": _pool_kwargs(httpx)["limits"]}
+    try:
+        http_options = types.HttpOptions(
+            base_url=base_url,
+            timeout=int(CLIENT_POOL_CONFIG["timeout"] * 1000),
+            client_args=client_args,
+            async_client_args=client_args
+        )
+    except Exception:
+        # 旧版SDK不支持自定义连接池参数
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+
+def get_client(provider, api_key=None, base_url=None):
+    """获取（必要时创建）共享的同步客户端，不支持的提供商返回None"""
+    key = _resolve(provider, api_key, base_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _create_client(*key)
+            if client is not None:
+                _clients[key] = client
+        return client
+
+
+def get_async_client(provider, api_key=None, base_url=None):
+    """获取当前事件循环下共享的异步客户端，必须在协程中调用
+
+    异步连接绑定在创建它的事件循环上，因此每个事件循环各自持有一组客户端。
+    没有原生异步客户端的提供商返回None。
+    """
+    key = _resolve(provider, api_key, base_url)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is not None:
+            return client
+    if provider in ["openai", "deepseek"]:
+        import openai
+        client = openai.AsyncOpenAI(
+            api_key=key[2],
+            base_url=key[1],
+            http_client=openai.DefaultAsyncHttpxClient(**_pool_kwargs(_sdk_httpx(openai.DefaultAsyncHttpxClient)))
+        )
+    elif provider == "gemini":
+        # 不复用共享同步客户端的 .aio：其异步连接池在进程内共享，会跨事件循环使用
+        client = _create_gemini_client(key[1], key[2]).aio
+    else:
+        return None
+    with _lock:
+        return loop_clients.setdefault(key, client)
+
+
+async def aclose_async_clients():
+    """关闭当前事件循环下创建的异步客户端（在事件循环关闭前调用）"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        loop_clients = _async_clients.pop(loop, {})
+    for (provider, _, _), client in loop_clients.items():
+        if provider in ["openai", "deepseek"]:
+            await client.close()
+        elif provider == "gemini" and hasattr(client, "aclose"):
+            await client.aclose()
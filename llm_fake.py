@@ -0,0 +1,103 @@
+"""
+确定性的进程内假提供商（provider = "fake"）
+
+不访问任何API，按请求内容的哈希生成合法的结构化输出，相同的请求总是得到相同的回答；
+可配置的固定延迟和抖动模拟网络往返，用于端到端基准测试（benchmarks/bench_end_to_end.py）和性能分析。
+- 投入决策：投入比例由 (玩家, 消息) 的哈希决定，金额不超过玩家当前金额
+- 小组决策：按prompt中的【玩家X】…当前金额 为每名组员生成一项
+- 最终决策：金额不超过结构化输出模型中的上限
+- 信念更新等文本请求：返回固定的自我反思文本
+同时返回按字符数估算的token用量，使用量统计、费用和指标的代码路径与真实提供商一致。
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import time
+from config import FAKE_PROVIDER_CONFIG, RATE_LIMIT_CONFIG
+
+_BELIEF_TEXT = "我会参考其他玩家的历史投入调整自己的投入，在保持合作的同时避免被长期搭便车。"
+_GROUP_MEMBER_PATTERN = re.compile(r"【玩家(\S+?)】.*?当前金额：(\d+)", re.S)
+
+
+def _unit(*parts):
+    """由内容哈希得到 [0, 1) 之间的确定性数值"""
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def _upper_bound(structured_output, field="output"):
+    """结构化输出模型中字段的 le 上限，没有时返回None"""
+    info = structured_output.model_fields.get(field)
+    for constraint in (info.metadata if info else []):
+        if getattr(constraint, "le", None) is not None:
+            return constraint.le
+    return None
+
+
+def _decision(seed, upper):
+    ratio = round(_unit(seed, "ratio") * 100, 1)
+    return {
+        "estimated_others_avg_ratio": round(_unit(seed, "estimate") * 100, 1),
+        "output": int(upper * ratio / 100),
+        "output_ratio": ratio,
+        "reasoning": f"综合其他玩家的历史投入和公共池收益，本轮投入约 {ratio}% 的当前金额。"
+    }
+
+
+def _usage(messages, output_text):
+    chars_per_token = RATE_LIMIT_CONFIG["chars_per_token"]
+    input_tokens = int(sum(len(message.get("content") or "") for message in messages) / chars_per_token)
+    output_tokens = int(len(output_text) / chars_per_token)
+    return {
+        "input_tokens": input_tokens,
+        "cached_input_tokens": 0,
+        "uncached_input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens
+    }
+
+
+def fake_response(agent, messages, structured_output=None):
+    """生成一次请求的结果，格式同 Agent._request_llm（不含延迟）"""
+    seed = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+    if not structured_output:
+        return _BELIEF_TEXT, None, None, None, _usage(messages, _BELIEF_TEXT)
+    if "decisions" in structured_output.model_fields:
+        members = _GROUP_MEMBER_PATTERN.findall(messages[-1]["content"])
+        payload = {"decisions": [dict(_decision((seed, player_id), int(amount)), player_id=player_id)
+                                 for player_id, amount in members]}
+    elif "output_ratio" in structured_output.model_fields:
+        payload = _decision((seed, agent.id), agent.current_total_money)
+    else:
+        upper = _upper_bound(structured_output)
+        upper = upper if upper is not None else agent.current_total_money
+        payload = {"reasoning": "最终一次性决策按公共池倍数和其他玩家的历史表现权衡。",
+                   "output": int(upper * _unit(seed, agent.id, "final"))}
+    output_text = json.dumps(payload, ensure_ascii=False)
+    result = agent._parse_structured_response(structured_output.model_validate_json(output_text))
+    return tuple(result) + (_usage(messages, output_text),)
+
+
+def fake_latency(agent, messages):
+    """本次请求的模拟延迟（秒）：固定延迟加上由请求内容决定的抖动"""
+    latency = agent.game_config.get("fake_latency", FAKE_PROVIDER_CONFIG["latency"])
+    jitter = agent.game_config.get("fake_jitter", FAKE_PROVIDER_CONFIG["jitter"])
+    if jitter:
+        latency += jitter * _unit(agent.id, len(messages), messages[-1].get("content", "")[-64:])
+    return latency
+
+
+def respond(agent, messages, structured_output=None):
+    delay = fake_latency(agent, messages)
+    if delay > 0:
+        time.sleep(delay)
+    return fake_response(agent, messages, structured_output)
+
+
+async def arespond(agent, messages, structured_output=None):
+    delay = fake_latency(agent, messages)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return fake_response(agent, messages, structured_output)
@@ -0,0 +1,317 @@
+"""
+LLM调用的指标
+
+每次LLM交互记录完成后（Agent._record_interaction）更新进程内共享的指标，标签为
+provider、model、debug_label（决策阶段、信念更新等）以及 outcome（success / cache_hit / 错误类型）：
+- pgg_llm_calls_total：调用次数
+- pgg_llm_retries_total：重试次数
+- pgg_llm_call_duration_seconds：调用耗时直方图（含排队、重试等待，批处理模式下含任务等待）
+- pgg_llm_queue_seconds：在调度器中等待限流/排队的时间直方图
+- pgg_llm_tokens_total：提供商报告的token数（kind 为 input / cached_input / output）
+小组决策中同一次请求只按组长计一次。
+
+导出方式：
+- Prometheus 文本格式：write_textfile() 写入 METRICS_CONFIG["textfile"]（可供 node_exporter 的 textfile collector 采集）
+- HTTP 端点：start_http_server(port) 在后台线程中提供 /metrics
+- 每局游戏结束时按该局的交互记录打印摘要（interaction_metrics，精确分位数），
+  批量实验结束时打印进程内直方图的摘要（summary，按桶线性插值估算分位数）
+"""
+
+import math
+import os
+import threading
+from config import METRICS_CONFIG
+
+_LABELS = ("provider", "model", "debug_label", "outcome")
+_PERCENTILES = (50, 95, 99)
+
+
+def _outcome(interaction):
+    if interaction.get("error_class"):
+        return interaction["error_class"]
+    return "cache_hit" if interaction.get("cache") == "hit" else "success"
+
+
+def _counts_call(agent_id, interaction):
+    """小组决策中同一次请求的各组员都有交互记录，只统计组长的一条"""
+    group = interaction.get("group")
+    return not group or agent_id is None or group.get("leader") == agent_id
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _quantile(q, buckets, counts, total):
+    """按桶计数线性插值估算分位数（与 Prometheus 的 histogram_quantile 相同），超出最大桶时返回最大桶上界"""
+    if total == 0:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for upper, count in zip(buckets, counts):
+        if cumulative + count >= rank and count > 0:
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = upper
+    return buckets[-1]
+
+
+def _percentile(sorted_values, q):
+    """精确分位数（最近秩法）"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.counts = [0] * len(buckets)
+        self.overflow = 0
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, buckets, value):
+        self.sum += value
+        self.count += 1
+        for i, upper in enumerate(buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                return
+        self.overflow += 1
+
+
+class MetricsRegistry:
+    """进程内共享的计数器和直方图"""
+
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets if buckets is not None else METRICS_CONFIG["buckets"])
+        self._lock = threading.Lock()
+        self.calls = {}       # (provider, model, debug_label, outcome) -> 次数
+        self.retries = {}     # 同上 -> 重试次数
+        self.tokens = {}      # (provider, model, debug_label, kind) -> token数
+        self.durations = {}   # (provider, model, debug_label, outcome) -> _Histogram
+        self.queue = {}       # 同上 -> _Histogram
+
+    def observe_interaction(self, interaction, agent_id=None):
+        """记录一条交互（字段同 Agent._record_interaction 生成的交互记录），agent_id 为交互所属的玩家"""
+        if not _counts_call(agent_id, interaction):
+            return
+        key = (interaction.get("provider"), interaction.get("model"), interaction.get("debug_label") or "",
+               _outcome(interaction))
+        usage = interaction.get("usage") or {}
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.retries[key] = self.retries.get(key, 0) + (interaction.get("retry_count") or 0)
+            self.durations.setdefault(key, _Histogram(self.buckets)).observe(
+                self.buckets, interaction.get("duration_seconds") or 0.0)
+            self.queue.setdefault(key, _Histogram(self.buckets)).observe(
+                self.buckets, interaction.get("queue_seconds") or 0.0)
+            for kind, field in (("input", "input_tokens"), ("cached_input", "cached_input_tokens"),
+                                ("output", "output_tokens")):
+                if usage.get(field):
+                    token_key = key[:3] + (kind,)
+                    self.tokens[token_key] = self.tokens.get(token_key, 0) + usage[field]
+
+    def snapshot(self):
+        """可序列化（pickle）的指标快照，用于把子进程的指标合并到主进程"""
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "calls": dict(self.calls),
+                "retries": dict(self.retries),
+                "tokens": dict(self.tokens),
+                "durations": {key: (list(h.counts), h.overflow, h.sum, h.count) for key, h in self.durations.items()},
+                "queue": {key: (list(h.counts), h.overflow, h.sum, h.count) for key, h in self.queue.items()}
+            }
+
+    def merge(self, snapshot):
+        """合并另一个进程的快照（桶边界必须相同）"""
+        if snapshot["buckets"] != self.buckets:
+            raise ValueError("指标快照的直方图桶边界与当前进程不同，无法合并")
+        with self._lock:
+            for name in ("calls", "retries", "tokens"):
+                target = getattr(self, name)
+                for key, value in snapshot[name].items():
+                    target[key] = target.get(key, 0) + value
+            for name in ("durations", "queue"):
+                target = getattr(self, name)
+                for key, (counts, overflow, total, count) in snapshot[name].items():
+                    histogram = target.setdefault(key, _Histogram(self.buckets))
+                    histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                    histogram.overflow += overflow
+                    histogram.sum += total
+                    histogram.count += count
+
+    def render_prometheus(self):
+        """Prometheus 文本格式（exposition format 0.0.4）"""
+        lines = []
+        with self._lock:
+            lines += ["# HELP pgg_llm_calls_total LLM调用次数", "# TYPE pgg_llm_calls_total counter"]
+            for key, value in sorted(self.calls.items()):
+                lines.append(f"pgg_llm_calls_total{_format_labels(_LABELS, key)} {value}")
+            lines += ["# HELP pgg_llm_retries_total LLM调用的重试次数", "# TYPE pgg_llm_retries_total counter"]
+            for key, value in sorted(self.retries.items()):
+                lines.append(f"pgg_llm_retries_total{_format_labels(_LABELS, key)} {value}")
+            lines += ["# HELP pgg_llm_tokens_total 提供商报告的token数", "# TYPE pgg_llm_tokens_total counter"]
+            for key, value in sorted(self.tokens.items()):
+                lines.append(f"pgg_llm_tokens_total{_format_labels(_LABELS[:3] + ('kind',), key)} {value}")
+            for name, help_text, histograms in (
+                ("pgg_llm_call_duration_seconds", "LLM调用耗时（秒）", self.durations),
+                ("pgg_llm_queue_seconds", "在调度器中等待限流/排队的时间（秒）", self.queue)
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for key, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for upper, count in zip(self.buckets, histogram.counts):
+                        cumulative += count
+                        labels = _format_labels(_LABELS + ("le",), key + (repr(float(upper)),))
+                        lines.append(f"{name}_bucket{labels} {cumulative}")
+                    labels = _format_labels(_LABELS + ("le",), key + ("+Inf",))
+                    lines.append(f"{name}_bucket{labels} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(_LABELS, key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(_LABELS, key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """按 (provider, model, debug_label) 汇总：调用数、错误率、重试次数、耗时分位数（按桶插值）、平均排队时间"""
+        rows = {}
+        with self._lock:
+            for key, histogram in self.durations.items():
+                row_key = key[:3]
+                row = rows.setdefault(row_key, {"calls": 0, "errors": 0, "retries": 0, "queue_sum": 0.0,
+                                                "counts": [0] * len(self.buckets), "overflow": 0})
+                row["calls"] += histogram.count
+                if key[3] not in ("success", "cache_hit"):
+                    row["errors"] += histogram.count
+                row["retries"] += self.retries.get(key, 0)
+                row["queue_sum"] += self.queue[key].sum
+                row["counts"] = [a + b for a, b in zip(row["counts"], histogram.counts)]
+                row["overflow"] += histogram.overflow
+        result = []
+        for (provider, model, debug_label), row in sorted(rows.items()):
+            result.append(_summary_row(provider, model, debug_label, row["calls"], row["errors"], row["retries"],
+                                       row["queue_sum"],
+                                       lambda q, row=row: _quantile(q, self.buckets, row["counts"], row["calls"])))
+        return result
+
+    def write_textfile(self, path=None):
+        """把 Prometheus 文本写入文件（先写临时文件再替换，避免采集到写了一半的内容）"""
+        path = path or METRICS_CONFIG["textfile"]
+        if not path:
+            return None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+        return path
+
+
+def _summary_row(provider, model, debug_label, calls, errors, retries, queue_sum, quantile):
+    row = {
+        "provider": provider,
+        "model": model,
+        "debug_label": debug_label,
+        "calls": calls,
+        "errors": errors,
+        "error_rate": errors / calls if calls else 0.0,
+        "retries": retries,
+        "mean_queue_seconds": queue_sum / calls if calls else 0.0
+    }
+    for p in _PERCENTILES:
+        row[f"p{p}_seconds"] = quantile(p / 100)
+    return row
+
+
+def interaction_metrics(interactions):
+    """按交互记录计算与 MetricsRegistry.summary 相同格式的摘要（精确分位数），用于单局游戏
+
+    Args:
+        interactions: [(agent_id, 交互记录), ...]
+    """
+    groups = {}
+    for agent_id, interaction in interactions:
+        if not _counts_call(agent_id, interaction):
+            continue
+        key = (interaction.get("provider"), interaction.get("model"), interaction.get("debug_label") or "")
+        groups.setdefault(key, []).append(interaction)
+    result = []
+    for (provider, model, debug_label), group in sorted(groups.items()):
+        durations = sorted(interaction.get("duration_seconds") or 0.0 for interaction in group)
+        errors = sum(1 for interaction in group if interaction.get("error_class"))
+        retries = sum(interaction.get("retry_count") or 0 for interaction in group)
+        queue_sum = sum(interaction.get("queue_seconds") or 0.0 for interaction in group)
+        result.append(_summary_row(provider, model, debug_label, len(group), errors, retries, queue_sum,
+                                   lambda q, durations=durations: _percentile(durations, q)))
+    return result
+
+
+def format_summary(rows, title="LLM调用指标"):
+    """把摘要格式化为文本表格"""
+    lines = [f"\n=== {title} ===",
+             f"{'提供商/模型':<32} {'阶段':<16} {'调用':>6} {'错误率':>7} {'重试':>5} "
+             f"{'p50(s)':>8} {'p95(s)':>8} {'p99(s)':>8} {'平均排队(s)':>11}"]
+    for row in rows:
+        percentiles = " ".join(
+            f"{row[f'p{p}_seconds']:>8.2f}" if row[f"p{p}_seconds"] is not None else f"{'-':>8}" for p in _PERCENTILES
+        )
+        lines.append(f"{row['provider'] + '/' + row['model']:<32} {row['debug_label']:<16} {row['calls']:>6} "
+                     f"{row['error_rate']:>7.1%} {row['retries']:>5} {percentiles} {row['mean_queue_seconds']:>11.2f}")
+    if not rows:
+        lines.append("（没有LLM调用）")
+    return "\n".join(lines)
+
+
+def start_http_server(port, registry=None):
+    """在后台线程中提供 http://0.0.0.0:<port>/metrics，返回 HTTPServer"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    registry = registry or get_metrics()
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[llm_metrics.py] 指标端点：http://localhost:{server.server_address[1]}/metrics")
+    return server
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """获取进程内共享的指标"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
+
+
+def reset_metrics():
+    """清空进程内的指标（run_experiments 的子进程每局游戏开始前调用，结束后把快照交给主进程合并）"""
+    global _metrics
+    with _metrics_lock:
+        _metrics = MetricsRegistry()
+        return _metrics
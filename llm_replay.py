@@ -0,0 +1,128 @@
+"""
+离线回放提供商
+
+从已保存的 game_history 记录（任意输出格式）中读取每个智能体的 llm_interactions，按记录回答 LLM 调用，
+无需访问任何API即可以CPU速度重新运行整局游戏，用于性能分析和可复现的回归测试。
+
+匹配规则：
+- 优先按 (智能体, 消息内容哈希) 匹配，同一哈希出现多次时按记录顺序依次使用
+- 哈希未命中时（例如修改了prompt构建代码）按该智能体的调用序号取对应记录
+- 小组决策的记录按 group.call_id 把各组员的结果重新组合为一次小组请求的输出
+"""
+
+import hashlib
+import json
+import threading
+from collections import defaultdict, deque
+from game_recorder import load_game_history
+
+
+class ReplayError(ValueError):
+    """回放记录中没有可用的响应（归类为不可重试的错误）"""
+
+
+def message_hash(messages):
+    """消息列表的内容哈希"""
+    text = json.dumps(messages, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ReplaySource:
+    def __init__(self, path):
+        """
+        Args:
+            path: 已保存的游戏历史JSON文件路径
+        """
+        self.path = path
+        self.game_record = load_game_history(path)
+        self._lock = threading.Lock()
+        self._sequences = {}                    # agent_id -> 按顺序排列的交互记录
+        self._by_hash = defaultdict(deque)      # (agent_id, 消息哈希) -> 交互记录序号队列
+        self._cursors = defaultdict(int)        # agent_id -> 下一次调用的序号
+        self._used = set()                      # 已回放的 (agent_id, 序号)
+        self._groups = defaultdict(dict)        # 小组决策的 call_id -> {agent_id: 交互记录序号}
+        interactions_by_agent = self.game_record.get("llm_interactions", {}).get("interactions_by_agent", {})
+        for agent_id, data in interactions_by_agent.items():
+            interactions = data.get("interactions", [])
+            self._sequences[agent_id] = interactions
+            for index, interaction in enumerate(interactions):
+                messages = interaction.get("input", {}).get("messages", [])
+                self._by_hash[(agent_id, message_hash(messages))].append(index)
+                if interaction.get("group"):
+                    self._groups[interaction["group"]["call_id"]][agent_id] = index
+
+    def game_config(self):
+        """原始游戏的配置"""
+        return dict(self.game_record.get("game_config", {}))
+
+    def anchor_ids(self):
+        """原始游戏中锚定智能体的id列表"""
+        return [agent["id"] for agent in self.game_record.get("agents", []) if agent.get("is_anchor")]
+
+    def respond(self, agent_id, messages):
+        """返回与一次调用对应的记录结果 (content, reasoning, estimated_others_avg_ratio, output_ratio)"""
+        with self._lock:
+            cursor = self._cursors[agent_id]
+            self._cursors[agent_id] += 1
+            candidates = self._by_hash.get((agent_id, message_hash(messages)))
+            index = None
+            while candidates:
+                candidate = candidates.popleft()
+                if (agent_id, candidate) not in self._used:
+                    index = candidate
+                    break
+            if index is None:
+                sequence = self._sequences.get(agent_id, [])
+                if cursor >= len(sequence) or (agent_id, cursor) in self._used:
+                    raise ReplayError(f"回放记录中没有玩家 {agent_id} 的第 {cursor + 1} 次调用")
+                index = cursor
+            self._used.add((agent_id, index))
+            interaction = self._sequences[agent_id][index]
+            if interaction.get("group"):
+                return self._group_response(interaction["group"])
+        output = interaction.get("output", {})
+        if output.get("status") == "error":
+            raise ReplayError(f"原始记录中该调用失败: {output.get('content')}")
+        return (
+            output.get("content"),
+            output.get("reasoning"),
+            output.get("estimated_others_avg_ratio"),
+            output.get("output_ratio")
+        )
+
+
+    def _group_response(self, group):
+        """由各组员的记录重新组合小组请求的输出（调用方已持有锁）"""
+        decisions = []
+        for member_id in group["members"]:
+            index = self._groups[group["call_id"]].get(member_id)
+            if index is None:
+                continue
+            if member_id != group["leader"]:
+                # 组员的记录随组长的请求一起回放
+                self._used.add((member_id, index))
+                self._cursors[member_id] += 1
+            output = self._sequences[member_id][index].get("output", {})
+            if output.get("status") == "error":
+                raise ReplayError(f"原始记录中该调用失败: {output.get('content')}")
+            decisions.append({
+                "player_id": member_id,
+                "estimated_others_avg_ratio": output.get("estimated_others_avg_ratio") or 0,
+                "output": int(output.get("content")),
+                "output_ratio": output.get("output_ratio") or 0,
+                "reasoning": output.get("reasoning") or ""
+            })
+        return json.dumps({"decisions": decisions}, ensure_ascii=False), None, None, None
+
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def get_replay_source(path, game_id=None):
+    """同一局游戏的所有智能体共享一个回放源（各局游戏的调用序号互不影响）"""
+    with _sources_lock:
+        key = (path, game_id)
+        if key not in _sources:
+            _sources[key] = ReplaySource(path)
+        return _sources[key]
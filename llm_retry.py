@@ -0,0 +1,123 @@
+"""
+LLM调用的重试策略
+
+把每次调用失败分为三类：
+- transient：网络错误、超时、5xx 等暂时性错误，指数退避后重试
+- rate_limited：429 / 配额耗尽，优先遵循服务端给出的 Retry-After，并让调度器暂停该提供商
+- permanent：参数错误、鉴权失败、模型不存在、结构化输出校验失败等确定性错误，不再重试
+
+参数在 config.py 的 RETRY_CONFIG 中设置。
+"""
+
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from config import RETRY_CONFIG
+
+TRANSIENT = "transient"
+RATE_LIMITED = "rate_limited"
+PERMANENT = "permanent"
+
+# 按异常类名识别（避免在这里导入各提供商的SDK）
+_TRANSIENT_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "InternalServerError", "ServerError",
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "ReadError", "WriteTimeout",
+    "PoolTimeout", "RemoteProtocolError", "TimeoutException", "APIReachLimitError"
+}
+_RATE_LIMIT_ERROR_NAMES = {"RateLimitError", "ResourceExhausted"}
+
+
+class LLMCallError(RuntimeError):
+    """LLM调用最终失败（重试次数耗尽或遇到不可重试的错误）"""
+
+    def __init__(self, message, error_class=None, attempts=0):
+        super().__init__(message)
+        self.error_class = error_class
+        self.attempts = attempts
+
+
+def _status_code(exc):
+    """尽量从异常中取出HTTP状态码"""
+    for attr in ("status_code", "code", "http_status"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def classify_error(exc):
+    """将异常归类为 transient / rate_limited / permanent"""
+    names = {cls.__name__ for cls in type(exc).__mro__}
+    status = _status_code(exc)
+    if names & _RATE_LIMIT_ERROR_NAMES or status == 429:
+        return RATE_LIMITED
+    if names & _TRANSIENT_ERROR_NAMES:
+        return TRANSIENT
+    if status is not None:
+        if status in (408, 409) or status >= 500:
+            return TRANSIENT
+        if 400 <= status < 500:
+            return PERMANENT
+    # 结构化输出解析/校验失败（JSONDecodeError、pydantic ValidationError 都是 ValueError 的子类）
+    # 以及不支持的提供商等编程错误，在 temperature=0 下重试也不会成功
+    if isinstance(exc, (ValueError, TypeError, KeyError, AttributeError)):
+        return PERMANENT
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return TRANSIENT
+    # 未知错误按暂时性错误处理
+    return TRANSIENT
+
+
+def retry_after_seconds(exc):
+    """读取服务端建议的重试等待时间（Retry-After / retry-after-ms / Gemini 的 retryDelay），没有则返回None"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers:
+        value = headers.get("retry-after-ms")
+        if value:
+            try:
+                return float(value) / 1000.0
+            except ValueError:
+                pass
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+    # Gemini 在错误详情中以 "retryDelay": "30s" 的形式给出
+    match = re.search(r"retryDelay['\"]?\s*[:=]\s*['\"]?([\d.]+)s", str(getattr(exc, "details", "") or exc))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, config=None):
+        """
+        Args:
+            config: 重试配置（默认使用 RETRY_CONFIG）
+        """
+        self.config = config if config is not None else RETRY_CONFIG
+
+    def next_delay(self, attempt, error_class, exc):
+        """第 attempt 次尝试失败后的等待秒数，返回None表示不再重试
+
+        指数退避 + 完全抖动：在 [0, min(max_delay, base_delay * 2^(attempt-1))] 中随机取值；
+        服务端给出 Retry-After 时至少等待该时长（不超过 max_retry_after）
+        """
+        if attempt >= self.config["max_attempts"].get(error_class, 1):
+            return None
+        backoff = min(self.config["max_delay"], self.config["base_delay"] * (2 ** (attempt - 1)))
+        delay = random.uniform(0, backoff)
+        if error_class == RATE_LIMITED:
+            hint = retry_after_seconds(exc)
+            if hint is not None:
+                delay = max(delay, min(hint, self.config["max_retry_after"]))
+        return delay
@@ -0,0 +1,234 @@
+"""
+LLM请求调度器
+
+所有LLM调用在发出前都要从调度器获取一个"许可"：
+- 按提供商、按模型分别维护每分钟请求数（RPM）和每分钟token数（TPM）的令牌桶
+- 限制进程内同时在途的调用数
+- 多局游戏共享同一进程时，按各局已获得的许可数轮流放行（公平排队），避免一局游戏占满配额
+
+限额在 config.py 的 RATE_LIMIT_CONFIG 中设置，值为 None 表示不限制。
+注意限额按进程计算，多进程并行时由 run_experiments 按进程数缩放。
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from config import RATE_LIMIT_CONFIG
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟限额，按 限额/60 每秒匀速补充"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """距离桶内有 amount 个令牌还需等待的秒数（单次需求超过容量时按容量计）"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+    def refund(self, amount):
+        """按实际用量修正：amount 为预估值与实际值之差，可为负"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class Grant:
+    """一次调用的许可，记录排队时间，调用结束后可填入实际token用量"""
+
+    def __init__(self, game_id, provider, model, tokens):
+        self.game_id = game_id
+        self.provider = provider
+        self.model = model
+        self.tokens = tokens
+        self.used_tokens = None
+        self.enqueued_at = time.monotonic()
+        self.queue_seconds = 0.0
+
+
+class RequestScheduler:
+    def __init__(self, config=None, scale=1.0):
+        """
+        Args:
+            config: 限额配置（默认使用 RATE_LIMIT_CONFIG）
+            scale: 限额缩放系数（多进程并行时为 1/进程数）
+        """
+        self.config = config if config is not None else RATE_LIMIT_CONFIG
+        self.scale = scale
+        self.max_in_flight = self.config.get("max_in_flight")
+        self._cond = threading.Condition()
+        self._buckets = {}   # (层级, 名称, "rpm"/"tpm") -> TokenBucket
+        self._queues = {}    # game_id -> 等待中的Grant队列
+        self._served = {}    # game_id -> 已放行的许可数
+        self._finished = set()   # 已结束但仍有排队请求的游戏，队列清空后删除其记录
+        self._paused_until = {}  # provider -> 暂停放行直到该时刻（收到限流错误后设置）
+        self._in_flight = 0
+
+    def _bucket(self, scope, name, kind):
+        """获取某个提供商/模型的令牌桶，未配置限额时返回None"""
+        key = (scope, name, kind)
+        if key not in self._buckets:
+            limit = self.config.get(scope, {}).get(name, {}).get(kind)
+            self._buckets[key] = TokenBucket(limit * self.scale) if limit else None
+        return self._buckets[key]
+
+    def _buckets_for(self, grant):
+        """返回 [(令牌桶, 需要的数量)]"""
+        pairs = []
+        for scope, name in (("providers", grant.provider), ("models", grant.model)):
+            rpm = self._bucket(scope, name, "rpm")
+            tpm = self._bucket(scope, name, "tpm")
+            if rpm:
+                pairs.append((rpm, 1))
+            if tpm:
+                pairs.append((tpm, grant.tokens))
+        return pairs
+
+    def _enqueue(self, grant):
+        with self._cond:
+            if grant.game_id not in self._served:
+                # 新加入的游戏从当前最少放行数开始计，避免一次性抢占大量配额
+                active = [self._served[g] for g in self._queues if self._queues[g]]
+                self._served[grant.game_id] = min(active) if active else 0
+            self._queues.setdefault(grant.game_id, deque()).append(grant)
+
+    def _grantable_wait(self, grant, now):
+        """grant 立即可放行时返回0，否则返回建议等待的秒数（None 表示等待其他调用结束）"""
+        if self.max_in_flight and self._in_flight >= self.max_in_flight:
+            return None
+        paused = self._paused_until.get(grant.provider, 0.0) - now
+        if paused > 0:
+            return paused
+        return max([bucket.wait_time(amount, now) for bucket, amount in self._buckets_for(grant)] or [0.0])
+
+    def _try_grant(self, grant):
+        """在锁内尝试放行，返回 (是否放行, 建议等待秒数)"""
+        queue = self._queues[grant.game_id]
+        if queue[0] is not grant:
+            return False, None
+        now = time.monotonic()
+        wait = self._grantable_wait(grant, now)
+        if wait != 0.0:
+            return False, wait
+        # 公平排队：只有在当前可放行的各局游戏中放行数最少的一局才能先走
+        ready = [g for g, q in self._queues.items() if q and self._grantable_wait(q[0], now) == 0.0]
+        if self._served[grant.game_id] > min(self._served[g] for g in ready):
+            return False, None
+        for bucket, amount in self._buckets_for(grant):
+            bucket.consume(amount)
+        queue.popleft()
+        self._served[grant.game_id] += 1
+        self._forget_if_done(grant.game_id)
+        self._in_flight += 1
+        grant.queue_seconds = time.monotonic() - grant.enqueued_at
+        self._cond.notify_all()
+        return True, 0.0
+
+    def _cancel(self, grant):
+        with self._cond:
+            queue = self._queues.get(grant.game_id)
+            if queue and grant in queue:
+                queue.remove(grant)
+                self._forget_if_done(grant.game_id)
+                self._cond.notify_all()
+
+    def acquire(self, provider, model, tokens, game_id=None):
+        """阻塞直到获得许可"""
+        grant = Grant(game_id, provider, model, tokens)
+        self._enqueue(grant)
+        try:
+            with self._cond:
+                while True:
+                    granted, wait = self._try_grant(grant)
+                    if granted:
+                        return grant
+                    self._cond.wait(timeout=wait if wait else 1.0)
+        except BaseException:
+            self._cancel(grant)
+            raise
+
+    async def aacquire(self, provider, model, tokens, game_id=None):
+        """acquire 的异步版本：等待期间让出事件循环"""
+        grant = Grant(game_id, provider, model, tokens)
+        self._enqueue(grant)
+        try:
+            while True:
+                with self._cond:
+                    granted, wait = self._try_grant(grant)
+                if granted:
+                    return grant
+                await asyncio.sleep(min(wait, 1.0) if wait else 0.05)
+        except BaseException:
+            self._cancel(grant)
+            raise
+
+    def release_game(self, game_id):
+        """一局游戏结束后删除它的排队和放行计数，避免长时间的批量实验中这两个表不断增长（每次放行都要遍历它们）"""
+        with self._cond:
+            self._finished.add(game_id)
+            self._forget_if_done(game_id)
+            self._cond.notify_all()
+
+    def _forget_if_done(self, game_id):
+        """在锁内调用：已结束的游戏没有排队的请求时删除其记录"""
+        if game_id in self._finished and not self._queues.get(game_id):
+            self._queues.pop(game_id, None)
+            self._served.pop(game_id, None)
+            self._finished.discard(game_id)
+
+    def pause(self, provider, seconds):
+        """收到限流错误后暂停该提供商的所有新请求 seconds 秒，避免在限流期间继续冲击服务端"""
+        with self._cond:
+            until = time.monotonic() + seconds
+            self._paused_until[provider] = max(self._paused_until.get(provider, 0.0), until)
+
+    def release(self, grant):
+        """调用结束后释放在途名额，并按实际token用量修正TPM令牌桶"""
+        with self._cond:
+            self._in_flight -= 1
+            if grant.used_tokens is not None:
+                for scope, name in (("providers", grant.provider), ("models", grant.model)):
+                    tpm = self._bucket(scope, name, "tpm")
+                    if tpm:
+                        tpm.refund(grant.tokens - grant.used_tokens)
+            self._cond.notify_all()
+
+
+def estimate_tokens(messages):
+    """粗略估计一次调用消耗的token数（输入按字符数折算，加上预估的输出）"""
+    chars = sum(len(msg.get("content") or "") for msg in messages)
+    return int(chars / RATE_LIMIT_CONFIG["chars_per_token"]) + RATE_LIMIT_CONFIG["output_tokens_estimate"]
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """获取进程内共享的调度器"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def configure_scheduler(scale=1.0):
+    """按缩放系数重建进程内的调度器（run_experiments 的子进程初始化时调用）"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(scale=scale)
+        return _scheduler
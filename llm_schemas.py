@@ -0,0 +1,126 @@
+"""
+结构化输出模型工厂
+
+投入决策、小组决策和最终决策的Pydantic模型只有投入上限（当前总金额）会变化。
+旧实现在每次调用时都重新定义一个模型类，DeepSeek 路径还会在每次请求时重新生成并序列化JSON schema，
+一局游戏要重复 N×R 次。这里按投入上限缓存模型类，并按模型类缓存其JSON schema及序列化文本。
+"""
+
+import json
+from functools import lru_cache
+from pydantic import BaseModel, Field
+
+# 投入上限的取值随游戏进程增长，缓存足够覆盖一次实验中出现的所有金额
+_MODEL_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=_MODEL_CACHE_SIZE)
+def contribution_decision_model(max_amount):
+    """每轮投入决策的结构化输出模型（投入上限为 max_amount）
+
+    max_amount 为 None 时schema中不含玩家特定的上限（prefix 布局使用：schema位于提示的最前面，
+    各玩家使用相同的schema才能共享前缀缓存；投入金额由调用方按当前金额截断）
+    """
+    upper = max_amount if max_amount is not None else "当前金额"
+
+    class DynamicContributionDecision(BaseModel):
+        estimated_others_avg_ratio: float = Field(
+            ...,
+            ge=0,
+            le=100,
+            description=f"估计其他玩家本轮的平均投入比例（0-100之间的百分比数值，例如50表示50%）"
+        )
+        output: int = Field(
+            ...,
+            ge=0,
+            le=max_amount,
+            description=f"本轮投入金额，必须是 0–{upper} 之间的整数"
+        )
+        output_ratio: float = Field(
+            ...,
+            ge=0,
+            le=100,
+            description=f"本轮投入比例（0-100之间的百分比数值，应该等于 output/{upper}*100）"
+        )
+        reasoning: str = Field(
+            ...,
+            description="完整决策理由：先说明你如何认知其他玩家（为什么估计他们会这样投入），再解释你自己的决策逻辑（考虑边际收益、风险以及博弈策略）"
+        )
+
+    return DynamicContributionDecision
+
+
+@lru_cache(maxsize=_MODEL_CACHE_SIZE)
+def final_decision_model(max_amount):
+    """最终一次性决策的结构化输出模型（投入上限为 max_amount）"""
+
+    class FinalDecision(BaseModel):
+        reasoning: str = Field(
+            ...,
+            description="思考过程：解释在最终一次性决策中考虑的因素"
+        )
+        output: int = Field(
+            ...,
+            ge=0,
+            le=max_amount,
+            description=f"投入金额，必须是0–{max_amount}之间的整数"
+        )
+
+    return FinalDecision
+
+
+@lru_cache(maxsize=_MODEL_CACHE_SIZE)
+def group_decision_model(max_amount):
+    """小组决策（一次请求为多名玩家做出投入决策）的结构化输出模型，max_amount 为组内玩家当前金额的最大值"""
+
+    class GroupMemberDecision(BaseModel):
+        player_id: str = Field(
+            ...,
+            description="玩家编号，与题目中【玩家X】的X一致"
+        )
+        estimated_others_avg_ratio: float = Field(
+            ...,
+            ge=0,
+            le=100,
+            description="该玩家估计其他玩家本轮的平均投入比例（0-100之间的百分比数值，例如50表示50%）"
+        )
+        output: int = Field(
+            ...,
+            ge=0,
+            le=max_amount,
+            description="该玩家本轮投入金额，必须是 0 到该玩家当前金额之间的整数"
+        )
+        output_ratio: float = Field(
+            ...,
+            ge=0,
+            le=100,
+            description="该玩家本轮投入比例（0-100之间的百分比数值，应该等于 output/该玩家当前金额*100）"
+        )
+        reasoning: str = Field(
+            ...,
+            description="该玩家的完整决策理由：先说明如何认知其他玩家（为什么估计他们会这样投入），再解释自己的决策逻辑（考虑边际收益、风险以及博弈策略）"
+        )
+
+    class GroupContributionDecision(BaseModel):
+        decisions: list[GroupMemberDecision] = Field(
+            ...,
+            description="按题目中的玩家顺序，每名玩家一项"
+        )
+
+    return GroupContributionDecision
+
+
+@lru_cache(maxsize=_MODEL_CACHE_SIZE)
+def _schema_json(model):
+    return json.dumps(model.model_json_schema(), sort_keys=True)
+
+
+def model_schema(model):
+    """模型的JSON schema（按模型类缓存，每次返回新的副本，调用方可以修改）"""
+    return json.loads(_schema_json(model))
+
+
+@lru_cache(maxsize=_MODEL_CACHE_SIZE)
+def model_schema_text(model):
+    """模型JSON schema的缩进文本（DeepSeek 的JSON格式说明中使用）"""
+    return json.dumps(model.model_json_schema(), indent=2)
@@ -0,0 +1,120 @@
+"""
+LLM调用的token用量
+
+把各提供商响应中的用量字段统一为：
+{"input_tokens", "cached_input_tokens", "uncached_input_tokens", "output_tokens", "total_tokens"}
+其中 cached_input_tokens 为命中提供商提示缓存（按共享前缀匹配）的输入token数：
+- OpenAI（Responses API）：usage.input_tokens_details.cached_tokens
+- Gemini：usage_metadata.cached_content_token_count（隐式缓存和显式缓存都计入）
+- DeepSeek（Chat Completions）：usage.prompt_cache_hit_tokens
+
+费用按 PRICING_CONFIG 中的价格表估算，批处理请求（交互记录带 batch_job）按 batch_discount 折算；
+命中本地响应缓存的交互没有用量，不计费用。
+"""
+
+from config import PRICING_CONFIG
+
+_TOKEN_KEYS = ("input_tokens", "cached_input_tokens", "uncached_input_tokens", "output_tokens", "total_tokens")
+
+
+def _get(obj, name):
+    """同时支持SDK响应对象和JSON字典（批处理结果）"""
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def normalize_usage(provider, usage):
+    """把提供商的用量对象转换为统一的字典，没有用量信息时返回None"""
+    if usage is None:
+        return None
+    if provider == "gemini":
+        input_tokens = _get(usage, "prompt_token_count") or 0
+        cached = _get(usage, "cached_content_token_count") or 0
+        # 思考token按输出计费
+        output_tokens = (_get(usage, "candidates_token_count") or 0) + (_get(usage, "thoughts_token_count") or 0)
+        total_tokens = _get(usage, "total_token_count")
+    elif _get(usage, "input_tokens") is not None:
+        # OpenAI Responses API
+        input_tokens = _get(usage, "input_tokens") or 0
+        cached = _get(_get(usage, "input_tokens_details"), "cached_tokens") or 0
+        output_tokens = _get(usage, "output_tokens") or 0
+        total_tokens = _get(usage, "total_tokens")
+    else:
+        # Chat Completions（DeepSeek 等OpenAI兼容接口）
+        input_tokens = _get(usage, "prompt_tokens") or 0
+        cached = _get(usage, "prompt_cache_hit_tokens")
+        if cached is None:
+            cached = _get(_get(usage, "prompt_tokens_details"), "cached_tokens")
+        cached = cached or 0
+        output_tokens = _get(usage, "completion_tokens") or 0
+        total_tokens = _get(usage, "total_tokens")
+    return {
+        "input_tokens": input_tokens,
+        "cached_input_tokens": cached,
+        "uncached_input_tokens": input_tokens - cached,
+        "output_tokens": output_tokens,
+        "total_tokens": total_tokens if total_tokens is not None else input_tokens + output_tokens
+    }
+
+
+def response_usage(provider, response):
+    """从SDK的响应对象中读取统一格式的用量"""
+    if provider == "gemini":
+        return normalize_usage(provider, getattr(response, "usage_metadata", None))
+    return normalize_usage(provider, getattr(response, "usage", None))
+
+
+def result_usage(result):
+    """调用结果 (answer, reasoning, estimated_ratio, output_ratio[, usage]) 中的用量，没有时返回None"""
+    return result[4] if result is not None and len(result) > 4 else None
+
+
+def interaction_cost(model, usage, batch=False):
+    """按价格表估算一次调用的费用，模型不在价格表中时返回None"""
+    prices = PRICING_CONFIG["models"].get(model)
+    if prices is None or not usage:
+        return None
+    cost = ((usage.get("uncached_input_tokens") or 0) * prices["input"]
+            + (usage.get("cached_input_tokens") or 0) * prices.get("cached_input", prices["input"])
+            + (usage.get("output_tokens") or 0) * prices["output"]) / 1_000_000
+    return cost * PRICING_CONFIG["batch_discount"] if batch else cost
+
+
+def usage_totals(interactions):
+    """汇总交互记录中的用量和费用，没有任何用量信息时返回None
+
+    cached_ratio 为命中提示缓存的输入token占全部输入token的比例；
+    cost 只包含价格表中有价格的模型，unpriced_calls 为没有价格的调用数
+    """
+    totals = dict.fromkeys(("calls",) + _TOKEN_KEYS, 0)
+    totals.update(cost=0.0, unpriced_calls=0)
+    for interaction in interactions:
+        usage = interaction.get("usage")
+        if not usage:
+            continue
+        totals["calls"] += 1
+        for key in _TOKEN_KEYS:
+            totals[key] += usage.get(key) or 0
+        cost = interaction_cost(interaction.get("model"), usage, bool(interaction.get("batch_job")))
+        if cost is None:
+            totals["unpriced_calls"] += 1
+        else:
+            totals["cost"] += cost
+    if totals["calls"] == 0:
+        return None
+    totals["cached_ratio"] = totals["cached_input_tokens"] / totals["input_tokens"] if totals["input_tokens"] else 0.0
+    totals["cost"] = round(totals["cost"], 6)
+    totals["currency"] = PRICING_CONFIG["currency"]
+    return totals
+
+
+def usage_by_phase(interactions):
+    """按交互的 debug_label（决策阶段、信念更新等）分别汇总用量，返回 {debug_label: 汇总}"""
+    phases = {}
+    for interaction in interactions:
+        if interaction.get("usage"):
+            phases.setdefault(interaction.get("debug_label") or "", []).append(interaction)
+    return {label: usage_totals(phase_interactions) for label, phase_interactions in phases.items()}
@@ -3,11 +3,15 @@ import sys
 import traceback
 import argparse
 import copy
+import os
 from game_controller import GameController
-from config import validate_config, GAME_CONFIG
+from config import validate_config, GAME_CONFIG, METRICS_CONFIG
 
 def main(model=None, endowment=None, rounds=None, r=None, num_players=None, personality_type=None, 
-         reveal_mode=None, anchor_ratio=None, instruction_type=None, debug_prompts=False):
+         reveal_mode=None, anchor_ratio=None, instruction_type=None, debug_prompts=False,
+         max_workers=None, async_mode=None, use_cache=None, cache_salt=None, replay_file=None,
+         stream_history=None, resume_file=None, batch_mode=None, group_size=None,
+         prompt_layout=None):
     """游戏主入口函数
     
     Args:
@@ -21,6 +25,16 @@ def main(model=None, endowment=None, rounds=None, r=None, num_players=None, pers
         anchor_ratio: anchor智能体比例
         instruction_type: 指导语类型 ("certain" 或 "uncertain")
         debug_prompts: 是否启用调试输出
+        max_workers: 每个阶段并发LLM调用数上限（默认使用 CONCURRENCY_CONFIG）
+        async_mode: 是否使用异步客户端驱动LLM调用（默认使用 CONCURRENCY_CONFIG）
+        use_cache: 是否启用LLM响应缓存（默认使用 CACHE_CONFIG）
+        cache_salt: 参与缓存键计算的盐值（如重复实验序号），不同盐值互不命中
+        replay_file: 已保存的游戏历史JSON；指定后按其中的配置和LLM记录离线回放整局游戏
+        stream_history: 是否流式记录（每轮数据和每次LLM交互立即追加到JSONL，默认使用 RECORDER_CONFIG）
+        resume_file: 中断的游戏记录（JSON）或流式记录（JSONL）；指定后恢复到其最后完成的轮次并继续游戏
+        batch_mode: 是否以批处理任务执行每个阶段的LLM调用（默认使用 BATCH_CONFIG）
+        group_size: 小组决策时每次请求包含的玩家数（1 表示单独调用，默认使用 GROUP_DECISION_CONFIG）
+        prompt_layout: 投入决策提示的布局 ("legacy" 或 "prefix"，默认使用 PROMPT_CONFIG)
     """
     
     # 创建游戏配置的副本，避免修改全局配置
@@ -54,6 +68,27 @@ def main(model=None, endowment=None, rounds=None, r=None, num_players=None, pers
         game_config["anchor_ratio"] = anchor_ratio
     if instruction_type is not None:
         game_config["instruction_type"] = instruction_type
+    if max_workers is not None:
+        game_config["max_workers"] = max_workers
+    if async_mode is not None:
+        game_config["async_mode"] = async_mode
+    if use_cache is not None:
+        game_config["use_cache"] = use_cache
+    if cache_salt is not None:
+        game_config["cache_salt"] = cache_salt
+    if stream_history is not None:
+        game_config["stream_history"] = stream_history
+    if batch_mode is not None:
+        game_config["batch_mode"] = batch_mode
+    if group_size is not None:
+        game_config["group_size"] = group_size
+    if prompt_layout is not None:
+        game_config["prompt_layout"] = prompt_layout
+    if replay_file is not None:
+        apply_replay_config(game_config, replay_file)
+    resume_record = None
+    if resume_file is not None:
+        resume_record = apply_resume_config(game_config, resume_file)
     
     print(f"\n{'='*80}")
     print(f"🎮 游戏配置信息")
@@ -66,11 +101,9 @@ def main(model=None, endowment=None, rounds=None, r=None, num_players=None, pers
     print(f"{'='*80}\n")
     
     try:
-        # 验证配置并更新全局配置
+        # 验证配置（本局配置显式传给控制器和智能体，不修改全局 GAME_CONFIG）
         print("正在验证游戏配置...")
-        # 更新全局配置（不恢复，让agents可以读取到正确的配置）
-        GAME_CONFIG.update(game_config)
-        validate_config()
+        validate_config(game_config)
         
         # 创建游戏控制器
         print("正在初始化游戏控制器...")
@@ -78,6 +111,8 @@ def main(model=None, endowment=None, rounds=None, r=None, num_players=None, pers
         # 创建并运行游戏
         game = GameController(game_config)
         game.setup_game()  # 设置游戏，包括创建智能体
+        if resume_record is not None:
+            game.restore_state(resume_record)
         
         # 根据参数设置调试模式
         if debug_prompts:
@@ -109,13 +144,97 @@ def main(model=None, endowment=None, rounds=None, r=None, num_players=None, pers
 
 
 
+def apply_replay_config(game_config, replay_file):
+    """用已保存游戏的配置覆盖本局配置，并切换到回放提供商
+    
+    锚定智能体的位置沿用原始游戏，回放结果保存到 game_history/replay/，不会被计入实验完成次数
+    """
+    from llm_replay import ReplaySource
+    source = ReplaySource(replay_file)
+    recorded_config = source.game_config()
+    for key in ["model", "personality_type", "endowment", "r", "rounds", "num_players",
+                "reveal_mode", "anchor_ratio", "instruction_type", "group_size", "prompt_layout"]:
+        if recorded_config.get(key) is not None:
+            game_config[key] = recorded_config[key]
+    game_config["provider"] = "replay"
+    game_config["replay_file"] = replay_file
+    game_config["anchor_ids"] = source.anchor_ids()
+    game_config["output_dir"] = os.path.join("game_history", "replay")
+    return game_config
+
+
+def apply_resume_config(game_config, resume_file):
+    """用中断游戏的配置覆盖本局配置，返回用于恢复状态的游戏记录
+    
+    锚定智能体的位置、模型和提供商都沿用原始游戏
+    """
+    from game_recorder import load_game_history, load_stream_record
+    if resume_file.endswith(".jsonl"):
+        _, game_record, _, _ = load_stream_record(resume_file)
+    else:
+        game_record = load_game_history(resume_file)
+    recorded_config = game_record.get("game_config", {})
+    for key in ["model", "provider", "personality_type", "endowment", "r", "rounds", "num_players",
+                "reveal_mode", "anchor_ratio", "instruction_type", "group_size", "prompt_layout"]:
+        if recorded_config.get(key) is not None:
+            game_config[key] = recorded_config[key]
+    game_config["anchor_ids"] = [agent["id"] for agent in game_record.get("agents", []) if agent.get("is_anchor")]
+    game_config["resumed_from"] = resume_file
+    return game_record
+
+
 if __name__ == "__main__":
     # 添加命令行参数解析
     parser = argparse.ArgumentParser(description='公共品博弈游戏')
     parser.add_argument('--debug-prompts', action='store_true', 
                        help='启用prompt调试输出，显示发送给AI的完整提示内容')
+    parser.add_argument('--max-workers', type=int, default=None,
+                       help='每个阶段并发LLM调用数上限（1 表示串行）')
+    parser.add_argument('--async', dest='async_mode', action='store_true', default=None,
+                       help='使用异步客户端在单个事件循环中驱动所有LLM调用')
+    parser.add_argument('--cache', dest='use_cache', action='store_true', default=None,
+                       help='启用LLM响应缓存（相同请求直接返回缓存结果）')
+    parser.add_argument('--cache-salt', default=None,
+                       help='参与缓存键计算的盐值，不同盐值的请求互不命中')
+    parser.add_argument('--replay', dest='replay_file', default=None,
+                       help='按已保存的游戏历史JSON离线回放整局游戏（不调用API）')
+    parser.add_argument('--stream', dest='stream_history', action='store_true', default=None,
+                       help='流式记录：每轮数据和每次LLM交互立即追加到 game_history/streams/ 下的JSONL')
+    parser.add_argument('--resume', dest='resume_file', default=None,
+                       help='从中断的游戏记录（JSON）或流式记录（JSONL）恢复到最后完成的轮次并继续游戏')
+    parser.add_argument('--batch', dest='batch_mode', action='store_true', default=None,
+                       help='批处理模式：每个阶段所有玩家的请求打包为一个批处理任务（延迟更高、价格更低）')
+    parser.add_argument('--group-size', type=int, default=None,
+                       help='小组决策：每次请求为多少名玩家做出投入决策（1 表示每名玩家单独调用）')
+    parser.add_argument('--prompt-layout', choices=['legacy', 'prefix'], default=None,
+                       help='投入决策提示的布局：prefix 把规则和共享历史放在前面、玩家信息放在最后，便于命中提供商的提示缓存')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                       help='在该端口提供 Prometheus 格式的LLM调用指标（/metrics）')
+    parser.add_argument('--profile', action='store_true',
+                       help='性能分析：用cProfile分析本局游戏，按阶段统计不含LLM等待的CPU时间，报告写入 game_history/profiles/')
+    parser.add_argument('--compact-stream', default=None, metavar='JSONL',
+                       help='由流式记录的JSONL（包括崩溃后留下的文件）生成完整的JSON/TXT记录后退出')
     args = parser.parse_args()
     
+    if args.compact_stream:
+        from game_recorder import compact_stream
+        compact_stream(args.compact_stream)
+        sys.exit(0)
+    
+    from llm_metrics import get_metrics, start_http_server
+    metrics_port = args.metrics_port or METRICS_CONFIG["http_port"]
+    if metrics_port:
+        start_http_server(metrics_port)
+    
     # 运行单次游戏
-    main(debug_prompts=args.debug_prompts)
+    game_kwargs = dict(debug_prompts=args.debug_prompts, max_workers=args.max_workers, async_mode=args.async_mode,
+                       use_cache=args.use_cache, cache_salt=args.cache_salt, replay_file=args.replay_file,
+                       stream_history=args.stream_history, resume_file=args.resume_file, batch_mode=args.batch_mode,
+                       group_size=args.group_size, prompt_layout=args.prompt_layout)
+    if args.profile:
+        from profiling import run_profiled
+        run_profiled("game", main, **game_kwargs)
+    else:
+        main(**game_kwargs)
+    get_metrics().write_textfile()
 
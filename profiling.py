@@ -0,0 +1,248 @@
+"""
+运行开销分析（--profile）
+
+真实提供商下LLM等待时间掩盖了其他开销；使用快速的本地后端或大量玩家时，prompt构建、format_round_summary、
+调试输出、GameRecorder 的文本渲染和JSON序列化等Python开销会成为主要部分。启用后：
+- 用 cProfile 分析整个运行过程（Python 3.12 之前 cProfile 只分析启用它的线程，这里为每个新线程各创建一个分析器，
+  结束时合并），结果保存为 .prof（可用 pstats / snakeviz 查看）
+- 各阶段（controller.* / agent.* / recorder.*）按线程CPU时间（time.thread_time）计时，只统计该阶段自身的时间
+  （减去嵌套阶段），等待LLM响应、限流排队和线程池等待不消耗CPU，因此不计入；
+  提供商SDK的请求序列化和响应解析单独计入 llm.request，也不算作控制器/智能体/记录器的开销
+- 协程（异步模式的请求）按其每次恢复执行的片段分别计时后合并为一次调用：同一线程中交错运行的其他协程
+  不会计入，事件循环外层的阶段（如 controller.play_round）也不再包含这部分CPU时间
+- 结束时在 PROFILE_CONFIG["dir"]（默认 game_history/profiles/）下写出 <名称>_<时间戳>.prof 和同名 .txt 报告
+
+未启用时 profiled 装饰器和 phase 只检查一次全局变量，不计时。
+"""
+
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from config import PROFILE_CONFIG
+
+_active = None
+_NULL_PHASE = nullcontext()
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        # [名称, 开始CPU时间, 开始墙钟时间, 嵌套阶段的CPU时间]
+        stack.append([self.name, time.thread_time(), time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stack = self.profiler._stack()
+        name, cpu_start, wall_start, children_cpu = stack.pop()
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        if stack:
+            stack[-1][3] += cpu
+        self.profiler._add(name, cpu - children_cpu, wall)
+        return False
+
+
+class _CoroutinePhase:
+    """把协程的执行计入阶段 name：每次恢复执行的片段各自压栈计时（片段之间没有挂起，栈的嵌套关系保持正确），
+    结束时合并记录为一次调用，墙钟时间为从开始到结束的总时长（含等待）"""
+
+    def __init__(self, profiler, name, coro):
+        self.profiler = profiler
+        self.name = name
+        self.coro = coro
+
+    def _step(self, method, arg):
+        stack = self.profiler._stack()
+        stack.append([self.name, time.thread_time(), 0.0, 0.0])
+        try:
+            return method(arg)
+        finally:
+            _, cpu_start, _, children_cpu = stack.pop()
+            cpu = time.thread_time() - cpu_start
+            if stack:
+                stack[-1][3] += cpu
+            self.cpu += cpu - children_cpu
+
+    def __await__(self):
+        self.cpu = 0.0
+        wall_start = time.perf_counter()
+        method, arg = self.coro.send, None
+        try:
+            while True:
+                try:
+                    yielded = self._step(method, arg)
+                except StopIteration as stop:
+                    return stop.value
+                try:
+                    method, arg = self.coro.send, (yield yielded)
+                except BaseException as e:
+                    method, arg = self.coro.throw, e
+        finally:
+            self.profiler._add(self.name, self.cpu, time.perf_counter() - wall_start)
+
+
+class RunProfiler:
+    """一次运行（单局游戏或一次批量实验）的CPU分析器和阶段计时"""
+
+    def __init__(self, name):
+        self.name = name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profilers = []
+        self.phases = {}      # 阶段名 -> [调用次数, 自身CPU时间, 墙钟时间（含嵌套阶段和等待）]
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, name, cpu, wall):
+        with self._lock:
+            entry = self.phases.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += cpu
+            entry[2] += wall
+
+    def _start_thread_profiler(self, frame, event, arg):
+        """threading.setprofile 的钩子：新线程第一次执行时为其创建并启用一个 cProfile 分析器"""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 已有全局分析器覆盖所有线程（sys.monitoring 实现的 cProfile）
+            return
+        with self._lock:
+            self._profilers.append(profiler)
+
+    def start(self):
+        global _active
+        profiler = cProfile.Profile()
+        self._profilers.append(profiler)
+        threading.setprofile(self._start_thread_profiler)
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        _active = self
+        profiler.enable()
+        return self
+
+    def stop(self):
+        global _active
+        self._profilers[0].disable()
+        _active = None
+        threading.setprofile(None)
+        self.wall_seconds = time.perf_counter() - self._wall_start
+        self.cpu_seconds = time.process_time() - self._cpu_start
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def stats(self):
+        """合并所有线程的 cProfile 结果"""
+        stats = pstats.Stats(self._profilers[0])
+        for profiler in self._profilers[1:]:
+            try:
+                stats.add(profiler)
+            except TypeError:
+                # 线程中的分析器没有记录到任何调用
+                continue
+        return stats
+
+    def report(self, top=None):
+        """阶段耗时表和按自身时间排序的前 top 个函数"""
+        top = top or PROFILE_CONFIG["top"]
+        llm_cpu = self.phases.get("llm.request", [0, 0.0, 0.0])[1]
+        overhead = {name: entry for name, entry in self.phases.items() if name != "llm.request"}
+        attributed = sum(entry[1] for entry in overhead.values())
+        lines = [
+            f"运行: {self.name}",
+            f"墙钟时间: {self.wall_seconds:.3f}s  进程CPU时间: {self.cpu_seconds:.3f}s",
+            f"LLM请求: {self.phases.get('llm.request', [0])[0]} 次，等待（墙钟累计）{self.phases.get('llm.request', [0, 0.0, 0.0])[2]:.3f}s，"
+            f"SDK序列化/解析CPU {llm_cpu:.3f}s（均不计入下表）",
+            "",
+            "各阶段自身CPU时间（不含嵌套阶段和LLM等待）：",
+            f"{'阶段':<36} {'次数':>8} {'CPU(s)':>10} {'占比':>7} {'单次(ms)':>10}"
+        ]
+        for name, (calls, cpu, _) in sorted(overhead.items(), key=lambda item: item[1][1], reverse=True):
+            share = cpu / self.cpu_seconds if self.cpu_seconds else 0.0
+            lines.append(f"{name:<36} {calls:>8} {cpu:>10.3f} {share:>7.1%} {cpu / calls * 1000 if calls else 0:>10.3f}")
+        unattributed = max(0.0, self.cpu_seconds - attributed - llm_cpu)
+        lines.append(f"{'（其他，未归入任何阶段）':<36} {'':>8} {unattributed:>10.3f} "
+                     f"{unattributed / self.cpu_seconds if self.cpu_seconds else 0.0:>7.1%}")
+        stream = io.StringIO()
+        stats = self.stats()
+        stats.stream = stream
+        stats.sort_stats("tottime").print_stats(top)
+        lines += ["", f"cProfile（按自身时间排序的前 {top} 个函数，所有线程合并）：", stream.getvalue()]
+        return "\n".join(lines)
+
+    def write(self, directory=None):
+        """写出 .prof 和 .txt 报告，返回 (prof路径, txt路径)"""
+        directory = directory or PROFILE_CONFIG["dir"]
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, f"{self.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        prof_path, text_path = stem + ".prof", stem + ".txt"
+        self.stats().dump_stats(prof_path)
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write(self.report())
+        return prof_path, text_path
+
+
+def phase(name):
+    """标记一段代码属于某个阶段（未启用分析时为空操作）"""
+    profiler = _active
+    if profiler is None:
+        return _NULL_PHASE
+    return _Phase(profiler, name)
+
+
+def profiled(name):
+    """把函数的执行时间计入阶段 name 的装饰器（同步函数和协程函数均可）"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                profiler = _active
+                if profiler is None:
+                    return await func(*args, **kwargs)
+                return await _CoroutinePhase(profiler, name, func(*args, **kwargs))
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return func(*args, **kwargs)
+            with _Phase(profiler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_profiled(name, func, *args, **kwargs):
+    """在分析器中运行 func，结束后写出报告并打印路径，返回 func 的返回值"""
+    profiler = RunProfiler(name)
+    try:
+        with profiler:
+            return func(*args, **kwargs)
+    finally:
+        prof_path, text_path = profiler.write()
+        print(f"\n性能分析结果已保存到：{prof_path}")
+        print(f"性能分析报告：{text_path}")
@@ -6,13 +6,26 @@
 1. 在下方设置要循环的变量列表
 2. 不需要循环的变量会使用 config.py 中的默认值
 3. 运行：python run_experiments.py
+4. 并行运行：python run_experiments.py --workers 4（每局游戏在独立的子进程中运行，输出写入 game_history/logs/）
+5. 批处理模式：python run_experiments.py --batch（每个阶段的请求打包为批处理任务）；
+   加上 --lockstep 8 时同一进程中同时推进8局游戏，各局同一阶段的请求合并为同一个批处理任务
 """
 
 import time
-import glob
 import os
+import sys
+import argparse
+import functools
+import itertools
+import multiprocessing
+import contextvars
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from main import main
-from config import GAME_CONFIG
+from config import GAME_CONFIG, METRICS_CONFIG
+from llm_scheduler import configure_scheduler
+from experiment_catalog import get_catalog, print_cost_report
+from llm_metrics import get_metrics, reset_metrics, format_summary, start_http_server
+from profiling import run_profiled
 
 # ============ 实验参数设置 ============
 # 设置要循环的变量（用列表表示），不循环的变量注释掉或设为单个值
@@ -39,7 +52,21 @@ personality_types = ["neutral"]  # 性格类型，可选：["selfish", "neutral"
 repeat = 3  # 每组参数重复实验的次数
 
 # ============ 辅助函数 ============
-def check_experiment_exists(model, rounds, num_players, anchor_ratio, reveal_mode, instruction_type, personality_type, required_count=3):
+def count_completed_experiments(model, rounds, num_players, anchor_ratio, reveal_mode, instruction_type, personality_type):
+    """统计指定条件已完成的实验次数（查询 game_history 的实验目录索引）"""
+    return get_catalog("game_history").count(
+        status="completed",
+        model=model,
+        rounds=rounds,
+        num_players=num_players,
+        anchor_ratio=anchor_ratio,
+        reveal_mode=reveal_mode,
+        instruction_type=instruction_type,
+        personality_type=personality_type
+    )
+
+def check_experiment_exists(model, rounds, num_players, anchor_ratio, reveal_mode, instruction_type, personality_type, required_count=3,
+                            existing_count=None):
     """
     检查指定条件的实验是否已经完成足够次数
     
@@ -52,19 +79,16 @@ def check_experiment_exists(model, rounds, num_players, anchor_ratio, reveal_mod
         instruction_type: 指导语类型
         personality_type: 性格类型
         required_count: 需要的完成次数（默认3次）
+        existing_count: 已查询到的完成次数（None 时查询实验目录）
     
     Returns:
         bool: 如果已完成足够次数返回True，否则返回False
     """
-    # 构建文件名模式（不包含时间戳）
-    anchor_pct = int(anchor_ratio * 100)
-    pattern = f"game_history/{model}_{personality_type}_{num_players}p_{rounds}r_{reveal_mode}_anchor{anchor_pct}pct_{instruction_type}_completed_*.json"
-    
-    # 查找匹配的文件
-    matching_files = glob.glob(pattern)
+    if existing_count is None:
+        existing_count = count_completed_experiments(model, rounds, num_players, anchor_ratio,
+                                                     reveal_mode, instruction_type, personality_type)
     
     # 返回是否已完成足够次数
-    existing_count = len(matching_files)
     if existing_count >= required_count:
         print(f"  ✓ 跳过：该条件已完成 {existing_count} 次实验")
         return True
@@ -72,8 +96,22 @@ def check_experiment_exists(model, rounds, num_players, anchor_ratio, reveal_mod
         print(f"  → 继续：该条件已完成 {existing_count}/{required_count} 次，需要补充 {required_count - existing_count} 次")
     return False
 
+def iter_conditions():
+    """按固定顺序遍历实验参数网格"""
+    for model, rounds, num_players, anchor_ratio, reveal_mode, instruction_type, personality_type in itertools.product(
+            models, rounds_list, num_players_list, anchor_ratios, reveal_modes, instruction_types, personality_types):
+        yield {
+            "model": model,
+            "rounds": rounds,
+            "num_players": num_players,
+            "anchor_ratio": anchor_ratio,
+            "reveal_mode": reveal_mode,
+            "instruction_type": instruction_type,
+            "personality_type": personality_type
+        }
+
 # ============ 批量运行函数 ============
-def run_batch():
+def run_batch(batch_mode=None):
     """批量运行实验"""
     total_experiments = (len(models) * len(rounds_list) * len(num_players_list) * 
                         len(anchor_ratios) * len(reveal_modes) * 
@@ -94,14 +132,17 @@ def run_batch():
                         for instruction_type in instruction_types:
                             for personality_type in personality_types:
                                 # 检查该条件是否已完成足够次数
+                                existing_count = count_completed_experiments(model, rounds, num_players, anchor_ratio,
+                                                                             reveal_mode, instruction_type, personality_type)
                                 if check_experiment_exists(model, rounds, num_players, anchor_ratio, 
                                                          reveal_mode, instruction_type, personality_type, 
-                                                         required_count=repeat):
+                                                         required_count=repeat, existing_count=existing_count):
                                     skipped_count += repeat
                                     continue
+                                skipped_count += existing_count
                                 
-                                # 如果未完成足够次数，运行实验
-                                for i in range(repeat):
+                                # 如果未完成足够次数，只补充缺少的次数（序号接着已完成的次数，与 collect_tasks 一致）
+                                for i in range(existing_count, repeat):
                                     experiment_count += 1
                                     print(f"\n{'='*60}")
                                     print(f"实验 {experiment_count}/{total_experiments - skipped_count}")
@@ -122,7 +163,9 @@ def run_batch():
                                         reveal_mode=reveal_mode,
                                         anchor_ratio=anchor_ratio,
                                         instruction_type=instruction_type,
-                                        debug_prompts=True  # 启用prompt调试输出
+                                        debug_prompts=True,  # 启用prompt调试输出
+                                        cache_salt=f"repeat{i + 1}",  # 启用缓存时，各次重复实验独立采样
+                                        batch_mode=batch_mode
                                     )
                                     
                                     # 实验间休息
@@ -136,5 +179,213 @@ def run_batch():
     print(f"  - 总计: {total_experiments} 个实验")
     print(f"{'='*60}\n")
 
+def _run_game_in_worker(game_kwargs, log_path, profile=False):
+    """子进程中运行一局游戏，标准输出重定向到日志文件
+
+    每局游戏的配置都通过参数显式传入 main()，不依赖也不修改进程内的全局配置；
+    返回 (是否成功, 耗时, 本局的LLM调用指标快照)，由主进程合并；profile 为 True 时每局写出各自的性能分析报告
+    """
+    reset_metrics()
+    start = time.time()
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = log_file
+        try:
+            if profile:
+                success = run_profiled(os.path.splitext(os.path.basename(log_path))[0], main, **game_kwargs)
+            else:
+                success = main(**game_kwargs)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+    return success, time.time() - start, get_metrics().snapshot()
+
+def collect_tasks(log_dir, batch_mode=None):
+    """确定每个条件还需补充的次数，返回 ([(game_kwargs, log_path), ...], 跳过的实验数)"""
+    tasks = []
+    skipped_count = 0
+    for condition in iter_conditions():
+        existing_count = count_completed_experiments(**condition)
+        check_experiment_exists(**condition, required_count=repeat, existing_count=existing_count)
+        missing = max(0, repeat - existing_count)
+        skipped_count += repeat - missing
+        for i in range(existing_count, existing_count + missing):
+            game_kwargs = dict(
+                condition,
+                endowment=GAME_CONFIG.get("endowment", 10),
+                r=GAME_CONFIG.get("r", 3),
+                debug_prompts=True,  # 启用prompt调试输出（写入日志文件）
+                cache_salt=f"repeat{i + 1}",  # 启用缓存时，各次重复实验独立采样；中断后重跑同一序号可命中缓存
+                batch_mode=batch_mode
+            )
+            log_name = (f"{condition['model']}_{condition['personality_type']}_{condition['num_players']}p_"
+                        f"{condition['rounds']}r_{condition['reveal_mode']}_anchor{int(condition['anchor_ratio'] * 100)}pct_"
+                        f"{condition['instruction_type']}_repeat{i + 1}.log")
+            tasks.append((game_kwargs, os.path.join(log_dir, log_name)))
+    return tasks, skipped_count
+
+def run_batch_parallel(workers, batch_mode=None, profile=False):
+    """使用多个子进程并行运行实验，已完成的条件按 check_experiment_exists 的规则跳过"""
+    total_experiments = (len(models) * len(rounds_list) * len(num_players_list) * 
+                        len(anchor_ratios) * len(reveal_modes) * 
+                        len(instruction_types) * len(personality_types) * repeat)
+    
+    print(f"\n{'='*60}")
+    print(f"总共需要运行 {total_experiments} 个实验（并行进程数: {workers}）")
+    print(f"{'='*60}\n")
+    
+    log_dir = os.path.join("game_history", "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    
+    # 先确定每个条件还需补充的次数，再统一提交
+    tasks, skipped_count = collect_tasks(log_dir, batch_mode)
+    
+    print(f"\n待运行 {len(tasks)} 个实验，跳过已完成 {skipped_count} 个\n")
+    
+    succeeded = 0
+    failed = 0
+    # spawn：每个子进程从干净的解释器启动，互不共享模块级状态
+    # 限流额度按进程计算，各子进程平分 RATE_LIMIT_CONFIG 中的限额
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=configure_scheduler, initargs=(1.0 / workers,)) as executor:
+        futures = {executor.submit(_run_game_in_worker, game_kwargs, log_path, profile): log_path
+                   for game_kwargs, log_path in tasks}
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            log_path = futures[future]
+            try:
+                success, elapsed, metrics_snapshot = future.result()
+                get_metrics().merge(metrics_snapshot)
+            except Exception as e:
+                success, elapsed = False, 0
+                print(f"  ✗ 子进程异常: {e}")
+            if success:
+                succeeded += 1
+            else:
+                failed += 1
+            print(f"[{done_count}/{len(tasks)}] {'✓' if success else '✗'} {os.path.basename(log_path)} ({elapsed:.1f}s)")
+    
+    print(f"\n{'='*60}")
+    print(f"所有实验完成！")
+    print(f"  - 成功: {succeeded} 个实验")
+    print(f"  - 失败: {failed} 个实验（详见 {log_dir}）")
+    print(f"  - 跳过已完成: {skipped_count} 个实验")
+    print(f"  - 总计: {total_experiments} 个实验")
+    print(f"{'='*60}\n")
+
+class _ThreadLogStream:
+    """按所属游戏把输出写入各自的日志文件（同步推进的多局游戏在同一进程的不同线程中运行）
+
+    日志文件绑定在上下文变量上：批处理的工作线程和游戏内的线程池在发起调用的游戏的上下文中执行
+    （见 PreparedCall.context 和 GameController._map_agents），其输出也写入该游戏的日志
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.current = contextvars.ContextVar("log_file", default=None)
+
+    def _target(self):
+        return self.current.get() or self.default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+def run_batch_lockstep(games):
+    """在同一进程中同时推进 games 局游戏（批处理模式），各局同一阶段的请求合并为同一个批处理任务
+    
+    每局游戏在独立的线程中运行，输出写入 game_history/logs/ 下各自的日志文件
+    """
+    total_experiments = (len(models) * len(rounds_list) * len(num_players_list) * 
+                        len(anchor_ratios) * len(reveal_modes) * 
+                        len(instruction_types) * len(personality_types) * repeat)
+    
+    print(f"\n{'='*60}")
+    print(f"总共需要运行 {total_experiments} 个实验（批处理模式，同步推进的游戏数: {games}）")
+    print(f"{'='*60}\n")
+    
+    log_dir = os.path.join("game_history", "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    tasks, skipped_count = collect_tasks(log_dir, batch_mode=True)
+    print(f"\n待运行 {len(tasks)} 个实验，跳过已完成 {skipped_count} 个\n")
+    
+    stream = _ThreadLogStream(sys.stdout)
+    
+    def run_game(game_kwargs, log_path):
+        start = time.time()
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            token = stream.current.set(log_file)
+            try:
+                success = main(**game_kwargs)
+            finally:
+                stream.current.reset(token)
+        return success, time.time() - start
+    
+    succeeded = 0
+    failed = 0
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = stream
+    try:
+        with ThreadPoolExecutor(max_workers=games) as executor:
+            futures = {executor.submit(run_game, game_kwargs, log_path): log_path for game_kwargs, log_path in tasks}
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                log_path = futures[future]
+                try:
+                    success, elapsed = future.result()
+                except Exception as e:
+                    success, elapsed = False, 0
+                    print(f"  ✗ 游戏线程异常: {e}")
+                if success:
+                    succeeded += 1
+                else:
+                    failed += 1
+                print(f"[{done_count}/{len(tasks)}] {'✓' if success else '✗'} {os.path.basename(log_path)} ({elapsed:.1f}s)")
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    
+    print(f"\n{'='*60}")
+    print(f"所有实验完成！")
+    print(f"  - 成功: {succeeded} 个实验")
+    print(f"  - 失败: {failed} 个实验（详见 {log_dir}）")
+    print(f"  - 跳过已完成: {skipped_count} 个实验")
+    print(f"  - 总计: {total_experiments} 个实验")
+    print(f"{'='*60}\n")
+
 if __name__ == "__main__":
-    run_batch()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='批量运行公共品博弈实验')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='并行运行的游戏数（每局一个子进程），1 表示串行')
+    parser.add_argument('--batch', dest='batch_mode', action='store_true', default=None,
+                       help='批处理模式：每个阶段所有玩家的请求打包为一个批处理任务')
+    parser.add_argument('--lockstep', type=int, default=0,
+                       help='批处理模式下在同一进程中同时推进的游戏数，各局同一阶段的请求合并提交')
+    parser.add_argument('--profile', action='store_true',
+                       help='性能分析：串行/同步推进时分析整次批量实验，--workers 时每局各写一份报告（game_history/profiles/）')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                       help='在该端口提供 Prometheus 格式的LLM调用指标（/metrics，并行模式下每局结束后合并子进程的指标）')
+    args = parser.parse_args()
+    
+    metrics_port = args.metrics_port or METRICS_CONFIG["http_port"]
+    if metrics_port:
+        start_http_server(metrics_port)
+    sweep_start = time.time()
+    if args.lockstep > 1:
+        run = functools.partial(run_batch_lockstep, args.lockstep)
+    elif args.workers > 1:
+        # 子进程各自分析所运行的游戏
+        run = functools.partial(run_batch_parallel, args.workers, batch_mode=args.batch_mode, profile=args.profile)
+    else:
+        run = functools.partial(run_batch, batch_mode=args.batch_mode)
+    if args.profile and not (args.workers > 1 and args.lockstep <= 1):
+        run_profiled("sweep", run)
+    else:
+        run()
+    
+    # 本次批量实验的token用量和估算费用（按模型和实验条件汇总）
+    print("本次批量实验的token用量和费用：")
+    print_cost_report(get_catalog("game_history"), since=sweep_start)
+    if METRICS_CONFIG["print_summary"]:
+        print(format_summary(get_metrics().summary(), "本次批量实验的LLM调用指标"))
+    textfile = get_metrics().write_textfile()
+    if textfile:
+        print(f"LLM调用指标已写入：{textfile}")